@@ -1,14 +1,31 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import Flask, render_template, request, flash, redirect, session, g, jsonify
 # from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm, UpdatePasswordForm, PrivacySettingsForm, AdminUserUpdateForm, DirectMessageForm
-from models import db, connect_db, User, Message, Likes, Notification, Block, DirectMessage
+from models import db, connect_db, User, Message, Likes, Notification, Block, DirectMessage, Conversation, clear_notifications, decode_cursor, paginate_newer, paginate_timeline, recount_counters, timeline_query, toggle_like
+from conversations import send_dm, note_read, mark_read, read_inbox, read_thread, rebuild_conversations
+from unread import invalidate_on_commit, unread_counts
+from events import event_stream, publish
+from current_user import get_current_user
+from passwords import PasswordHasherBusy, init_app as init_password_hashing
+from metrics import init_app as init_metrics
+from instrumentation import endpoint_stats, init_app as init_instrumentation
+from ratelimit import RateLimitExceeded, init_app as init_rate_limiting
+from search import search_users, list_all_users, suggest_usernames, search_messages
+from timelines import fan_out_message, backfill_follow, prune_author, remove_message, remove_user, rebuild_all_timelines, read_home_timeline, read_home_since, home_watermark, latest_message_id
 
 CURR_USER_KEY = "curr_user"
 
+# Endpoints that only need to know who is logged in, not a full ORM user;
+# None covers 404s.
+IDENTITY_ONLY_ENDPOINTS = {None, 'static', 'metrics', 'like_post', 'mark_dm_read', 'mark_all_dms_read',
+                           'mark_conversation_read', 'clear_all_notifications', 'events_stream',
+                           'timeline_updates'}
+
 app = Flask(__name__)
 
 # Get DB_URI from environ variable (useful for production/testing) or,
@@ -19,9 +36,60 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+# Authors with more followers than this get merged into home timelines at
+# read time instead of being fanned out on write (see timelines.py).
+app.config['TIMELINE_CELEBRITY_CUTOFF'] = int(os.environ.get('TIMELINE_CELEBRITY_CUTOFF', 10000))
+# Seconds the navbar's unread notification/DM counts are cached, and for how
+# many users per process (see unread.py).
+app.config['UNREAD_CACHE_TTL'] = int(os.environ.get('UNREAD_CACHE_TTL', 15))
+app.config['UNREAD_CACHE_SIZE'] = int(os.environ.get('UNREAD_CACHE_SIZE', 1024))
+# Size and lifetime of the per-process cache of logged-in user snapshots.
+# Edits reach other workers' caches over the events fanout; the TTL only
+# matters if that event is lost.
+app.config['CURRENT_USER_CACHE_SIZE'] = int(os.environ.get('CURRENT_USER_CACHE_SIZE', 1024))
+app.config['CURRENT_USER_CACHE_TTL'] = int(os.environ.get('CURRENT_USER_CACHE_TTL', 60))
+# bcrypt work factor, and how many hashes may run / wait at once across
+# every worker on this host (see passwords.py). PASSWORD_HASH_WORKERS=0
+# hashes inline.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', app.config['PASSWORD_HASH_WORKERS'] * 4))
+app.config['PASSWORD_HASH_STORAGE'] = os.environ.get('PASSWORD_HASH_STORAGE')
+# Token buckets for login, signup and write endpoints (see ratelimit.py).
+# RATELIMIT_BACKEND is "mmap" (shared by this host's workers), "memory", or
+# "module:Class" for a multi-host store.
+app.config['RATELIMIT_ENABLED'] = os.environ.get('RATELIMIT_ENABLED', '1') != '0'
+app.config['RATELIMIT_BACKEND'] = os.environ.get('RATELIMIT_BACKEND', 'mmap')
+app.config['RATELIMIT_STORAGE'] = os.environ.get('RATELIMIT_STORAGE')
+# Count queries and DB time per request, sent back as a Server-Timing header;
+# statements slower than SLOW_QUERY_MS are logged (see instrumentation.py).
+app.config['SQL_INSTRUMENTATION'] = os.environ.get('SQL_INSTRUMENTATION', '0') != '0'
+app.config['SLOW_QUERY_MS'] = int(os.environ.get('SLOW_QUERY_MS', 200))
+app.config['SLOW_QUERY_EXPLAIN'] = os.environ.get('SLOW_QUERY_EXPLAIN', '0') != '0'
+# Live updates on /events (see events.py). EVENTS_FANOUT is "postgres",
+# "socket", "local" or "module:Class"; unset picks postgres on Postgres.
+app.config['EVENTS_ENABLED'] = os.environ.get('EVENTS_ENABLED', '1') != '0'
+app.config['EVENTS_FANOUT'] = os.environ.get('EVENTS_FANOUT')
+app.config['EVENTS_SOCKET_DIR'] = os.environ.get('EVENTS_SOCKET_DIR')
+app.config['EVENTS_KEEPALIVE'] = int(os.environ.get('EVENTS_KEEPALIVE', 15))
+app.config['EVENTS_MAX_AGE'] = int(os.environ.get('EVENTS_MAX_AGE', 300))
+# Bearer token required to read /metrics; unset leaves it open (see metrics.py).
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+# Number of proxies in front of the app whose X-Forwarded-For is trusted, so
+# per-IP limits see the client's address. The Procfile sets 1 for the Heroku
+# router; left at 0 behind a proxy, every client shares the proxy's bucket.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
 # toolbar = DebugToolbarExtension(app)
 
+if app.config['TRUSTED_PROXIES']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'])
+
 connect_db(app)
+init_password_hashing(app)
+init_metrics(app)
+init_instrumentation(app)
+# must come before add_user_to_g so limited requests never touch the database
+init_rate_limiting(app, session_key=CURR_USER_KEY)
 
 
 ##############################################################################
@@ -30,13 +98,29 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
+    Endpoints in IDENTITY_ONLY_ENDPOINTS get a cached read-only CurrentUser
+    instead of a User loaded from the database.
+    """
+
+    if CURR_USER_KEY not in session:
+        g.user = None
+    elif request.endpoint in IDENTITY_ONLY_ENDPOINTS:
+        g.user = get_current_user(session[CURR_USER_KEY])
+    else:
         g.user = User.query.get(session[CURR_USER_KEY])
         g.msg_form = MessageForm()
-    else:
-        g.user = None
+
+
+@app.context_processor
+def add_unread_counts():
+    """Give base.html the navbar badge counts for the logged-in user."""
+
+    if not g.get('user'):
+        return {}
+    pending_notifications, unread_dms = unread_counts(g.user.id)
+    return {'pending_notifications': pending_notifications, 'unread_dms': unread_dms}
 
 
 def do_login(user):
@@ -100,6 +184,8 @@ def login():
         user = User.authenticate(form.username.data, form.password.data)
 
         if user:
+            # saves a rehashed password if the work factor went up
+            db.session.commit()
             do_login(user)
             if user.following == []:
                 flash(f"Welcome back, {user.username}. Follow some users below!", "success")
@@ -128,17 +214,29 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, location
+    or bio, and a 'page' param for the page of results.
     """
 
     search = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
 
     if not search:
-        users = User.query.all()
+        users, has_next = list_all_users(page)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_next = search_users(search, page)
+
+    return render_template('users/index.html', users=users, page=page, has_next=has_next, search=search)
+
 
-    return render_template('users/index.html', users=users)
+@app.route('/users/suggest')
+def suggest_users():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    prefix = request.args.get('q', '').strip()
+    if not prefix:
+        return jsonify(users=[])
+    return jsonify(users=suggest_usernames(prefix))
 
 
 @app.route('/users/<int:user_id>')
@@ -149,10 +247,9 @@ def users_show(user_id):
     blocked = g.user.check_for_blocked(user)
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
+    messages = (timeline_query()
                 .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
+                .order_by(Message.id.desc())
                 .limit(100)
                 .all())
     return render_template('users/show.html', user=user, messages=messages, blocked=blocked)
@@ -192,6 +289,7 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    backfill_follow(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -220,6 +318,7 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    prune_author(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -282,6 +381,7 @@ def delete_user():
 
     do_logout()
 
+    remove_user(g.user.id)
     db.session.delete(g.user)
     db.session.commit()
 
@@ -296,6 +396,7 @@ def delete_selected_user(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    remove_user(user.id)
     db.session.delete(user)
     db.session.commit()
     flash('User deleted successfully!', 'success')
@@ -358,8 +459,23 @@ def show_notification_page(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    notifications = Notification.query.filter_by(to_id=user_id)
-    return render_template('/users/notifications.html', notifications=notifications)
+    notifications = Notification.query.filter_by(to_id=user_id).order_by(Notification.id).all()
+    # "Clear all" only clears what's on the page, not anything sent since
+    up_to = notifications[-1].id if notifications else None
+    return render_template('/users/notifications.html', notifications=notifications, up_to=up_to)
+
+@app.route('/users/notifications/clear', methods=["POST"])
+def clear_all_notifications():
+    """Clears the user's notifications, up to `up_to` if sent"""
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    cleared = clear_notifications(g.user.id, up_to=bulk_up_to())
+    invalidate_on_commit(g.user.id)
+    publish(g.user.id, 'read')
+    db.session.commit()
+    return bulk_response(f'{cleared} notifications cleared', f'/users/{g.user.id}/notifications',
+                         cleared=cleared)
 
 @app.route('/users/accept-follow/<int:from_id>/<int:notification_id>', methods=["POST"])
 def accept_follow(from_id, notification_id):
@@ -370,6 +486,7 @@ def accept_follow(from_id, notification_id):
     from_user = User.query.get_or_404(from_id)
     n = Notification.query.get_or_404(notification_id)
     g.user.accept_follow_req(from_user, n)
+    backfill_follow(from_user.id, g.user.id)
     db.session.delete(n)
     db.session.commit()
     flash(f'Accepted follow request from {from_user.username}', 'success')
@@ -381,6 +498,7 @@ def reject_follow(from_id, notification_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     n = Notification.query.get_or_404(notification_id)
+    from_user = n.from_user
     g.user.notifications.remove(n)
     db.session.delete(n)
     db.session.commit()
@@ -409,6 +527,7 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        fan_out_message(msg)
         db.session.commit()
         flash('Message posted successfully!', 'success')
         return redirect('/')
@@ -416,7 +535,25 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@app.route('/messages/search')
+def messages_search():
+    """Search warbles by text.
+
+    Takes a 'q' param, best matches first, continued with ?before=<cursor>.
+    """
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    search = request.args.get('q', '').strip()
+    messages, next_cursor = [], None
+    if search:
+        messages, next_cursor = search_messages(g.user, search, before=request.args.get('before'))
+
+    return render_template('messages/search.html', messages=messages, next_cursor=next_cursor, search=search)
+
+
+@app.route('/messages/<int(signed=True):message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
@@ -424,7 +561,7 @@ def messages_show(message_id):
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["GET","POST"])
+@app.route('/messages/<int(signed=True):message_id>/delete', methods=["GET","POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -433,45 +570,108 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
     flash('Message deleted successfully', 'success')
     return redirect(f"/users/{g.user.id}")
 @app.route('/messages/all')
 def messages_show_all():
-    """page to view all messages - even users who aren't followed"""
+    """page to view all messages - even users who aren't followed
+
+    Pages of 100, continued with ?before=<cursor>.
+    """
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    shown_msgs = (Message.query.order_by(Message.timestamp.desc()).limit(100).all())
-    msg = [message for message in shown_msgs if g.user.check_for_blocked(message.user) == False]
-    
-    return render_template('home.html', messages=msg)
+    messages, next_cursor = paginate_timeline(g.user.global_timeline(),
+                                              before=request.args.get('before'))
+
+    return render_template('home.html', messages=messages, next_cursor=next_cursor, timeline='global')
+
+
+@app.route('/timelines/<name>')
+def timeline_updates(name):
+    """JSON: the home or global timeline's messages newer than ?since=<cursor>,
+    oldest first, each with its card's HTML.
+
+    The timeline's watermark (its newest message id) is checked first, with
+    only the logged-in user's cached snapshot, so when nothing is newer the
+    answer is an empty list, or a 304 for a matching If-None-Match.
+    """
+    if not g.user:
+        return jsonify(error="Not logged in"), 401
+    if name not in ('home', 'global'):
+        return jsonify(error="No such timeline"), 404
+    since = decode_cursor(request.args.get('since'))
+    if since is None:
+        return jsonify(error="since must be a message cursor"), 400
+
+    watermark = home_watermark(g.user.id) if name == 'home' else latest_message_id()
+    if watermark <= since:
+        messages, more = [], False
+    else:
+        # the cards need the full user (likes, admin tools)
+        g.user = User.query.get(g.user.id)
+        if name == 'home':
+            messages, more = read_home_since(g.user, since)
+        else:
+            messages, more = paginate_newer(g.user.global_timeline(), since)
+    # past the watermark once caught up, so messages hidden from this user
+    # aren't looked at again
+    latest = messages[-1].id if more else max(watermark, since, *(msg.id for msg in messages))
+
+    # snowflake ids don't fit in a JavaScript number, so send them as strings
+    resp = jsonify(messages=[{'id': str(msg.id), 'user_id': msg.user_id, 'username': msg.user.username,
+                              'text': msg.text, 'timestamp': msg.timestamp.isoformat(),
+                              'html': render_template('messages/card.html', msg=msg)}
+                             for msg in messages],
+                   more=more, latest=str(latest))
+    # cards differ per user (likes, blocks, admin tools), so the tag does too
+    resp.set_etag(f'{g.user.id}-{name}-{since}-{watermark}')
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    return resp.make_conditional(request)
 
 
 ##############################################################################
 # Like routes
 
-@app.route('/users/add_like/<int:msg_id>', methods=["POST"])
+@app.route('/messages/<int(signed=True):msg_id>/like', methods=["POST"])
+@app.route('/users/add_like/<int(signed=True):msg_id>', methods=["POST"])
 def like_post(msg_id):
-    """Route for liking a post"""
-    msg = Message.query.get(msg_id)
-    if msg in g.user.likes:
-        g.user.likes.remove(msg)
-        
-        db.session.commit()
-        return ("",201)
-    else:
-        g.user.likes.append(msg)
-        db.session.commit()
-        return ("",201)
+    """Like or unlike a message; responds with the new state as JSON.
+
+    Send liked=true or liked=false (form field or JSON) to set the state,
+    which is safe to repeat; without it the like is toggled.
+    """
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    data = request.get_json(silent=True) or request.form
+    wanted = data.get('liked')
+    if isinstance(wanted, str):
+        wanted = {'true': True, 'false': False}.get(wanted.lower())
+    elif not isinstance(wanted, bool):
+        wanted = None
+    result = toggle_like(g.user.id, msg_id, wanted)
+    if result is None:
+        # a JSON 404, not the error handler's redirect home
+        return jsonify(message_id=str(msg_id), error="No such message"), 404
+    liked, likes, author_id = result
+    # snowflake ids don't fit in a JavaScript number, so send them as strings
+    publish(author_id, 'like', {'message_id': str(msg_id), 'likes': likes})
+    db.session.commit()
+    return jsonify(message_id=str(msg_id), liked=liked, likes=likes)
 
 
 @app.route('/users/<int:user_id>/likes')
 def show_liked_posts(user_id):
     """Shows page with lists of liked posts"""
-    user = User.query.get(user_id)
-    user_likes = user.likes    
+    user_likes = (timeline_query()
+                  .join(Likes, Likes.message_id == Message.id)
+                  .filter(Likes.user_id == user_id)
+                  .order_by(Likes.id.desc())
+                  .all())
     return (render_template(f'/users/likes.html', messages=user_likes))
 ##############################################################################
 # Homepage and error pages
@@ -487,12 +687,16 @@ def block_this_user(user_id):
     if g.user.check_for_blocked(user):
         block = Block.query.filter_by(user=g.user.id, blocked_user=user.id).first()
         db.session.delete(block)
+        db.session.flush()
+        if g.user.is_following(user):
+            backfill_follow(g.user.id, user.id)
         db.session.commit()
         flash('User unblocked!', 'danger')
         return redirect(f'/users/{user_id}')    
     else:
         new_block = Block(user=g.user.id, blocked_user=user.id)
         db.session.add(new_block)
+        prune_author(g.user.id, user.id)
         db.session.commit()
         flash('User blocked!', 'danger')
         return redirect(f'/users/{user_id}')
@@ -505,17 +709,45 @@ def show_blocked_users():
     block_list = g.user.get_blocked_users()
     return render_template("users/blockedusers.html", blocked_users = block_list)
 
+##############################################################################
+# Live updates
+
+@app.route('/events')
+def events_stream():
+    """Server-Sent Events: new notifications, DMs and likes as they happen"""
+    if not g.user:
+        # a 204 tells EventSource to stop reconnecting
+        return '', 204
+    return event_stream(g.user.id)
+
+
 ##############################################################################
 # Direct Messages routes:
 
 @app.route('/messages/direct-messages')
 def show_direct_messages():
-    """shows direct messages"""
+    """shows the inbox: a page of conversations, most recent first"""
+    if not g.user:
+        flash("Access unauthorized.","danger")
+        return redirect('/')
+    conversations, next_cursor = read_inbox(g.user.id, before=request.args.get('before'))
+    return render_template('users/directmessages.html', conversations=conversations, next_cursor=next_cursor)
+
+@app.route('/messages/conversations/<int:conversation_id>')
+def show_conversation(conversation_id):
+    """shows a page of one conversation's DMs, newest first"""
     if not g.user:
         flash("Access unauthorized.","danger")
         return redirect('/')
-    # dms = g.user.get_direct_messages()
-    return render_template('users/directmessages.html')
+    conversation = Conversation.query.get_or_404(conversation_id)
+    if g.user.id not in (conversation.user_low_id, conversation.user_high_id):
+        flash("Access unauthorized.","danger")
+        return redirect('/')
+    dms, next_cursor = read_thread(conversation, before=request.args.get('before'))
+    other_user = User.query.get(conversation.other_user_id(g.user.id))
+    return render_template('messages/conversation.html', conversation=conversation, dms=dms,
+                           next_cursor=next_cursor, other_user=other_user, reply_to=other_user,
+                           form=DirectMessageForm())
 
 @app.route('/messages/<int:dm_id>/markread', methods=["POST"])
 def mark_dm_read(dm_id):
@@ -524,10 +756,66 @@ def mark_dm_read(dm_id):
         flash("Access unauthorized.","danger")
         return redirect('/')
     dm = DirectMessage.query.get_or_404(dm_id)
+    if dm.dm_to != g.user.id:
+        flash("Access unauthorized.","danger")
+        return redirect('/')
+    if dm.is_new:
+        note_read(dm)
     dm.is_new = False
     db.session.commit()
     flash('Message marked as read', 'success')
+    if dm.conversation_id:
+        return redirect(f'/messages/conversations/{dm.conversation_id}')
     return redirect('/messages/direct-messages')
+
+def bulk_up_to():
+    """The `up_to` id sent with a bulk read or clear (JSON or form), if any."""
+    data = request.get_json(silent=True) or request.form
+    try:
+        return int(data['up_to'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def bulk_response(message, redirect_to, **result):
+    """Scripts get the result and fresh badge counts as JSON; plain form
+    posts get a flash and a redirect."""
+    if not request.is_json:
+        flash(message, 'success')
+        return redirect(redirect_to)
+    pending_notifications, unread_dms = unread_counts(g.user.id)
+    return jsonify(pending_notifications=pending_notifications, unread_dms=unread_dms, **result)
+
+@app.route('/messages/direct-messages/read', methods=["POST"])
+def mark_all_dms_read():
+    """Marks every unread DM to the user read (up to `up_to`, if sent)"""
+    if not g.user:
+        flash("Access unauthorized.","danger")
+        return redirect('/')
+    marked = mark_read(g.user.id, up_to=bulk_up_to())
+    invalidate_on_commit(g.user.id)
+    publish(g.user.id, 'read')
+    db.session.commit()
+    return bulk_response(f'{marked} messages marked as read', '/messages/direct-messages', marked=marked)
+
+@app.route('/messages/conversations/<int:conversation_id>/read', methods=["POST"])
+def mark_conversation_read(conversation_id):
+    """Marks a conversation's unread DMs to the user read, up to `up_to` if sent"""
+    if not g.user:
+        flash("Access unauthorized.","danger")
+        return redirect('/')
+    conversation = Conversation.query.get(conversation_id)
+    if conversation is None or g.user.id not in (conversation.user_low_id, conversation.user_high_id):
+        if request.is_json:
+            return jsonify(conversation_id=conversation_id, error="No such conversation"), 404
+        flash("Access unauthorized.","danger")
+        return redirect('/')
+    marked = mark_read(g.user.id, conversation_id, up_to=bulk_up_to())
+    invalidate_on_commit(g.user.id)
+    publish(g.user.id, 'read')
+    db.session.commit()
+    return bulk_response(f'{marked} messages marked as read', f'/messages/conversations/{conversation_id}',
+                         conversation_id=conversation_id, marked=marked,
+                         unread=conversation.unread_for(g.user.id))
 @app.route('/messages/<int:dm_to_id>/reply', methods=["POST","GET"])
 def reply_to_dm(dm_to_id):
     """GET: show reply form - POST: send reply"""
@@ -538,13 +826,11 @@ def reply_to_dm(dm_to_id):
     form = DirectMessageForm()
     to_user = User.query.get_or_404(dm_to_id)
     if form.validate_on_submit():
-        text = form.message_text.data
-        new_dm = DirectMessage(dm_to=dm_to_id, dm_from=g.user.id, message_text=text)
-        db.session.add(new_dm)
+        new_dm = send_dm(g.user.id, to_user.id, form.message_text.data)
         db.session.commit()
-        
+
         flash(f"Message to {to_user.username} sent!", 'success')
-        return redirect('/messages/direct-messages')
+        return redirect(f'/messages/conversations/{new_dm.conversation_id}')
     else:
         return render_template('messages/dmnew.html', form=form, reply_to=to_user)
 @app.route('/messages/<int:user_to>/send', methods=["GET","POST"])
@@ -556,43 +842,85 @@ def send_message_to_user(user_to):
     to_user = User.query.get_or_404(user_to)    
     form = DirectMessageForm()
     if form.validate_on_submit():
-        text = form.message_text.data
-        new_dm = DirectMessage(dm_to=user_to.id, dm_from=g.user.id, message_text=text)
-        db.session.add(new_dm)
+        send_dm(g.user.id, to_user.id, form.message_text.data)
         db.session.commit()
         flash(f"Message to {to_user.username} sent!", 'success')
-        return redirect(f'/users/{user_to.id}')
+        return redirect(f'/users/{to_user.id}')
     else: 
         return render_template('messages/dmnew.html', form=form, reply_to=to_user)
 
+@app.route('/admin/sql-stats')
+def sql_stats():
+    """ADMIN ONLY: per-endpoint query counts and timings for this process."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return jsonify(endpoint_stats())
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, paged
+      with ?before=<cursor>
     """
-    ## NOTE - I do not think this is the correct way to handle this request. But it is functionable!
     if g.user:
-        all_messages = (Message.query.order_by(Message.timestamp.desc()).all())
-        messages = [msg for msg in all_messages if g.user in msg.user.followers or msg.user == g.user and not g.user.check_for_blocked(msg.user)]
-        messages = messages[:100]
-    #    messages = g.user.get_messages()
-        return render_template('home.html', messages=messages)
+        messages, next_cursor = read_home_timeline(g.user, before=request.args.get('before'))
+        return render_template('home.html', messages=messages, next_cursor=next_cursor, timeline='home')
     else:
         return render_template('home-anon.html')
 @app.errorhandler(404)
-def not_found_err():
+def not_found_err(e):
     """displays when 404'd"""
     flash("404 - Page not found!", "danger")
     return redirect("/")
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(e):
+    """Turn away logins/signups when every bcrypt worker is busy."""
+    return ("Too many sign-ins right now - please try again in a moment.", 503, {'Retry-After': '2'})
+@app.errorhandler(RateLimitExceeded)
+def rate_limited(e):
+    """Too many requests from this client; tell it when to come back."""
+    return ("Slow down! Please try again in a moment.", 429, {'Retry-After': str(max(1, round(e.retry_after)))})
 @app.errorhandler(500)
-def unexpected_request():
+def unexpected_request(e):
     """displays when 500'd"""
     flash("404 - Page not found!", "danger")
     return redirect("/")
 
 
+##############################################################################
+# CLI commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild every user's materialized home timeline."""
+
+    rebuilt = rebuild_all_timelines()
+    print(f"Rebuilt {rebuilt} timelines.")
+
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations_command():
+    """Rebuild every DM conversation and its inbox summary from the DMs."""
+
+    rebuilt = rebuild_conversations()
+    print(f"Rebuilt {rebuilt} conversations.")
+
+
+@app.cli.command('recount-counters')
+def recount_counters_command():
+    """Recompute every user's message/follower/following/likes counts."""
+
+    recounted = recount_counters()
+    print(f"Recounted {recounted} users.")
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -602,8 +930,11 @@ def unexpected_request():
 
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request, except where the view set
+    its own Cache-Control (timeline polls, the event stream)."""
 
+    if 'Cache-Control' in req.headers:
+        return req
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
     req.headers["Expires"] = "0"
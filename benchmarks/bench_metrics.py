@@ -0,0 +1,82 @@
+"""Measure what recording a metric costs on the request path.
+
+    python benchmarks/bench_metrics.py [--iterations 200000] [--budget-us 10]
+
+Times the per-request work metrics.py does (one latency observation, one
+status count, one cache lookup count) with values in memory and with the
+multiprocess mmap store gunicorn uses, each in a fresh interpreter since
+prometheus_client picks its store at import. Exits non-zero if any of them
+averages more than --budget-us microseconds.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = ['request_latency', 'request_count', 'cache_lookup']
+
+
+def measure(iterations):
+    """Run in the child: print "case microseconds" for each case."""
+    sys.path.insert(0, ROOT)
+    from metrics import REQUEST_LATENCY, REQUESTS, _child, record_cache
+
+    def request_latency():
+        _child(REQUEST_LATENCY, 'homepage', 'GET').observe(0.0123)
+
+    def request_count():
+        _child(REQUESTS, 'homepage', '200').inc()
+
+    def cache_lookup():
+        record_cache('unread', True)
+
+    for name in CASES:
+        case = locals()[name]
+        case()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            case()
+        print(name, (time.perf_counter() - started) / iterations * 1e6)
+
+
+def run(label, iterations, env):
+    output = subprocess.run([sys.executable, __file__, '--child', '--iterations', str(iterations)],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    results = {}
+    for line in output.splitlines():
+        name, micros = line.split()
+        results[name] = float(micros)
+        print(f"{label:<13} {name:<16} {float(micros):7.2f} us/op")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--iterations', type=int, default=200_000)
+    parser.add_argument('--budget-us', type=float, default=10.0)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.iterations)
+        return
+
+    env = {k: v for k, v in os.environ.items() if k != 'PROMETHEUS_MULTIPROC_DIR'}
+    results = run('in-memory', args.iterations, env)
+    with tempfile.TemporaryDirectory() as metrics_dir:
+        results.update({f"multiprocess {name}": micros for name, micros in
+                        run('multiprocess', args.iterations, dict(env, PROMETHEUS_MULTIPROC_DIR=metrics_dir)).items()})
+
+    over = {name: micros for name, micros in results.items() if micros > args.budget_us}
+    if over:
+        sys.exit(f"over the {args.budget_us}us budget: {', '.join(over)}")
+    print(f"all within {args.budget_us}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Measure bcrypt throughput inline vs. through the passwords worker pool.
+
+    python benchmarks/bench_passwords.py --rounds 12 --hashes 64
+
+Prints hashes per second overall and per core, so BCRYPT_LOG_ROUNDS and
+PASSWORD_HASH_WORKERS can be picked for the machine the app runs on.
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import passwords  # noqa: E402
+
+
+def run(label, hashes, concurrency, cores):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        list(threads.map(lambda i: passwords.hash_password(f'password{i}'), range(hashes)))
+    elapsed = time.perf_counter() - start
+    rate = hashes / elapsed
+    print(f"{label:<10} {hashes:>5} hashes in {elapsed:7.2f}s  "
+          f"{rate:8.1f}/s  {rate / cores:8.1f}/s per core")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=passwords.DEFAULT_ROUNDS)
+    parser.add_argument('--hashes', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    passwords.settings.update(rounds=args.rounds, workers=0)
+    run('inline', args.hashes, 1, 1)
+
+    passwords.settings.update(workers=args.workers, queue=args.hashes, timeout=None)
+    run('pool', args.hashes, args.workers * 2, args.workers)
+
+
+if __name__ == '__main__':
+    main()
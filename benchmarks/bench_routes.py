@@ -0,0 +1,188 @@
+"""Time Warbler's main pages against generated datasets of several sizes.
+
+    python benchmarks/bench_routes.py --sizes 1k,100k,1m
+    python benchmarks/bench_routes.py --sizes 1k --database sqlite:////tmp/bench.db
+    python benchmarks/bench_routes.py --update-baseline
+
+For each size (in messages) a dataset is generated with generator/generate.py,
+loaded with loader.py into the --database given (default
+BENCH_DATABASE_URL, else postgresql:///warbler-bench; it is wiped), and each
+endpoint is requested --requests times through the Flask test client as
+the most-following user. p50/p95 latency and the SQL statement count are
+reported per endpoint; statement counts come from the Server-Timing header
+that instrumentation.py adds.
+
+The run fails if an endpoint issues more statements than its QUERY_BUDGETS
+entry, or if its p95 is more than --tolerance times the one stored in the
+baseline file for that size and database. --update-baseline rewrites the
+baseline from this run instead.
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'generator')]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routes_baseline.json')
+
+SIZES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+
+# The most SQL statements each page may issue, whatever the data size.
+QUERY_BUDGETS = {
+    '/': 8,
+    '/messages/all': 6,
+    '/users': 5,
+    '/users/<id>': 8,
+    '/users/<id>/likes': 8,
+    '/messages/direct-messages': 6,
+    '/users/<id>/notifications': 6,
+}
+
+QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+
+
+def dataset_shape(messages):
+    """Generator arguments for a dataset of `messages` messages."""
+    users = max(messages // 100, 100)
+    return ['--messages', str(messages), '--users', str(users), '--follows', str(users * 30),
+            '--likes', str(messages * 2), '--blocks', str(users // 50), '--dms', str(users * 5),
+            '--notifications', str(users // 5), '--private', '0.05']
+
+
+def build_dataset(messages, seed):
+    """Generate and load a dataset, then derive timelines, counters and
+    conversations as seed.py does."""
+    import generate
+    from conversations import rebuild_conversations
+    from loader import load_csvs
+    from models import recount_counters
+    from timelines import rebuild_all_timelines
+
+    with tempfile.TemporaryDirectory() as out:
+        generate.main(dataset_shape(messages) + ['--seed', str(seed), '--out', out])
+        load_csvs(out)
+    rebuild_all_timelines()
+    recount_counters()
+    rebuild_conversations()
+
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def time_routes(app, requests):
+    """{endpoint: {'p50', 'p95' (ms), 'queries'}} as the most-following user."""
+    from app import CURR_USER_KEY
+    from models import User
+
+    with app.app_context():
+        viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+        popular = User.query.order_by(User.follower_count.desc(), User.id).first()
+        viewer_id, popular_id = viewer.id, popular.id
+        # someone with DMs waiting, so the inbox isn't empty
+        viewer_dms = len(viewer.dms)
+
+    paths = {
+        '/': '/',
+        '/messages/all': '/messages/all',
+        '/users': '/users',
+        '/users/<id>': f'/users/{popular_id}',
+        '/users/<id>/likes': f'/users/{viewer_id}/likes',
+        '/messages/direct-messages': '/messages/direct-messages',
+        '/users/<id>/notifications': f'/users/{viewer_id}/notifications',
+    }
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = viewer_id
+
+    results = {}
+    for name, path in paths.items():
+        client.get(path)  # warm caches and connections
+        samples, queries = [], 0
+        for _ in range(requests):
+            started = time.perf_counter()
+            resp = client.get(path)
+            samples.append((time.perf_counter() - started) * 1000)
+            if resp.status_code != 200:
+                raise SystemExit(f"{path} returned {resp.status_code}")
+            match = QUERIES_RE.search(resp.headers.get('Server-Timing', ''))
+            queries = max(queries, int(match.group(1)) if match else 0)
+        results[name] = {'p50': statistics.median(samples), 'p95': percentile(samples, 0.95),
+                         'queries': queries}
+    print(f"  viewer #{viewer_id} ({viewer_dms} DMs), profile #{popular_id}")
+    return results
+
+
+def check(size, results, baseline, tolerance):
+    """Print a table for one size and return the list of failures."""
+    failures = []
+    print(f"  {'endpoint':<28} {'p50 ms':>9} {'p95 ms':>9} {'base p95':>9} {'queries':>8} {'budget':>7}")
+    for name, result in results.items():
+        budget = QUERY_BUDGETS[name]
+        base = baseline.get(name, {}).get('p95')
+        print(f"  {name:<28} {result['p50']:9.1f} {result['p95']:9.1f} "
+              f"{base if base is not None else '-':>9} {result['queries']:>8} {budget:>7}")
+        if result['queries'] > budget:
+            failures.append(f"{size} {name}: {result['queries']} queries, budget is {budget}")
+        if base is not None and result['p95'] > base * tolerance:
+            failures.append(f"{size} {name}: p95 {result['p95']:.1f}ms vs baseline {base:.1f}ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1k,100k', help=f"comma-separated, from {', '.join(SIZES)}")
+    parser.add_argument('--database', default=os.environ.get('BENCH_DATABASE_URL', 'postgresql:///warbler-bench'))
+    parser.add_argument('--requests', type=int, default=20, help="timed requests per endpoint")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=1.5, help="allowed p95 / baseline p95")
+    parser.add_argument('--reuse', action='store_true', help="time the data already in --database")
+    args = parser.parse_args()
+
+    if args.database.startswith('postgres'):
+        os.environ['DATABASE_URL'] = args.database
+    from app import app
+    app.config.update(SQLALCHEMY_DATABASE_URI=args.database, SQL_INSTRUMENTATION=True,
+                      RATELIMIT_ENABLED=False, SLOW_QUERY_MS=10 ** 9)
+
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    dialect = args.database.split(':')[0]
+
+    failures = []
+    for size in args.sizes.split(','):
+        print(f"== {size} messages ({dialect})")
+        with app.app_context():
+            if not args.reuse:
+                build_dataset(SIZES[size], args.seed)
+        results = time_routes(app, args.requests)
+        key = f"{dialect}:{size}"
+        failures += check(size, results, baselines.get(key, {}), args.tolerance)
+        if args.update_baseline:
+            baselines[key] = results
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"baseline written to {args.baseline}")
+    elif failures:
+        sys.exit('\n'.join(['FAILED:'] + failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+"""Replay a realistic traffic mix against a running Warbler and report latency.
+
+Start the app against a seeded local database (SQLite or Postgres), with
+rate limiting off so the load isn't throttled:
+
+    RATELIMIT_ENABLED=0 gunicorn app:app
+    python benchmarks/loadgen.py --url http://127.0.0.1:8000 --concurrency 50 --duration 60
+
+Each virtual user logs in through /login with an account from --users-csv
+(password --password; seeded accounts use "password") and keeps its session
+cookie and a keep-alive connection. It then loops over actions picked from
+the traffic mix: timeline reads, profiles, like toggles, posts, follows,
+DMs and the occasional fresh login. Likes go to messages the user has seen.
+
+With --log, requests are replayed from a JSONL file instead. Each line looks
+like {"method": "POST", "path": "/messages/new", "data": {"text": "hi"},
+"user": "alice"}. Requests with the same "user" share a session; lines
+without a user are dealt round-robin. Form posts get the session's CSRF
+token added. Lines without a path are skipped and counted.
+
+The report gives requests per second plus p50/p95/p99 latency and error
+rate for each endpoint. Responses of 400 and up count as errors; 429s are
+also shown on their own. Only the standard library is used (asyncio streams
+speaking HTTP/1.1).
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# action: relative weight
+DEFAULT_MIX = {
+    'home': 40,
+    'all_messages': 8,
+    'profile': 12,
+    'users': 5,
+    'like': 15,
+    'post': 6,
+    'follow': 4,
+    'dm': 4,
+    'notifications': 3,
+    'login': 3,
+}
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+MESSAGE_ID_RE = re.compile(r'href="/messages/(-?\d+)"')
+ID_RE = re.compile(r'/-?\d+(?=/|$)')
+# seconds a virtual user waits before logging in again after a failure
+LOGIN_RETRY_DELAY = 1.0
+
+
+class HTTPClient:
+    """One keep-alive HTTP/1.1 connection with a cookie jar."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+        self.cookies = {}
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, form=None):
+        """Send one request; return (status, body). Redirects aren't followed."""
+        body = urlencode(form).encode() if form is not None else b''
+        headers = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                   "Connection: keep-alive", f"Content-Length: {len(body)}"]
+        if form is not None:
+            headers.append("Content-Type: application/x-www-form-urlencoded")
+        if self.cookies:
+            headers.append("Cookie: " + '; '.join(f"{k}={v}" for k, v in self.cookies.items()))
+        payload = ('\r\n'.join(headers) + '\r\n\r\n').encode() + body
+
+        for attempt in range(2):
+            reused = self.writer is not None
+            if not reused:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                self.writer.write(payload)
+                await self.writer.drain()
+                return await self._read_response()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await self.close()
+                # the server may have dropped an idle keep-alive connection
+                if not reused or attempt:
+                    raise
+
+    async def _read_response(self):
+        status_line = await self.reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        length, chunked, close = None, False, False
+        while True:
+            line = (await self.reader.readuntil(b'\r\n')).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'transfer-encoding' and 'chunked' in value.lower():
+                chunked = True
+            elif name == 'connection' and value.lower() == 'close':
+                close = True
+            elif name == 'set-cookie':
+                cookie, _, attributes = value.partition(';')
+                key, _, val = cookie.partition('=')
+                if 'expires=thu, 01 jan 1970' in attributes.lower():
+                    self.cookies.pop(key.strip(), None)
+                else:
+                    self.cookies[key.strip()] = val.strip()
+
+        if chunked:
+            body = b''
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                body += await self.reader.readexactly(size + 2)
+                if not size:
+                    break
+        elif length is not None:
+            body = await self.reader.readexactly(length)
+        else:
+            body = await self.reader.read()
+            close = True
+        if close:
+            await self.close()
+        return status, body.decode('utf-8', 'replace')
+
+
+class Stats:
+    """Latencies and outcomes per endpoint label."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.limited = defaultdict(int)
+        self.skipped = 0
+
+    def record(self, label, seconds, status):
+        self.latencies[label].append(seconds)
+        if status is None or status >= 400:
+            self.errors[label] += 1
+        if status == 429:
+            self.limited[label] += 1
+
+    def report(self, elapsed):
+        total = sum(len(samples) for samples in self.latencies.values())
+        errors = sum(self.errors.values())
+        print(f"{total:,} requests in {elapsed:.1f}s: {total / elapsed:,.1f} req/s, "
+              f"{errors:,} errors ({errors / max(total, 1):.1%})")
+        if self.skipped:
+            print(f"{self.skipped:,} log lines skipped (no path)")
+        print(f"{'endpoint':<32} {'count':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+              f"{'p99 ms':>8} {'errors':>7} {'429s':>5}")
+        for label in sorted(self.latencies, key=lambda label: -len(self.latencies[label])):
+            samples = sorted(self.latencies[label])
+            pct = lambda share: samples[min(len(samples) - 1, int(share * len(samples)))] * 1000
+            print(f"{label:<32} {len(samples):>7,} {len(samples) / elapsed:>8.1f} {pct(0.5):>8.1f} "
+                  f"{pct(0.95):>8.1f} {pct(0.99):>8.1f} {self.errors[label] / len(samples):>7.1%} "
+                  f"{self.limited[label]:>5}")
+
+
+class VirtualUser:
+    """A logged-in browser session."""
+
+    def __init__(self, url, user_id, username, password, stats, population):
+        parts = urlsplit(url)
+        self.client = HTTPClient(parts.hostname, parts.port or 80)
+        self.user_id = user_id
+        self.username = username
+        self.password = password
+        self.stats = stats
+        self.population = population
+        self.csrf = None
+        self.seen_messages = []
+        self.logged_in = False
+
+    async def call(self, label, method, path, form=None):
+        started = time.perf_counter()
+        try:
+            status, body = await self.client.request(method, path, form)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            self.stats.record(label, time.perf_counter() - started, None)
+            return None, ''
+        self.stats.record(label, time.perf_counter() - started, status)
+        token = CSRF_RE.search(body)
+        if token:
+            self.csrf = token.group(1)
+        if method == 'GET':
+            seen = MESSAGE_ID_RE.findall(body)
+            if seen:
+                self.seen_messages = seen[:50]
+        return status, body
+
+    async def login(self):
+        self.client.cookies.clear()
+        await self.call('GET /login', 'GET', '/login')
+        status, _ = await self.call('POST /login', 'POST', '/login', {
+            'username': self.username, 'password': self.password, 'csrf_token': self.csrf or ''})
+        # a successful login redirects; a failed one re-renders the form
+        self.logged_in = status == 302
+        return self.logged_in
+
+    async def act(self, action):
+        other = random.choice(self.population)[0]
+        if action == 'home':
+            await self.call('GET /', 'GET', '/')
+        elif action == 'all_messages':
+            await self.call('GET /messages/all', 'GET', '/messages/all')
+        elif action == 'profile':
+            await self.call('GET /users/<id>', 'GET', f'/users/{other}')
+        elif action == 'users':
+            await self.call('GET /users', 'GET', '/users')
+        elif action == 'like':
+            if not self.seen_messages:
+                await self.call('GET /', 'GET', '/')
+            if self.seen_messages:
+                message_id = random.choice(self.seen_messages)
+                await self.call('POST /users/add_like/<id>', 'POST', f'/users/add_like/{message_id}', {})
+        elif action == 'post':
+            await self.call('GET /messages/new', 'GET', '/messages/new')
+            await self.call('POST /messages/new', 'POST', '/messages/new', {
+                'text': f"load test warble {random.randrange(10 ** 9)}", 'csrf_token': self.csrf or ''})
+        elif action == 'follow':
+            await self.call('POST /users/follow/<id>', 'POST', f'/users/follow/{other}', {})
+        elif action == 'dm':
+            await self.call('GET /messages/<id>/send', 'GET', f'/messages/{other}/send')
+            await self.call('POST /messages/<id>/send', 'POST', f'/messages/{other}/send', {
+                'message_text': "hello from the load test", 'csrf_token': self.csrf or ''})
+        elif action == 'notifications':
+            await self.call('GET /users/<id>/notifications', 'GET', f'/users/{self.user_id}/notifications')
+        elif action == 'login':
+            await self.login()
+
+    async def replay(self, entry):
+        form = entry.get('data')
+        if form is not None and entry.get('method', 'GET').upper() != 'GET':
+            form = dict(form)
+            form.setdefault('csrf_token', self.csrf or '')
+        method = entry.get('method', 'GET').upper()
+        path = entry['path']
+        await self.call(f"{method} {ID_RE.sub('/<id>', path.split('?')[0])}", method, path, form)
+
+
+def read_population(path):
+    """[(id, username)] from a users CSV; ids default to row order, as loader.py assigns them."""
+    with open(path, newline='') as f:
+        return [(int(row.get('id') or number), row['username'])
+                for number, row in enumerate(csv.DictReader(f), start=1)]
+
+
+def parse_mix(text):
+    if not text:
+        return DEFAULT_MIX
+    mix = {}
+    for part in text.split(','):
+        action, _, weight = part.partition('=')
+        if action not in DEFAULT_MIX:
+            raise SystemExit(f"unknown action {action!r}; choose from {', '.join(DEFAULT_MIX)}")
+        mix[action] = float(weight)
+    return mix
+
+
+async def run_mix(args, stats, population):
+    mix = parse_mix(args.mix)
+    actions, weights = list(mix), list(mix.values())
+    deadline = time.perf_counter() + args.duration
+
+    async def virtual_user(number):
+        await asyncio.sleep(random.random() * args.ramp_up)
+        user_id, username = random.choice(population)
+        user = VirtualUser(args.url, user_id, username, args.password, stats, population)
+        while time.perf_counter() < deadline:
+            # a session that was turned away at login (e.g. a 503) retries,
+            # after a pause, before doing anything else
+            if not user.logged_in:
+                if not await user.login():
+                    await asyncio.sleep(LOGIN_RETRY_DELAY)
+            else:
+                await user.act(random.choices(actions, weights)[0])
+            if args.think:
+                await asyncio.sleep(random.expovariate(1 / args.think))
+        await user.client.close()
+
+    await asyncio.gather(*(virtual_user(n) for n in range(args.concurrency)))
+
+
+async def run_log(args, stats, population):
+    sessions = defaultdict(list)
+    with open(args.log) as f:
+        for number, line in enumerate(f):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = {}
+            if not isinstance(entry, dict) or 'path' not in entry:
+                stats.skipped += 1
+                continue
+            sessions[entry.get('user') or f"#{number % args.concurrency}"].append(entry)
+
+    limit = asyncio.Semaphore(args.concurrency)
+    user_ids = {username: user_id for user_id, username in population}
+
+    async def replay_session(name, entries):
+        async with limit:
+            username = name if not name.startswith('#') else random.choice(population)[1]
+            user = VirtualUser(args.url, user_ids.get(username), username, args.password, stats, population)
+            await user.login()
+            for entry in entries:
+                await user.replay(entry)
+            await user.client.close()
+
+    await asyncio.gather(*(replay_session(name, entries) for name, entries in sessions.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--concurrency', type=int, default=20, help="virtual users at once")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run the mix for")
+    parser.add_argument('--ramp-up', type=float, default=2, help="seconds over which users start")
+    parser.add_argument('--think', type=float, default=0, help="mean pause between actions, in seconds")
+    parser.add_argument('--mix', help="weights like home=40,like=15,post=5 (default: DEFAULT_MIX)")
+    parser.add_argument('--log', help="JSONL request log to replay instead of the mix")
+    parser.add_argument('--users-csv', default=os.path.join(ROOT, 'generator', 'users.csv'))
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    population = read_population(args.users_csv)
+    stats = Stats()
+    started = time.perf_counter()
+    asyncio.run(run_log(args, stats, population) if args.log else run_mix(args, stats, population))
+    stats.report(time.perf_counter() - started)
+    if not stats.latencies:
+        sys.exit("no requests were made")
+
+
+if __name__ == '__main__':
+    main()
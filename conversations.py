@@ -0,0 +1,253 @@
+"""Direct message conversations for Warbler.
+
+Every DM belongs to the conversation between its two users: one row per
+pair (lower user id first) holding the latest message's preview, time and
+sender, and how many DMs each side hasn't read. send_dm keeps that row
+current with a single INSERT ... ON CONFLICT DO UPDATE in the same
+transaction as the DM, so:
+
+- the inbox reads conversations alone, newest first, one index range per
+  side of the pair, paged with a (last_message_at, id) cursor
+- a thread is a range read of dms on (conversation_id, id), paged by id
+- marking many DMs read is one UPDATE that moves the counts with it
+
+If the rows ever drift (or DMs were bulk-loaded), `flask
+rebuild-conversations` rebuilds them from the dms table.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import and_, case, func, or_, select, text, union_all
+
+from models import db, Conversation, DirectMessage, User
+
+INBOX_PAGE_SIZE = 30
+THREAD_PAGE_SIZE = 50
+
+UPSERT_SQL = text("""
+    INSERT INTO conversations (user_low_id, user_high_id, last_message_at, last_message_preview,
+                               last_sender_id, low_unread, high_unread)
+    VALUES (:low, :high, :at, :preview, :sender, :low_unread, :high_unread)
+    ON CONFLICT (user_low_id, user_high_id) DO UPDATE SET
+        last_message_at = excluded.last_message_at,
+        last_message_preview = excluded.last_message_preview,
+        last_sender_id = excluded.last_sender_id,
+        low_unread = conversations.low_unread + excluded.low_unread,
+        high_unread = conversations.high_unread + excluded.high_unread
+    RETURNING id
+""")
+
+# One statement on Postgres: mark a user's unread DMs read (all of them, or
+# one conversation's up to an id) and take exactly that many off each
+# conversation's count, so a DM arriving meanwhile stays counted.
+MARK_READ_SQL = """
+    WITH marked AS (
+        UPDATE dms SET is_new = false
+        WHERE dm_to = :user_id AND is_new {criteria}
+        RETURNING conversation_id
+    ), per_conversation AS (
+        SELECT conversation_id, count(*) AS n FROM marked GROUP BY conversation_id
+    ), synced AS (
+        UPDATE conversations SET
+            low_unread = CASE WHEN user_low_id = :user_id
+                              THEN greatest(low_unread - per_conversation.n, 0) ELSE low_unread END,
+            high_unread = CASE WHEN user_low_id = :user_id
+                               THEN high_unread ELSE greatest(high_unread - per_conversation.n, 0) END
+        FROM per_conversation
+        WHERE conversations.id = per_conversation.conversation_id
+        RETURNING conversations.id
+    )
+    SELECT count(*) FROM marked
+"""
+
+
+def pair(user_id, other_id):
+    """(low, high) ids of the conversation between two users."""
+    return (user_id, other_id) if user_id <= other_id else (other_id, user_id)
+
+
+def send_dm(sender_id, recipient_id, message_text):
+    """Add a DM and bring its conversation up to date. The caller commits."""
+    low, high = pair(sender_id, recipient_id)
+    now = datetime.utcnow()
+    conversation_id = db.session.execute(UPSERT_SQL, {
+        'low': low, 'high': high, 'at': now, 'preview': message_text, 'sender': sender_id,
+        'low_unread': int(recipient_id == low), 'high_unread': int(recipient_id != low),
+    }).scalar()
+    dm = DirectMessage(conversation_id=conversation_id, dm_from=sender_id, dm_to=recipient_id,
+                       message_text=message_text, timestamp=now)
+    db.session.add(dm)
+    return dm
+
+
+def conversation_between(user_id, other_id):
+    """The Conversation between two users, or None if they've never DMed."""
+    low, high = pair(user_id, other_id)
+    return Conversation.query.filter_by(user_low_id=low, user_high_id=high).first()
+
+
+def note_read(dm):
+    """Take one DM that was unread off its recipient's side of the count."""
+    if dm.conversation_id is None:
+        return
+    conversations = Conversation.__table__
+    column = conversations.c.low_unread if dm.dm_to <= dm.dm_from else conversations.c.high_unread
+    db.session.execute(conversations.update()
+                       .where(conversations.c.id == dm.conversation_id)
+                       .values({column: case([(column > 0, column - 1)], else_=0)}))
+
+
+def mark_read(user_id, conversation_id=None, up_to=None):
+    """Mark `user_id`'s unread DMs read, optionally only those in one
+    conversation and with ids up to `up_to`, keeping the conversations'
+    unread counts in step. Returns how many DMs were marked. The caller
+    commits.
+    """
+    dms = DirectMessage.__table__
+    criteria = [dms.c.dm_to == user_id, dms.c.is_new == True]
+    if conversation_id is not None:
+        criteria.append(dms.c.conversation_id == conversation_id)
+    if up_to is not None:
+        criteria.append(dms.c.id <= up_to)
+
+    session = db.session
+    if session.get_bind().dialect.name == 'postgresql':
+        extra = ''
+        if conversation_id is not None:
+            extra += ' AND conversation_id = :conversation_id'
+        if up_to is not None:
+            extra += ' AND id <= :up_to'
+        marked = session.execute(text(MARK_READ_SQL.format(criteria=extra)),
+                                 {'user_id': user_id, 'conversation_id': conversation_id, 'up_to': up_to}).scalar()
+    else:
+        # SQLite has no writes inside WITH: count per conversation, then
+        # update (SQLite runs one writer at a time, so nothing slips between)
+        counts = session.execute(select([dms.c.conversation_id, func.count()])
+                                 .where(and_(*criteria))
+                                 .group_by(dms.c.conversation_id)).fetchall()
+        marked = session.execute(dms.update().where(and_(*criteria)).values(is_new=False)).rowcount
+        conversations = Conversation.__table__
+        for conversation, n in counts:
+            if conversation is None:
+                continue
+            own_low = conversations.c.user_low_id == user_id
+            session.execute(conversations.update()
+                            .where(conversations.c.id == conversation)
+                            .values(low_unread=case([(and_(own_low, conversations.c.low_unread > n),
+                                                      conversations.c.low_unread - n),
+                                                     (own_low, 0)], else_=conversations.c.low_unread),
+                                    high_unread=case([(own_low, conversations.c.high_unread),
+                                                      (conversations.c.high_unread > n,
+                                                       conversations.c.high_unread - n)], else_=0)))
+    return marked
+
+
+def encode_inbox_cursor(row):
+    return f"{row.last_message_at.strftime('%Y%m%d%H%M%S%f')}-{row.id}"
+
+
+def decode_inbox_cursor(cursor):
+    """Parse an inbox cursor into (last_message_at, id); None if invalid."""
+    try:
+        stamp, conversation_id = cursor.split('-')
+        return datetime.strptime(stamp, '%Y%m%d%H%M%S%f'), int(conversation_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def read_inbox(user_id, before=None, limit=INBOX_PAGE_SIZE):
+    """Return (rows, next_cursor) for a page of `user_id`'s conversations,
+    most recently active first.
+
+    Rows have the conversation's id, last_message_at, last_message_preview,
+    last_sender_id, this user's `unread` count, and the other user's
+    other_id, other_username and other_image_url. Both sides of the pair
+    are read in one statement, each a range on its own index.
+    """
+    conversations = Conversation.__table__
+    users = User.__table__
+    position = decode_inbox_cursor(before) if before else None
+
+    def side(own, other, unread, *criteria):
+        query = (select([conversations.c.id,
+                         conversations.c.last_message_at,
+                         conversations.c.last_message_preview,
+                         conversations.c.last_sender_id,
+                         unread.label('unread'),
+                         users.c.id.label('other_id'),
+                         users.c.username.label('other_username'),
+                         users.c.image_url.label('other_image_url')])
+                 .select_from(conversations.join(users, users.c.id == other))
+                 .where(and_(own == user_id, *criteria)))
+        if position:
+            stamp, conversation_id = position
+            query = query.where(or_(conversations.c.last_message_at < stamp,
+                                    and_(conversations.c.last_message_at == stamp,
+                                         conversations.c.id < conversation_id)))
+        return select([query
+                       .order_by(conversations.c.last_message_at.desc(), conversations.c.id.desc())
+                       .limit(limit + 1)
+                       .alias()])
+
+    low_side = side(conversations.c.user_low_id, conversations.c.user_high_id, conversations.c.low_unread)
+    # a conversation with yourself is already on the low side
+    high_side = side(conversations.c.user_high_id, conversations.c.user_low_id, conversations.c.high_unread,
+                     conversations.c.user_low_id != user_id)
+    both = union_all(low_side, high_side).alias()
+    rows = db.session.execute(select([both])
+                              .order_by(both.c.last_message_at.desc(), both.c.id.desc())
+                              .limit(limit + 1)).fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_inbox_cursor(rows[-1])
+    return rows, None
+
+
+def read_thread(conversation, before=None, limit=THREAD_PAGE_SIZE):
+    """Return (dms, next_cursor) for a page of a conversation, newest first."""
+    query = DirectMessage.query.filter(DirectMessage.conversation_id == conversation.id)
+    try:
+        before_id = int(before) if before else None
+    except ValueError:
+        before_id = None
+    if before_id:
+        query = query.filter(DirectMessage.id < before_id)
+    dms = query.order_by(DirectMessage.id.desc()).limit(limit + 1).all()
+    if len(dms) > limit:
+        dms = dms[:limit]
+        return dms, str(dms[-1].id)
+    return dms, None
+
+
+def rebuild_conversations():
+    """Rebuild every conversation from the dms table and point each DM at
+    its conversation. Returns how many conversations there are."""
+    dms = DirectMessage.__table__
+    conversations = Conversation.__table__
+    low = case([(dms.c.dm_from <= dms.c.dm_to, dms.c.dm_from)], else_=dms.c.dm_to)
+    high = case([(dms.c.dm_from <= dms.c.dm_to, dms.c.dm_to)], else_=dms.c.dm_from)
+
+    db.session.execute(dms.update().values(conversation_id=None))
+    db.session.execute(conversations.delete())
+
+    def unread(side):
+        return func.sum(case([(and_(dms.c.is_new == True, dms.c.dm_to == side), 1)], else_=0))
+
+    latest = func.max(dms.c.id)
+    pairs = (select([low.label('low'), high.label('high'), latest.label('latest'),
+                     unread(low).label('low_unread'), unread(high).label('high_unread')])
+             .group_by(low, high)
+             .alias())
+    summary = (select([pairs.c.low, pairs.c.high, dms.c.timestamp, dms.c.message_text, dms.c.dm_from,
+                       pairs.c.low_unread, pairs.c.high_unread])
+               .select_from(pairs.join(dms, dms.c.id == pairs.c.latest)))
+    db.session.execute(conversations.insert().from_select(
+        ['user_low_id', 'user_high_id', 'last_message_at', 'last_message_preview', 'last_sender_id',
+         'low_unread', 'high_unread'], summary))
+
+    matching = (select([conversations.c.id])
+                .where(and_(conversations.c.user_low_id == low, conversations.c.user_high_id == high))
+                .as_scalar())
+    db.session.execute(dms.update().values(conversation_id=matching))
+    db.session.commit()
+    return db.session.query(func.count(Conversation.id)).scalar()
@@ -0,0 +1,134 @@
+"""Process-local cache of logged-in user snapshots.
+
+Most pages need the real ORM user on g.user, but hot endpoints like the AJAX
+like button only need to know who is asking. For those, add_user_to_g uses
+a read-only CurrentUser snapshot from a small LRU keyed by user id, so the
+request skips the users-table round trip.
+
+Whenever a user row is updated or deleted through the ORM (profile edits,
+admin edits, password and privacy changes, deletes), that user's snapshot
+is dropped: in this worker right away, and in every other worker once the
+change commits, through a 'user_changed' event on the events fanout (see
+events.py). Entries also expire after CURRENT_USER_CACHE_TTL seconds, which
+bounds staleness if that event is lost, e.g. while a worker's LISTEN
+connection reconnects, or with EVENTS_ENABLED off, when the TTL is all
+there is.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+import events
+from metrics import record_cache
+from models import db, User
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 60
+
+SNAPSHOT_COLUMNS = ('id', 'username', 'image_url', 'header_image_url',
+                    'is_admin', 'is_private', 'is_verified')
+
+USER_CHANGED = 'user_changed'
+
+_snapshots = OrderedDict()
+# bumped by every invalidation, so a snapshot loaded while one happened
+# isn't cached
+_generation = 0
+_lock = Lock()
+
+log = logging.getLogger('warbler.current_user')
+
+
+class CurrentUser:
+    """Read-only stand-in for a logged-in User that isn't attached to a session."""
+
+    __slots__ = SNAPSHOT_COLUMNS
+
+    def __init__(self, row):
+        for name in SNAPSHOT_COLUMNS:
+            object.__setattr__(self, name, getattr(row, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("CurrentUser snapshots are read-only; load the User to change it")
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def _config(key, default):
+    return db.get_app().config.get(key, default)
+
+
+def _listen_for_changes():
+    """Make sure this worker hears about users changed in other workers."""
+    if not _config('EVENTS_ENABLED', True):
+        return
+    try:
+        events.get_broker()
+    except Exception:
+        log.exception("current_user: can't receive invalidations; relying on the TTL")
+
+
+def get_current_user(user_id):
+    """Return a CurrentUser for `user_id`, or None if the user doesn't exist."""
+    now = time.monotonic()
+    with _lock:
+        generation = _generation
+        cached = _snapshots.get(user_id)
+        if cached and cached[0] > now:
+            _snapshots.move_to_end(user_id)
+            record_cache('current_user', True)
+            return cached[1]
+
+    record_cache('current_user', False)
+    _listen_for_changes()
+
+    columns = [getattr(User, name) for name in SNAPSHOT_COLUMNS]
+    row = db.session.query(*columns).filter(User.id == user_id).first()
+    if row is None:
+        return None
+    snapshot = CurrentUser(row)
+
+    with _lock:
+        # only cache it if nothing was invalidated while we were loading
+        if _generation == generation:
+            _snapshots[user_id] = (now + _config('CURRENT_USER_CACHE_TTL', DEFAULT_TTL), snapshot)
+            _snapshots.move_to_end(user_id)
+            while len(_snapshots) > _config('CURRENT_USER_CACHE_SIZE', DEFAULT_SIZE):
+                _snapshots.popitem(last=False)
+    return snapshot
+
+
+def invalidate_current_user(user_id, data=None):
+    """Drop any cached snapshot of `user_id` in this worker."""
+    global _generation
+    with _lock:
+        _generation += 1
+        _snapshots.pop(user_id, None)
+
+
+events.handle(USER_CHANGED, invalidate_current_user)
+
+
+@event.listens_for(User, 'after_update')
+def _user_row_updated(mapper, connection, target):
+    # after_update also fires for users whose collections alone changed
+    # (follows, likes, messages); their snapshot is still good
+    if object_session(target).is_modified(target, include_collections=False):
+        _user_row_changed(target)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_row_deleted(mapper, connection, target):
+    _user_row_changed(target)
+
+
+def _user_row_changed(target):
+    invalidate_current_user(target.id)
+    # and in the other workers, once this commits
+    events.publish(target.id, USER_CHANGED)
@@ -0,0 +1,389 @@
+"""Live updates for Warbler over Server-Sent Events.
+
+GET /events holds a text/event-stream open for the logged-in user and
+pushes:
+
+- notification: a follow request arrived
+- dm: a direct message arrived (its id, conversation, sender and text)
+- read: DMs were read or notifications cleared, perhaps in another tab
+- like: one of the user's messages was liked or unliked, with its count
+
+Other modules can claim a kind with `handle` to run something in every
+worker instead; current_user.py uses that to drop cached snapshots of a
+user edited or deleted in another worker.
+
+notification, dm and read events also carry the navbar badge counts
+(pending_notifications, unread_dms), so the page never has to reload for
+them.
+
+New Notifications and DirectMessages, and read or deleted ones, are picked
+up from each session's flushes; anything else is queued with `publish`.
+Either way nothing is sent until the session commits. Sending goes through
+a fanout that reaches every worker, and each worker's Broker hands the
+event to its own open streams. EVENTS_FANOUT picks the fanout:
+
+- "postgres": NOTIFY on one channel; each worker LISTENs on a connection
+  of its own
+- "socket": a Unix datagram socket per worker in EVENTS_SOCKET_DIR, for a
+  single host (and tests)
+- "local": this process only
+- "module:Class": anything with the same start/publish methods
+
+By default it's "postgres" on Postgres and "socket" otherwise. Events sent
+while a worker's LISTEN connection is reconnecting are lost; badges catch
+up on the next event or page load.
+
+An open stream is an idle connection, so streams need gevent workers (see
+gunicorn.conf.py): each one would pin a whole sync worker. Streams are
+closed after EVENTS_MAX_AGE seconds and the browser reconnects, which
+keeps them spread over workers.
+"""
+
+import importlib
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import suppress
+
+from flask import Response, stream_with_context
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from models import db, DirectMessage, Notification
+from unread import invalidate_unread, unread_counts
+
+CHANNEL = 'warbler_events'
+DEFAULT_KEEPALIVE = 15
+DEFAULT_MAX_AGE = 300
+DEFAULT_QUEUE_SIZE = 100
+RECONNECT_DELAY = 5
+# what the browser waits before reconnecting, in milliseconds
+RETRY_MS = 3000
+MAX_DATAGRAM = 65536
+PREVIEW_LENGTH = 280
+
+# events that change the navbar badges
+BADGE_EVENTS = {'notification', 'dm', 'read'}
+
+# events that only need sending once per user per commit
+ONCE_PER_COMMIT = {'read', 'user_changed'}
+
+NOTIFY_SQL = text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"
+                  ).execution_options(autocommit=True)
+
+log = logging.getLogger('warbler.events')
+
+
+def encode(user_id, kind, data):
+    return json.dumps([user_id, kind, data], separators=(',', ':'))
+
+
+def decode(payload):
+    user_id, kind, data = json.loads(payload)
+    return user_id, kind, data
+
+
+class Broker:
+    """The open streams in this process, by user, each a bounded queue of
+    (kind, data) events."""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._streams = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id):
+        stream = queue.Queue(self.queue_size)
+        with self._lock:
+            self._streams[user_id].add(stream)
+        return stream
+
+    def unsubscribe(self, user_id, stream):
+        with self._lock:
+            streams = self._streams.get(user_id)
+            if streams is not None:
+                streams.discard(stream)
+                if not streams:
+                    del self._streams[user_id]
+
+    def deliver(self, user_id, kind, data):
+        with self._lock:
+            streams = list(self._streams.get(user_id, ()))
+        for stream in streams:
+            try:
+                stream.put_nowait((kind, data))
+            except queue.Full:
+                # the client stopped reading; its next event brings the
+                # badges up to date anyway
+                pass
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(streams) for streams in self._streams.values())
+
+
+class LocalFanout:
+    """Delivers events to this process's streams only."""
+
+    def __init__(self, config, deliver):
+        self.deliver = deliver
+
+    def start(self):
+        pass
+
+    def publish(self, events):
+        for user_id, kind, data in events:
+            self.deliver(user_id, kind, data)
+
+
+def default_socket_dir():
+    return os.path.join(tempfile.gettempdir(), 'warbler-events')
+
+
+class SocketFanout:
+    """A Unix datagram socket per process, all in one directory; publishing
+    sends every event to every socket there, this process's included."""
+
+    def __init__(self, config, deliver, name=None):
+        self.deliver = deliver
+        self.directory = config.get('EVENTS_SOCKET_DIR') or default_socket_dir()
+        self.path = os.path.join(self.directory, f'{name or os.getpid()}.sock')
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # a full receive buffer drops the event rather than stall the request
+        self._sender.setblocking(False)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.path)
+        threading.Thread(target=self._receive, args=(receiver,), name='events-socket', daemon=True).start()
+
+    def _receive(self, receiver):
+        while True:
+            self.deliver(*decode(receiver.recv(MAX_DATAGRAM)))
+
+    def publish(self, events):
+        payloads = [encode(*e).encode('utf-8') for e in events]
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            for payload in payloads:
+                try:
+                    self._sender.sendto(payload, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # left behind by a worker that has exited
+                    with suppress(FileNotFoundError):
+                        os.unlink(path)
+                    break
+                except BlockingIOError:
+                    log.warning("events: %s is not keeping up, dropped an event", name)
+
+
+class PostgresFanout:
+    """NOTIFY on CHANNEL, one statement per commit; each process LISTENs on
+    a connection taken out of the pool for good."""
+
+    def __init__(self, config, deliver):
+        self.deliver = deliver
+        self.engine = db.engine
+
+    def start(self):
+        threading.Thread(target=self._listen_forever, name='events-listen', daemon=True).start()
+
+    def _listen_forever(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                log.exception("events: LISTEN connection lost; reconnecting in %ss", RECONNECT_DELAY)
+                time.sleep(RECONNECT_DELAY)
+
+    def _listen(self):
+        connection = self.engine.raw_connection()
+        connection.detach()
+        try:
+            raw = connection.connection
+            raw.autocommit = True
+            raw.cursor().execute(f'LISTEN {CHANNEL}')
+            while True:
+                # wake up now and then so a dead connection is noticed
+                if select.select([raw], [], [], DEFAULT_KEEPALIVE)[0]:
+                    raw.poll()
+                else:
+                    raw.cursor().execute('SELECT 1')
+                while raw.notifies:
+                    self.deliver(*decode(raw.notifies.pop(0).payload))
+        finally:
+            connection.close()
+
+    def publish(self, events):
+        with self.engine.connect() as connection:
+            connection.execute(NOTIFY_SQL, channel=CHANNEL, payloads=[encode(*e) for e in events])
+
+
+FANOUTS = {'local': LocalFanout, 'socket': SocketFanout, 'postgres': PostgresFanout}
+
+
+def make_fanout(config, deliver):
+    """Build the fanout named by EVENTS_FANOUT (see the module docstring)."""
+    name = config.get('EVENTS_FANOUT')
+    if not name:
+        name = 'postgres' if db.engine.dialect.name == 'postgresql' else 'socket'
+    if name in FANOUTS:
+        return FANOUTS[name](config, deliver)
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)(config, deliver)
+
+
+_broker = None
+_fanout = None
+_pid = None
+_lock = threading.Lock()
+_handlers = {}
+
+
+def handle(kind, callback):
+    """Run `callback(user_id, data)` in every worker for `kind` events,
+    which then aren't streamed to browsers."""
+    _handlers[kind] = callback
+
+
+def _dispatcher(broker):
+    def dispatch(user_id, kind, data):
+        handler = _handlers.get(kind)
+        if handler is not None:
+            handler(user_id, data)
+        else:
+            broker.deliver(user_id, kind, data)
+    return dispatch
+
+
+def get_broker():
+    """This process's Broker and fanout, started on first use so each
+    forked worker has its own."""
+    global _broker, _fanout, _pid
+    with _lock:
+        if _broker is None or _pid != os.getpid():
+            config = db.get_app().config
+            _broker = Broker(config.get('EVENTS_QUEUE_SIZE', DEFAULT_QUEUE_SIZE))
+            _fanout = make_fanout(config, _dispatcher(_broker))
+            _fanout.start()
+            _pid = os.getpid()
+        return _broker, _fanout
+
+
+def reset():
+    """Forget the broker and fanout, e.g. after changing EVENTS_* config."""
+    global _broker, _fanout, _pid
+    with _lock:
+        _broker = _fanout = _pid = None
+
+
+def publish(user_id, kind, data=None):
+    """Queue an event for `user_id`'s streams, sent once the session commits."""
+    db.session.info.setdefault('events_pending', []).append((user_id, kind, data or {}))
+
+
+def send(events):
+    """Send committed events to every worker now."""
+    if not events or not db.get_app().config.get('EVENTS_ENABLED', True):
+        return
+    # several reads by one user in one commit only need one event
+    seen = set()
+    unique = []
+    for user_id, kind, data in events:
+        if kind in ONCE_PER_COMMIT:
+            if (user_id, kind) in seen:
+                continue
+            seen.add((user_id, kind))
+        unique.append((user_id, kind, data))
+    try:
+        get_broker()[1].publish(unique)
+    except Exception:
+        # the write has been committed already; a lost event only delays a badge
+        log.exception("events: could not send %d events", len(unique))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_events(session, flush_context):
+    pending = session.info.setdefault('events_pending', [])
+    for obj in session.new:
+        if isinstance(obj, Notification):
+            pending.append((obj.to_id, 'notification',
+                            {'id': obj.id, 'from_id': obj.from_id, 'kind': obj.notification_txt}))
+        elif isinstance(obj, DirectMessage):
+            pending.append((obj.dm_to, 'dm',
+                            {'id': obj.id, 'conversation_id': obj.conversation_id, 'from_id': obj.dm_from,
+                             'text': obj.message_text[:PREVIEW_LENGTH]}))
+    for obj in session.dirty:
+        if isinstance(obj, DirectMessage) and session.is_modified(obj):
+            pending.append((obj.dm_to, 'read', {}))
+    for obj in session.deleted:
+        if isinstance(obj, (Notification, DirectMessage)):
+            pending.append((obj.to_id if isinstance(obj, Notification) else obj.dm_to, 'read', {}))
+
+
+@event.listens_for(Session, 'after_commit')
+def _send_committed(session):
+    send(session.info.pop('events_pending', None))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('events_pending', None)
+
+
+def format_event(kind, data):
+    return f'event: {kind}\ndata: {json.dumps(data)}\n\n'
+
+
+def badge_counts(user_id):
+    """Fresh navbar counts; the write may have happened in another worker,
+    so this one's cached counts are dropped first."""
+    invalidate_unread(user_id)
+    pending_notifications, unread_dms = unread_counts(user_id)
+    # don't hold a pooled connection while the stream sits idle
+    db.session.remove()
+    return {'pending_notifications': pending_notifications, 'unread_dms': unread_dms}
+
+
+def event_stream(user_id):
+    """The text/event-stream Response for `user_id`, subscribed right away
+    so nothing committed after this call is missed."""
+    config = db.get_app().config
+    keepalive = config.get('EVENTS_KEEPALIVE', DEFAULT_KEEPALIVE)
+    max_age = config.get('EVENTS_MAX_AGE', DEFAULT_MAX_AGE)
+    broker, _ = get_broker()
+    events = broker.subscribe(user_id)
+    db.session.remove()
+
+    def generate():
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            deadline = time.monotonic() + max_age
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    kind, data = events.get(timeout=min(keepalive, remaining))
+                except queue.Empty:
+                    # also how a closed connection is noticed
+                    yield ': keepalive\n\n'
+                    continue
+                if kind in BADGE_EVENTS:
+                    data = dict(data, **badge_counts(user_id))
+                yield format_event(kind, data)
+        finally:
+            broker.unsubscribe(user_id, events)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -3,6 +3,9 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+For load-testing sized datasets, use generate.py instead: it runs offline
+and scales to millions of users.
 """
 
 import csv
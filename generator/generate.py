@@ -0,0 +1,421 @@
+"""Generate large, realistic CSVs of Warbler data for load testing.
+
+Unlike create_csvs.py this works fully offline and writes every file in
+chunks, so memory stays flat whether you ask for a thousand users or a
+million users and a hundred million messages:
+
+    python generator/generate.py --users 1000000 --messages 100000000 \\
+        --follows 50000000 --likes 200000000 --seed 7 --out generator/data
+
+Needs NumPy. Users and the other tables with an id column are numbered
+from 1 in the files, so rows can reference each other directly. Messages
+get snowflake ids made from their timestamps, as the app writes them; the
+ids are kept in a scratch file in --out while likes.csv is written. The
+same seed and chunk size always give the same files (the ids depend on
+the date it's run, like the timestamps).
+
+What the data looks like:
+
+- Who gets followed follows a Zipf law (--zipf), so a few accounts have
+  huge follower counts and most have a handful. How many accounts each user
+  follows is log-normal.
+- Posting activity is Zipf-distributed too, independently of popularity.
+- Message timestamps cover the last --days days, get busier as the site
+  grows and peak in the evening (UTC). Message ids increase with time.
+- Likes pile up on a small share of messages.
+- A --private share of accounts is private and has pending follow requests
+  in notifications.csv. Blocks and DMs are spread across all users.
+"""
+
+import argparse
+import csv
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+MAX_WARBLER_LENGTH = 140
+TEXT_POOL_SIZE = 1 << 16
+BIO_POOL_SIZE = 1 << 12
+
+# snowflake.py's layout, so generated message ids look like the app's
+SNOWFLAKE_EPOCH = datetime(2020, 1, 1)
+SNOWFLAKE_TIME_SHIFT = 22
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
+
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+]
+
+LOCATIONS = [
+    'Amsterdam', 'Atlanta', 'Austin', 'Berlin', 'Boston', 'Buenos Aires',
+    'Cairo', 'Chicago', 'Denver', 'Dublin', 'Houston', 'Istanbul', 'Jakarta',
+    'Lagos', 'Lisbon', 'London', 'Los Angeles', 'Madrid', 'Manila',
+    'Melbourne', 'Mexico City', 'Miami', 'Montreal', 'Mumbai', 'Nairobi',
+    'New York', 'Oakland', 'Osaka', 'Paris', 'Portland', 'Rome',
+    'San Francisco', 'Seattle', 'Seoul', 'Singapore', 'Stockholm', 'Sydney',
+    'Tokyo', 'Toronto', 'Vancouver',
+]
+
+WORDS = """
+able about across act after again against age ago agree air all almost alone
+along already also always among animal answer any area arm around art ask away
+baby back bad bag ball bank bar base beat beautiful bed best better big bird
+bit black blue board boat body book born both box boy break bring brother
+build business buy call camera campaign car card care carry case cat catch
+cause center chair chance change child choice city class clear close coach
+coffee cold color come common community cost could country course cover
+crowd cup cut dark data day dead deal dinner dog door down draw dream drive
+during early east easy eat edge effort energy enjoy enough evening event
+every eye face fact fall family far fast field fight film final find fine
+fire first fish five floor fly food foot force forget free friend front full
+fun game garden girl give glass goal good great green ground group grow guess
+guy hair half hand happy hard head hear heart heat heavy help here high hill
+history hold home hope horse hot hour house huge idea image inside island job
+join jump just keep key kid kind kitchen know lake land language large last
+late laugh lead learn leave left less letter life light line list listen
+little live local long look lose loud love low machine main make many map
+market match maybe meet memory middle might mind minute miss model moment
+money month moon morning mother mountain move movie music name nature near
+need never new news next nice night north note nothing now number ocean off
+office often old open order other outside over page paint paper park party
+pass past pay people perfect person phone picture piece place plan plant play
+point power present pretty price problem program pull push quick quiet race
+radio rain reach read ready real reason red remember rest rich ride right
+river road rock room round rule run safe same save say school science sea
+season second see sell send serve set seven shake share ship shoe short show
+side sign simple since sing sister sit six sky sleep slow small smile snow
+soft song soon sound south space speak special spend sport spring stage stand
+star start station stay step still stone stop store story street strong study
+style summer sun sure table take talk team tell ten test thank thing think
+three through ticket time today together tonight top town track train travel
+tree trip true try turn two under until up use usual value very view visit
+voice wait walk wall want warm watch water wave way weather week welcome west
+white whole wide wild win wind window winter wish without woman wonder word
+work world write wrong yard year yellow yes yesterday young
+""".split()
+
+# relative posting activity by hour of day (UTC), quiet overnight and
+# busiest in the evening
+HOURLY_ACTIVITY = np.array([
+    3, 2, 1.5, 1, 1, 1, 1.5, 2.5, 4, 5, 5.5, 6,
+    6.5, 6.5, 6, 6, 6.5, 7, 8, 9, 9.5, 9, 7, 5,
+])
+
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio',
+                     'header_image_url', 'location', 'is_private']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
+FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['id', 'user_id', 'message_id']
+BLOCKS_CSV_HEADERS = ['id', 'user', 'blocked_user']
+DMS_CSV_HEADERS = ['id', 'dm_from', 'dm_to', 'message_text', 'timestamp', 'is_new']
+NOTIFICATIONS_CSV_HEADERS = ['id', 'notification_txt', 'date', 'from_id', 'to_id']
+
+
+def sentence_pool(rng, size, min_words, max_words):
+    """`size` random sentences of dictionary words, as an object array."""
+    words = np.array(WORDS, dtype=object)
+    lengths = rng.integers(min_words, max_words + 1, size=size)
+    picks = np.split(words[rng.integers(len(WORDS), size=lengths.sum())], np.cumsum(lengths)[:-1])
+    return np.array([(' '.join(sentence).capitalize() + '.')[:MAX_WARBLER_LENGTH]
+                     for sentence in picks], dtype=object)
+
+
+class ZipfSampler:
+    """Draw ids 1..n where the id with popularity rank r has weight 1 / r**s.
+
+    Ranks are shuffled across ids so popularity has nothing to do with age.
+    """
+
+    def __init__(self, rng, n, s):
+        weights = 1.0 / np.arange(1, n + 1) ** s
+        self.cdf = np.cumsum(weights) / weights.sum()
+        self.ids = rng.permutation(n) + 1
+        self.rng = rng
+
+    def __call__(self, size):
+        ranks = np.searchsorted(self.cdf, self.rng.random(size), side='right')
+        return self.ids[np.minimum(ranks, len(self.ids) - 1)]
+
+
+def degrees(rng, total, n, cap, sigma=1.2):
+    """Split `total` edges over n sources log-normally, at most `cap` each."""
+    if n == 0 or total == 0:
+        return np.zeros(n, dtype=np.int64)
+    weights = rng.lognormal(0, sigma, n)
+    counts = rng.multinomial(total, weights / weights.sum())
+    return np.minimum(counts, cap)
+
+
+def source_blocks(counts, chunk_size):
+    """Yield (lo, hi) index ranges of sources with about chunk_size edges each."""
+    ends = np.cumsum(counts)
+    lo = 0
+    while lo < len(counts):
+        start = ends[lo - 1] if lo else 0
+        hi = max(int(np.searchsorted(ends, start + chunk_size, side='right')), lo + 1)
+        yield lo, min(hi, len(counts))
+        lo = hi
+
+
+def distinct_targets(lo, counts, draw, no_self=False, attempts=4):
+    """Give each source id lo+1 .. lo+len(counts) up to counts[i] distinct targets.
+
+    Targets come from `draw(size)`. Duplicates (and self-edges with no_self)
+    are dropped and redrawn up to `attempts` times; a source still short
+    after that keeps what it has. Returns (sources, targets) sorted by source.
+    """
+    sources = np.arange(lo + 1, lo + len(counts) + 1)
+    src = np.empty(0, dtype=np.int64)
+    dst = np.empty(0, dtype=np.int64)
+    want = counts
+    for _ in range(attempts):
+        if not want.any():
+            break
+        src = np.concatenate([src, np.repeat(sources, want)])
+        dst = np.concatenate([dst, draw(int(want.sum()))])
+        if no_self:
+            keep = src != dst
+            src, dst = src[keep], dst[keep]
+        stride = int(dst.max()) + 1 if len(dst) else 1
+        src, dst = np.divmod(np.unique(src * stride + dst), stride)
+        want = np.maximum(counts - np.bincount(src - lo - 1, minlength=len(counts)), 0)
+    return src, dst
+
+
+def format_timestamps(start, offsets_us):
+    """Render microsecond offsets from `start` as 'YYYY-MM-DD HH:MM:SS.ffffff'."""
+    stamps = np.datetime64(start, 'us') + offsets_us.astype('timedelta64[us]')
+    return np.char.replace(np.datetime_as_string(stamps, unit='us'), 'T', ' ').tolist()
+
+
+def snowflake_ids(millis):
+    """Ids for messages made at `millis` (sorted milliseconds since
+    SNOWFLAKE_EPOCH): each millisecond's messages are numbered from 0 in
+    the bits below the time."""
+    positions = np.arange(len(millis))
+    first = np.r_[True, millis[1:] != millis[:-1]]
+    return (millis << SNOWFLAKE_TIME_SHIFT) | (positions - np.maximum.accumulate(np.where(first, positions, 0)))
+
+
+def write_csv(path, headers, chunks):
+    """Write a header and then each chunk (a tuple of equal-length columns)."""
+    rows = 0
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for columns in chunks:
+            writer.writerows(zip(*columns))
+            rows += len(columns[0])
+    return rows
+
+
+class Generator:
+    """Holds the shape of one dataset and yields each table in chunks."""
+
+    def __init__(self, args):
+        self.args = args
+        streams = np.random.SeedSequence(args.seed).spawn(8)
+        self.rngs = [np.random.default_rng(stream) for stream in streams]
+        rng = self.rngs[0]
+        self.now = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.start = self.now - timedelta(days=args.days)
+        self.start_ms = (self.start - SNOWFLAKE_EPOCH) // timedelta(milliseconds=1)
+        self.message_ids = None
+        self.texts = sentence_pool(rng, TEXT_POOL_SIZE, 4, 24)
+        self.bios = sentence_pool(rng, BIO_POOL_SIZE, 3, 10)
+        self.private = rng.random(args.users) < args.private
+        self.popularity = ZipfSampler(rng, args.users, args.zipf)
+        self.activity = ZipfSampler(rng, args.users, args.zipf)
+
+    def users(self):
+        rng = self.rngs[1]
+        words = np.array(WORDS, dtype=object)
+        for lo in range(0, self.args.users, self.args.chunk_size):
+            ids = np.arange(lo + 1, min(lo + self.args.chunk_size, self.args.users) + 1)
+            size = len(ids)
+            first = words[rng.integers(len(WORDS), size=size)]
+            second = words[rng.integers(len(WORDS), size=size)]
+            usernames = [f"{a}{b}{i}" for a, b, i in zip(first, second, ids.tolist())]
+            yield (ids.tolist(),
+                   [f"{name}@example.com" for name in usernames],
+                   usernames,
+                   [IMAGE_URLS[i] for i in rng.integers(len(IMAGE_URLS), size=size)],
+                   [PASSWORD] * size,
+                   self.bios[rng.integers(len(self.bios), size=size)].tolist(),
+                   [HEADER_IMAGE_URLS[i] for i in rng.integers(len(HEADER_IMAGE_URLS), size=size)],
+                   [LOCATIONS[i] for i in rng.integers(len(LOCATIONS), size=size)],
+                   np.where(self.private[lo:lo + size], 'true', 'false').tolist())
+
+    def messages(self):
+        """Messages in timestamp order, with a day's posts never split over
+        chunks (so neither is a millisecond's). Their ids are also saved to
+        self.message_ids, for likes()."""
+        rng = self.rngs[2]
+        days = np.arange(self.args.days)
+        growth = np.exp(self.args.growth * days / max(self.args.days, 1))
+        per_day = rng.multinomial(self.args.messages, growth / growth.sum())
+        hourly = np.cumsum(HOURLY_ACTIVITY) / HOURLY_ACTIVITY.sum()
+
+        self.message_ids = np.lib.format.open_memmap(self.message_ids_path(), mode='w+', dtype=np.int64,
+                                                     shape=(max(self.args.messages, 1),))
+        written = 0
+        offsets = []
+        for day, count in zip(days.tolist(), per_day.tolist()):
+            if count:
+                hours = np.searchsorted(hourly, rng.random(count), side='right')
+                seconds = np.sort(hours * 3600 + rng.random(count) * 3600)
+                offsets.append(day * 86400_000_000 + (seconds * 1_000_000).astype(np.int64))
+            pending = sum(len(chunk) for chunk in offsets)
+            if offsets and (pending >= self.args.chunk_size or day == days[-1]):
+                offsets = np.concatenate(offsets)
+                ids = snowflake_ids(self.start_ms + offsets // 1000)
+                self.message_ids[written:written + len(ids)] = ids
+                written += len(ids)
+                yield (ids.tolist(),
+                       self.texts[rng.integers(len(self.texts), size=len(ids))].tolist(),
+                       format_timestamps(self.start, offsets),
+                       self.activity(len(ids)).tolist())
+                offsets = []
+
+    def message_ids_path(self):
+        return os.path.join(self.args.out, '.message_ids.npy')
+
+    def follows(self):
+        rng = self.rngs[3]
+        users = self.args.users
+        counts = degrees(rng, self.args.follows, users, max(users - 1, 0))
+        for lo, hi in source_blocks(counts, self.args.chunk_size):
+            followers, followed = distinct_targets(lo, counts[lo:hi], self.popularity, no_self=True)
+            yield followed.tolist(), followers.tolist()
+
+    def likes(self):
+        """Likes of the messages from messages(), which runs first."""
+        rng = self.rngs[4]
+        total = self.args.messages
+        if not total:
+            return
+        # Zipf ranks over messages, scattered over ids by an affine permutation
+        # so the hot messages aren't all the oldest ones
+        step = 2_147_483_647 if total % 2_147_483_647 else 2_147_483_629
+        offset = int(rng.integers(total))
+
+        def liked(size):
+            ranks = rng.zipf(self.args.like_zipf, size) % total
+            return (ranks * step + offset) % total + 1
+
+        counts = degrees(rng, self.args.likes, self.args.users, total)
+        next_id = 1
+        for lo, hi in source_blocks(counts, self.args.chunk_size):
+            users, messages = distinct_targets(lo, counts[lo:hi], liked)
+            yield (np.arange(next_id, next_id + len(users)).tolist(), users.tolist(),
+                   self.message_ids[messages - 1].tolist())
+            next_id += len(users)
+
+    def blocks(self):
+        rng = self.rngs[5]
+        users = self.args.users
+        counts = degrees(rng, self.args.blocks, users, max(users - 1, 0))
+        next_id = 1
+        for lo, hi in source_blocks(counts, self.args.chunk_size):
+            blockers, blocked = distinct_targets(
+                lo, counts[lo:hi], lambda size: rng.integers(1, users + 1, size), no_self=True)
+            yield np.arange(next_id, next_id + len(blockers)).tolist(), blockers.tolist(), blocked.tolist()
+            next_id += len(blockers)
+
+    def direct_messages(self):
+        rng = self.rngs[6]
+        period_us = self.args.days * 86400_000_000
+        recent_us = period_us - 7 * 86400_000_000
+        next_id = 1
+        for lo in range(0, self.args.dms, self.args.chunk_size):
+            size = min(self.args.chunk_size, self.args.dms - lo)
+            senders = self.activity(size)
+            recipients = rng.integers(1, self.args.users + 1, size)
+            keep = senders != recipients
+            senders, recipients = senders[keep], recipients[keep]
+            size = len(senders)
+            offsets = np.sort(rng.integers(period_us, size=size))
+            unread = (offsets > recent_us) & (rng.random(size) < 0.5)
+            yield (np.arange(next_id, next_id + size).tolist(),
+                   senders.tolist(),
+                   recipients.tolist(),
+                   self.texts[rng.integers(len(self.texts), size=size)].tolist(),
+                   format_timestamps(self.start, offsets),
+                   np.where(unread, 'true', 'false').tolist())
+            next_id += size
+
+    def notifications(self):
+        """Pending follow requests to private accounts."""
+        rng = self.rngs[7]
+        private_ids = np.flatnonzero(self.private) + 1
+        if not len(private_ids):
+            return
+        period_us = self.args.days * 86400_000_000
+        next_id = 1
+        for lo in range(0, self.args.notifications, self.args.chunk_size):
+            size = min(self.args.chunk_size, self.args.notifications - lo)
+            recipients = private_ids[rng.integers(len(private_ids), size=size)]
+            senders = rng.integers(1, self.args.users + 1, size)
+            keep = senders != recipients
+            senders, recipients = senders[keep], recipients[keep]
+            size = len(senders)
+            yield (np.arange(next_id, next_id + size).tolist(),
+                   ['follow_request'] * size,
+                   format_timestamps(self.start, np.sort(rng.integers(period_us, size=size))),
+                   senders.tolist(),
+                   recipients.tolist())
+            next_id += size
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Warbler CSVs offline, in bounded memory.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--likes', type=int, default=2000)
+    parser.add_argument('--blocks', type=int, default=50)
+    parser.add_argument('--dms', type=int, default=500)
+    parser.add_argument('--notifications', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--days', type=int, default=730, help="how far back messages go")
+    parser.add_argument('--growth', type=float, default=1.5,
+                        help="how much busier the newest day is than the oldest, as a log ratio")
+    parser.add_argument('--zipf', type=float, default=1.1, help="exponent for popularity and activity")
+    parser.add_argument('--like-zipf', type=float, default=1.3, help="exponent for likes per message (> 1)")
+    parser.add_argument('--private', type=float, default=0.05, help="share of private accounts")
+    parser.add_argument('--chunk-size', type=int, default=100_000, help="rows per write")
+    parser.add_argument('--out', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.out, exist_ok=True)
+    generator = Generator(args)
+    tables = [
+        ('users.csv', USERS_CSV_HEADERS, generator.users),
+        ('messages.csv', MESSAGES_CSV_HEADERS, generator.messages),
+        ('follows.csv', FOLLOWS_CSV_HEADERS, generator.follows),
+        ('likes.csv', LIKES_CSV_HEADERS, generator.likes),
+        ('blocks.csv', BLOCKS_CSV_HEADERS, generator.blocks),
+        ('direct_messages.csv', DMS_CSV_HEADERS, generator.direct_messages),
+        ('notifications.csv', NOTIFICATIONS_CSV_HEADERS, generator.notifications),
+    ]
+    for filename, headers, rows in tables:
+        count = write_csv(os.path.join(args.out, filename), headers, rows())
+        print(f"{filename:<22} {count:>12,} rows")
+    if os.path.exists(generator.message_ids_path()):
+        os.remove(generator.message_ids_path())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""gunicorn settings, read automatically when gunicorn starts in this directory.
+
+Workers share their Prometheus metrics through mmap'd files in
+PROMETHEUS_MULTIPROC_DIR (see metrics.py). It has to be set before the
+workers import the app. It is emptied when the server starts, and each
+worker's files are marked dead when it exits.
+
+Each worker also gets its own snowflake worker id (see snowflake.py): the
+lowest slot in 1..31 that no live worker holds, so a restarted worker
+reuses its predecessor's, offset by 32 * SNOWFLAKE_MACHINE_ID. Give each
+machine its own SNOWFLAKE_MACHINE_ID (0..31) when running on more than one.
+
+Workers are gevent workers, so the idle /events streams (see events.py)
+are greenlets rather than a sync worker apiece; psycopg2 is made to yield
+to other greenlets while it waits on Postgres. GUNICORN_WORKER_CLASS=sync
+switches back. The events fanout's socket directory is emptied on start,
+like the metrics one.
+"""
+
+import os
+import shutil
+import tempfile
+
+metrics_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR',
+                                    os.path.join(tempfile.gettempdir(), 'warbler-metrics'))
+events_dir = os.environ.setdefault('EVENTS_SOCKET_DIR',
+                                   os.path.join(tempfile.gettempdir(), 'warbler-events'))
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+# open connections per worker, idle event streams included
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 2000))
+
+
+def on_starting(server):
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    shutil.rmtree(events_dir, ignore_errors=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+SNOWFLAKE_SLOTS = 32
+
+
+def pre_fork(server, worker):
+    # runs in the master, which knows which slots its live workers hold
+    taken = {getattr(w, 'snowflake_slot', None) for w in server.WORKERS.values()}
+    worker.snowflake_slot = min(set(range(1, SNOWFLAKE_SLOTS)) - taken)
+
+
+def post_fork(server, worker):
+    machine = int(os.environ.get('SNOWFLAKE_MACHINE_ID', 0))
+    os.environ['SNOWFLAKE_WORKER_ID'] = str(machine * SNOWFLAKE_SLOTS + worker.snowflake_slot)
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,162 @@
+"""Per-request SQL instrumentation.
+
+With SQL_INSTRUMENTATION on, every statement run while handling a request
+is timed through SQLAlchemy's engine events, including lazy loads fired from
+templates, and no view needs to change. Each response then carries a
+Server-Timing header:
+
+    Server-Timing: db;dur=12.4;desc="7 queries", app;dur=31.0
+
+Per-endpoint totals (requests, queries, DB time, wall time, worst case)
+are kept in memory for the life of the process; see endpoint_stats().
+
+Statements slower than SLOW_QUERY_MS go to the "warbler.sql.slow" logger
+with the endpoint and the shape of their bind parameters (names and types,
+never values). With SLOW_QUERY_EXPLAIN on, slow SELECTs also log their plan:
+EXPLAIN ANALYZE on Postgres (which runs the query a second time) or
+EXPLAIN QUERY PLAN on SQLite.
+"""
+
+import logging
+import time
+from threading import Lock
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_SLOW_QUERY_MS = 200
+
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+slow_log = logging.getLogger('warbler.sql.slow')
+
+_endpoints = {}
+_lock = Lock()
+
+
+class RequestStats:
+    """Queries and DB time for the request being handled."""
+
+    __slots__ = ('started', 'queries', 'db_time', 'slow_ms', 'explain')
+
+    def __init__(self, slow_ms, explain):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slow_ms = slow_ms
+        self.explain = explain
+
+
+class EndpointStats:
+    """Running totals for one endpoint in this process."""
+
+    __slots__ = ('requests', 'queries', 'db_time', 'total_time', 'max_queries', 'max_time')
+
+    def __init__(self):
+        self.requests = self.queries = self.max_queries = 0
+        self.db_time = self.total_time = self.max_time = 0.0
+
+    def add(self, stats, elapsed):
+        self.requests += 1
+        self.queries += stats.queries
+        self.db_time += stats.db_time
+        self.total_time += elapsed
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def endpoint_stats():
+    """{endpoint: totals} for every endpoint seen by this process."""
+    with _lock:
+        return {endpoint: stats.as_dict() for endpoint, stats in _endpoints.items()}
+
+
+def reset_endpoint_stats():
+    with _lock:
+        _endpoints.clear()
+
+
+def bind_shape(parameters, executemany=False):
+    """Describe bind parameters by name and type, leaving out their values."""
+    if executemany:
+        return f"{len(parameters)} x {bind_shape(parameters[0]) if parameters else '()'}"
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f"{name}: {type(value).__name__}" for name, value in parameters.items()) + '}'
+    return '(' + ', '.join(type(value).__name__ for value in parameters or ()) + ')'
+
+
+def explain(conn, statement, parameters):
+    """The plan for `statement`, from a second cursor on the same connection."""
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name)
+    if prefix is None:
+        return None
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '\n'.join(str(row[-1]) for row in cursor.fetchall())
+    except Exception as e:
+        return f"(EXPLAIN failed: {e})"
+    finally:
+        cursor.close()
+
+
+def _current_stats():
+    return g.get('_sql_stats') if has_request_context() else None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    if _current_stats() is not None:
+        conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats()
+    started = conn.info.get('_query_started')
+    if stats is None or not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    stats.queries += 1
+    stats.db_time += elapsed
+
+    if elapsed * 1000 >= stats.slow_ms:
+        plan = None
+        if stats.explain and statement.lstrip()[:6].upper() == 'SELECT' and not executemany:
+            plan = explain(conn, statement, parameters)
+        slow_log.warning("%.1fms %s: %s %s%s", elapsed * 1000, request.endpoint,
+                         ' '.join(statement.split()), bind_shape(parameters, executemany),
+                         f"\n{plan}" if plan else '')
+
+
+def init_app(app):
+    """Time each request's SQL while app.config['SQL_INSTRUMENTATION'] is on.
+
+    Call this before registering other before_request hooks so their
+    queries are counted too.
+    """
+
+    @app.before_request
+    def start_sql_stats():
+        if app.config.get('SQL_INSTRUMENTATION'):
+            g._sql_stats = RequestStats(app.config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS),
+                                        app.config.get('SLOW_QUERY_EXPLAIN', False))
+
+    @app.after_request
+    def report_sql_stats(response):
+        stats = g.pop('_sql_stats', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        response.headers.add('Server-Timing', f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"')
+        response.headers.add('Server-Timing', f'app;dur={elapsed * 1000:.1f}')
+        with _lock:
+            _endpoints.setdefault(request.endpoint, EndpointStats()).add(stats, elapsed)
+        return response
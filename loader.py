@@ -0,0 +1,327 @@
+"""Streaming bulk loader for seeding Warbler from CSV files.
+
+On Postgres each CSV is streamed into its table with COPY, a chunk of rows
+(and one transaction) at a time, so memory stays flat however large the
+file. For a fresh load, secondary indexes, unique constraints and foreign
+keys are dropped first and rebuilt once the data is in; tables that don't
+depend on each other are loaded in parallel on separate connections.
+
+Append mode adds to an existing database and leaves its indexes in place
+unless asked otherwise. SQLite databases fall back to chunked executemany
+INSERTs. Either way, progress and rows/second go to stdout.
+
+CSV headers name the columns to load; any id columns given are kept, and
+the id sequences are moved past them afterwards. A messages.csv without
+ids gets snowflake ids made from each row's timestamp, so ordering by id
+still orders by time (see message_ids).
+"""
+
+import csv
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import chain
+
+from sqlalchemy import Boolean, DateTime, Integer, text
+
+import migrations
+from models import db
+from snowflake import SEQUENCE_BITS, WORKER_BITS, make_id
+
+CSV_FILES = {
+    'users': 'users.csv',
+    'messages': 'messages.csv',
+    'follows': 'follows.csv',
+    'likes': 'likes.csv',
+    'blocks': 'blocks.csv',
+    'dms': 'direct_messages.csv',
+    'notifications': 'notifications.csv',
+}
+
+# tables in the same stage only reference tables in earlier stages
+LOAD_STAGES = [
+    ['users'],
+    ['messages', 'follows', 'blocks', 'dms', 'notifications'],
+    ['likes'],
+]
+
+DEFAULT_CHUNK_SIZE = 100_000
+DEFAULT_WORKERS = 4
+
+TRUE_STRINGS = {'true', 't', '1', 'yes', 'y'}
+
+
+def report(message):
+    print(message, flush=True)
+
+
+class Progress:
+    """Rows loaded into one table and how fast."""
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def add(self, rows):
+        self.rows += rows
+        report(f"  {self.table:<14} {self.rows:>12,} rows  {self.rows / max(self.elapsed, 1e-9):>10,.0f} rows/s")
+
+    def __str__(self):
+        return (f"{self.table:<14} {self.rows:>12,} rows in {self.elapsed:8.1f}s  "
+                f"{self.rows / max(self.elapsed, 1e-9):>10,.0f} rows/s")
+
+
+def read_chunks(path, chunk_size):
+    """Yield (header, rows) for `path`, chunk_size parsed rows at a time."""
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        chunk = []
+        for row in reader:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield header, chunk
+                chunk = []
+        if chunk:
+            yield header, chunk
+
+
+def check_columns(table, header):
+    unknown = set(header) - set(table.c.keys())
+    if unknown:
+        raise ValueError(f"{table.name}: unknown column(s) in CSV: {', '.join(sorted(unknown))}")
+
+
+def missing_defaults(table, header):
+    """{column: default} for columns absent from the CSV that have a default
+    on the model, which COPY and core inserts would otherwise skip: scalar
+    ones, and callable ones the database has no default of its own for
+    (messages.id's next_id, for a messages.csv without timestamps either)."""
+    return {column.name: column.default for column in table.c
+            if column.name not in header and column.default is not None
+            and (column.default.is_scalar or (column.default.is_callable and column.server_default is None))}
+
+
+def default_values(defaults):
+    """One row's values for `defaults`, calling the callable ones."""
+    # SQLAlchemy wraps a no-argument default to take the execution context
+    return {name: default.arg(None) if default.is_callable else default.arg
+            for name, default in defaults.items()}
+
+
+def message_ids(table, header, rows, first_row):
+    """(header, rows) with an id added to messages rows that have a
+    timestamp but no id: the timestamp's millisecond, as revision 0002
+    numbered old messages, with the row's number in the file in the lower
+    (worker and sequence) bits so rows from the same millisecond differ.
+    Timestamps before snowflake.EPOCH give negative ids."""
+    if table.name != 'messages' or 'id' in header or 'timestamp' not in header:
+        return header, rows
+    column = header.index('timestamp')
+    low_bits = 1 << (WORKER_BITS + SEQUENCE_BITS)
+    ids = [make_id(datetime.fromisoformat(row[column]), *divmod(number % low_bits, 1 << SEQUENCE_BITS))
+           for number, row in enumerate(rows, first_row)]
+    return header + ['id'], [row + [str(message_id)] for row, message_id in zip(rows, ids)]
+
+
+def _copy_text(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def copy_csv(engine, table, path, chunk_size):
+    """COPY `path` into `table` one chunk (and one commit) at a time."""
+    progress = Progress(table.name)
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for header, rows in read_chunks(path, chunk_size):
+            check_columns(table, header)
+            header, rows = message_ids(table, header, rows, progress.rows)
+            defaults = missing_defaults(table, header)
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(row + [_copy_text(value) for value in default_values(defaults).values()]
+                                         for row in rows)
+            buffer.seek(0)
+            columns = ', '.join(f'"{name}"' for name in header + list(defaults))
+            cursor.copy_expert(f'COPY "{table.name}" ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+            connection.commit()
+            progress.add(len(rows))
+    finally:
+        connection.close()
+    return progress
+
+
+def _coercer(column):
+    """Turn a CSV string into what `column`'s type wants; '' means NULL."""
+    # with_variant() types wrap the generic one
+    column_type = getattr(column.type, 'impl', column.type)
+    if isinstance(column_type, Boolean):
+        convert = lambda value: value.strip().lower() in TRUE_STRINGS
+    elif isinstance(column_type, DateTime):
+        convert = datetime.fromisoformat
+    elif isinstance(column_type, Integer):
+        convert = int
+    else:
+        return lambda value: value
+    return lambda value: convert(value) if value != '' else None
+
+
+def insert_csv(engine, table, path, chunk_size):
+    """executemany INSERT `path` into `table` a chunk at a time (for SQLite)."""
+    progress = Progress(table.name)
+    for header, rows in read_chunks(path, chunk_size):
+        check_columns(table, header)
+        header, rows = message_ids(table, header, rows, progress.rows)
+        coercers = [_coercer(table.c[name]) for name in header]
+        defaults = missing_defaults(table, header)
+        records = [{**default_values(defaults),
+                    **{name: coerce(value) for name, coerce, value in zip(header, coercers, row)}}
+                   for row in rows]
+        with engine.begin() as connection:
+            connection.execute(table.insert(), records)
+        progress.add(len(rows))
+    return progress
+
+
+def deferred_schema(connection, tables):
+    """Return (drops, creates): DDL that removes and rebuilds the secondary
+    indexes, unique constraints and foreign keys of `tables` (Postgres)."""
+    names = list(tables)
+    constraints = connection.execute(text(
+        "SELECT c.conrelid::regclass::text, c.conname, c.contype, pg_get_constraintdef(c.oid) "
+        "FROM pg_constraint c JOIN pg_class t ON t.oid = c.conrelid "
+        "WHERE t.relname = ANY(:names) AND c.contype IN ('f', 'u') "
+        "AND t.relnamespace = current_schema()::regnamespace"), names=names).fetchall()
+    indexes = connection.execute(text(
+        "SELECT i.indexname, i.indexdef FROM pg_indexes i "
+        "WHERE i.schemaname = current_schema() AND i.tablename = ANY(:names) "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conname = i.indexname)"),
+        names=names).fetchall()
+
+    foreign_keys = [(table, name, definition) for table, name, kind, definition in constraints if kind == 'f']
+    uniques = [(table, name, definition) for table, name, kind, definition in constraints if kind == 'u']
+    drops = ([f'ALTER TABLE {table} DROP CONSTRAINT "{name}"' for table, name, _ in foreign_keys]
+             + [f'ALTER TABLE {table} DROP CONSTRAINT "{name}"' for table, name, _ in uniques]
+             + [f'DROP INDEX "{name}"' for name, _ in indexes])
+    # indexes first so the foreign keys can be validated against them
+    creates = ([[f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}' for table, name, definition in uniques]
+                + [definition for _, definition in indexes]]
+               + [[f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}' for table, name, definition in foreign_keys]])
+    return drops, creates
+
+
+def run_parallel(engine, statements, workers):
+    """Run independent DDL statements, each in its own transaction."""
+
+    def run(statement):
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            connection.execute(text(statement))
+        report(f"  {time.perf_counter() - started:6.1f}s  {statement[:100]}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run, statements))
+
+
+def rebuild_schema(engine, creates, workers):
+    """Run the `creates` from deferred_schema, one stage after another."""
+    for statements in creates:
+        run_parallel(engine, statements, workers)
+
+
+def reset_sequences(connection, tables):
+    """Move each serial id sequence past the largest id now in its table."""
+    for table in tables:
+        if 'id' not in table.c:
+            continue
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"coalesce((SELECT max(id) FROM \"{table.name}\"), 0) + 1, false)"))
+
+
+def load_csvs(directory, append=False, drop_indexes=None, workers=DEFAULT_WORKERS,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+    """Load every known CSV in `directory` into its table.
+
+    Unless `append`, the schema is dropped and recreated first. Secondary
+    indexes and constraints are dropped during the load when `drop_indexes`
+    (by default: when not appending); if the load fails they're rebuilt as
+    far as the partial data allows, and the load's error is raised.
+    Returns {table name: rows loaded}.
+    """
+    engine = db.get_engine()
+    postgres = engine.dialect.name == 'postgresql'
+    if drop_indexes is None:
+        drop_indexes = not append
+
+    if not append:
+        db.drop_all()
+        db.create_all()
+        # the models already declare everything the migrations add
+        migrations.stamp(engine)
+
+    tables = {name: db.metadata.tables[name] for name, filename in CSV_FILES.items()
+              if os.path.exists(os.path.join(directory, filename))}
+    load_one = copy_csv if postgres else insert_csv
+    started = time.perf_counter()
+    results = []
+
+    creates = []
+    if postgres and drop_indexes:
+        with engine.begin() as connection:
+            drops, creates = deferred_schema(connection, tables)
+            for statement in drops:
+                connection.execute(text(statement))
+        report(f"dropped {len(drops)} indexes and constraints")
+
+    try:
+        for stage in LOAD_STAGES:
+            jobs = [(load_one, engine, tables[name], os.path.join(directory, CSV_FILES[name]), chunk_size)
+                    for name in stage if name in tables]
+            if postgres:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    results.extend(pool.map(lambda job: job[0](*job[1:]), jobs))
+            else:
+                # SQLite has one writer at a time, and its connections
+                # belong to the thread that opened them
+                results.extend(job[0](*job[1:]) for job in jobs)
+    except BaseException:
+        if creates:
+            # put back what we can, but the load's error is the one to raise:
+            # partial data may well break a foreign key too
+            report("load failed; rebuilding indexes and constraints")
+            try:
+                rebuild_schema(engine, creates, workers)
+            except Exception as error:
+                report(f"couldn't rebuild them ({error}); the statements were:")
+                for statement in chain.from_iterable(creates):
+                    report(f"  {statement};")
+        raise
+
+    if creates:
+        report("rebuilding indexes and constraints")
+        rebuild_schema(engine, creates, workers)
+
+    if postgres:
+        with engine.begin() as connection:
+            reset_sequences(connection, tables.values())
+            for table in tables.values():
+                connection.execute(text(f'ANALYZE "{table.name}"'))
+
+    for progress in results:
+        report(str(progress))
+    total = sum(progress.rows for progress in results)
+    elapsed = time.perf_counter() - started
+    report(f"{'total':<14} {total:>12,} rows in {elapsed:8.1f}s  {total / max(elapsed, 1e-9):>10,.0f} rows/s")
+    return {progress.table: progress.rows for progress in results}
@@ -0,0 +1,145 @@
+"""Prometheus metrics for Warbler, served in text format at /metrics.
+
+Recorded:
+
+- warbler_request_duration_seconds: request latency histogram by endpoint
+  and method, plus warbler_requests_total by endpoint and status code
+- warbler_template_render_seconds: render time by template
+- warbler_db_pool_checkout_wait_seconds: time spent waiting for a pooled
+  connection (Postgres; SQLite keeps its own pool), and
+  warbler_db_pool_checked_out: connections in use right now (ones detached
+  from the pool, like events.py's LISTEN connection, stop counting)
+- warbler_cache_lookups_total: hits and misses of the in-process caches
+
+Under gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a
+shared directory. prometheus_client then keeps each worker's values in
+mmap'd files there, and /metrics adds them up across workers. Without it
+(flask run, tests) values stay in memory.
+
+Label children are looked up once and kept, so recording costs a dict hit
+plus prometheus_client's own update; benchmarks/bench_metrics.py measures it.
+Set METRICS_TOKEN to require "Authorization: Bearer <token>" on /metrics.
+"""
+
+import os
+import time
+
+from flask import Response, abort, before_render_template, g, request, template_rendered
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.pool import Pool, QueuePool
+
+REQUEST_LATENCY = Histogram(
+    'warbler_request_duration_seconds', 'Time to handle a request, by endpoint.',
+    ['endpoint', 'method'])
+REQUESTS = Counter(
+    'warbler_requests_total', 'Responses sent, by endpoint and status code.',
+    ['endpoint', 'status'])
+TEMPLATE_RENDER = Histogram(
+    'warbler_template_render_seconds', 'Time to render a template.',
+    ['template'], buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+POOL_WAIT = Histogram(
+    'warbler_db_pool_checkout_wait_seconds', 'Time spent getting a database connection from the pool.',
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 30))
+POOL_CHECKED_OUT = Gauge(
+    'warbler_db_pool_checked_out', 'Database connections currently checked out.',
+    multiprocess_mode='livesum')
+CACHE_LOOKUPS = Counter(
+    'warbler_cache_lookups_total', 'In-process cache lookups, by cache and result.',
+    ['cache', 'result'])
+
+_children = {}
+
+
+def _child(metric, *labels):
+    """metric.labels(*labels), memoized: labels() is the slow part of recording."""
+    key = (metric, labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*labels)
+    return child
+
+
+def record_cache(cache, hit):
+    """Count a hit or miss of one of the in-process caches."""
+    _child(CACHE_LOOKUPS, cache, 'hit' if hit else 'miss').inc()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started)
+
+
+@event.listens_for(Pool, 'checkout')
+def _connection_checked_out(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKED_OUT.inc()
+
+
+@event.listens_for(Pool, 'checkin')
+def _connection_checked_in(dbapi_connection, connection_record):
+    POOL_CHECKED_OUT.dec()
+
+
+@event.listens_for(Pool, 'detach')
+def _connection_detached(dbapi_connection, connection_record):
+    # a detached connection is never checked back in
+    POOL_CHECKED_OUT.dec()
+
+
+def registry():
+    """The registry to expose: every worker's files under gunicorn, else this process."""
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+def init_app(app):
+    """Record request and template metrics for `app` and serve /metrics.
+
+    Call this before the database is first used (so Postgres gets the timed
+    pool) and before other before_request hooks (so they're timed too).
+    """
+
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {}).setdefault('poolclass', TimedQueuePool)
+
+    @app.before_request
+    def start_request_timer():
+        g._request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('_request_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'none'
+            _child(REQUEST_LATENCY, endpoint, request.method).observe(time.perf_counter() - started)
+            _child(REQUESTS, endpoint, str(response.status_code)).inc()
+        return response
+
+    def start_render(sender, template, context, **extra):
+        g.setdefault('_renders', []).append(time.perf_counter())
+
+    def finish_render(sender, template, context, **extra):
+        renders = g.get('_renders')
+        if renders:
+            _child(TEMPLATE_RENDER, template.name or 'string').observe(time.perf_counter() - renders.pop())
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
+
+    @app.route('/metrics')
+    def metrics():
+        """Prometheus text exposition of every metric."""
+        token = app.config.get('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f"Bearer {token}":
+            abort(401)
+        return Response(generate_latest(registry()), mimetype=CONTENT_TYPE_LATEST)
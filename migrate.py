@@ -0,0 +1,37 @@
+"""Apply or revert schema migrations (see migrations/).
+
+    python migrate.py                   # upgrade to the latest revision
+    python migrate.py upgrade 0001      # ...or to a given one
+    python migrate.py downgrade 0001    # revert everything after 0001
+    python migrate.py downgrade base    # ...or everything
+    python migrate.py stamp             # mark as migrated without running anything
+    python migrate.py status
+"""
+
+import argparse
+
+from app import db
+import migrations
+
+parser = argparse.ArgumentParser(description="Apply or revert Warbler schema migrations.")
+parser.add_argument('command', nargs='?', default='upgrade', choices=['upgrade', 'downgrade', 'stamp', 'status'])
+parser.add_argument('revision', nargs='?', help="target revision (downgrade: the one to keep)")
+args = parser.parse_args()
+
+engine = db.engine
+
+if args.command == 'upgrade':
+    if not migrations.upgrade(engine, args.revision):
+        print("already up to date")
+elif args.command == 'downgrade':
+    if args.revision is None:
+        parser.error("downgrade needs the revision to go back to (base for none)")
+    migrations.downgrade(engine, None if args.revision == 'base' else args.revision)
+elif args.command == 'stamp':
+    migrations.stamp(engine, args.revision)
+
+with engine.begin() as connection:
+    done = migrations.applied(connection)
+for revision in migrations.revisions():
+    mark = '*' if revision.revision in done else ' '
+    print(f"{mark} {revision.revision}  {revision.description}")
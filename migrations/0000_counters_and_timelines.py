@@ -0,0 +1,63 @@
+"""User counters and materialized home timelines.
+
+Databases made before migrations existed have neither, and later
+revisions rely on both (0001 recounts likes_count, 0002 renumbers
+timeline_entries), so this comes first. It adds, where missing:
+
+- users.message_count, follower_count, following_count and likes_count,
+  filled in by models.recount_counters()
+- timeline_entries, as 0002 expects to find it (integer message ids, no
+  timestamp copy), filled in by timelines.rebuild_all_timelines()
+
+The search indexes are 0004's.
+
+The backfills go through the app's session and commit per batch, so the
+DDL runs outside a transaction: on Postgres an open ALTER TABLE would hold
+the lock the backfill's own connection waits for.
+"""
+
+from sqlalchemy import Column, ForeignKey, Index, Integer, MetaData, Table, inspect, text
+
+from models import db, recount_counters
+from timelines import rebuild_all_timelines
+
+transactional = False
+
+COUNTERS = ['message_count', 'follower_count', 'following_count', 'likes_count']
+
+metadata = MetaData()
+timeline_entries = Table(
+    'timeline_entries', metadata,
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+    Column('message_id', Integer, ForeignKey('messages.id', ondelete='cascade'), primary_key=True),
+    Column('author_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+    Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+)
+# only so the foreign keys above resolve; never created here
+Table('users', metadata, Column('id', Integer, primary_key=True))
+Table('messages', metadata, Column('id', Integer, primary_key=True))
+
+
+def upgrade(connection):
+    existing = {c['name'] for c in inspect(connection).get_columns('users')}
+    added = [name for name in COUNTERS if name not in existing]
+    for name in added:
+        connection.execute(text(f'ALTER TABLE users ADD COLUMN {name} INTEGER NOT NULL DEFAULT 0'))
+
+    new_timelines = 'timeline_entries' not in inspect(connection).get_table_names()
+    if new_timelines:
+        timeline_entries.create(connection)
+
+    if added:
+        recount_counters()
+    if new_timelines:
+        rebuild_all_timelines()
+    db.session.remove()
+
+
+def downgrade(connection):
+    timeline_entries.drop(connection, checkfirst=True)
+    existing = {c['name'] for c in inspect(connection).get_columns('users')}
+    for name in COUNTERS:
+        if name in existing:
+            connection.execute(text(f'ALTER TABLE users DROP COLUMN {name}'))
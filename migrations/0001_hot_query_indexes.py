@@ -0,0 +1,95 @@
+"""Index the hot queries; unique likes and blocks.
+
+Adds, where missing:
+
+- messages (user_id, timestamp, id): profile pages and the keyset cursor
+- follows (user_following_id, user_being_followed_id): who a user follows
+  (the primary key only serves the other direction)
+- likes (message_id), plus UNIQUE (user_id, message_id), which also serves
+  a user's likes
+- blocks UNIQUE (user, blocked_user)
+- dms (dm_to), and dms (dm_to) WHERE is_new for the unread badge
+- notifications (to_id)
+
+Duplicate likes and blocks are removed first (keeping the oldest) so the
+unique constraints can be built, and likes_count is corrected for users
+who lose a duplicate like. On Postgres the indexes are built CONCURRENTLY,
+so writes carry on during the build; the unique constraints are then
+attached to their finished indexes.
+"""
+
+from sqlalchemy import text
+
+from migrations import create_index
+
+transactional = False
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages', 'user_id, timestamp, id', None),
+    ('ix_follows_user_following_id', 'follows', 'user_following_id, user_being_followed_id', None),
+    ('ix_likes_message_id', 'likes', 'message_id', None),
+    ('ix_dms_dm_to', 'dms', 'dm_to', None),
+    ('ix_dms_dm_to_unread', 'dms', 'dm_to', 'is_new'),
+    ('ix_notifications_to_id', 'notifications', 'to_id', None),
+]
+
+UNIQUES = [
+    ('uq_likes_user_id_message_id', 'likes', 'user_id, message_id'),
+    ('uq_blocks_user_blocked_user', 'blocks', '"user", blocked_user'),
+]
+
+
+def postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def remove_duplicate_likes(connection):
+    """Delete all but the oldest of each (user, message) like and recount
+    the likes of the users affected."""
+    users = [row.user_id for row in connection.execute(text(
+        "SELECT DISTINCT user_id FROM likes "
+        "WHERE user_id IS NOT NULL AND message_id IS NOT NULL "
+        "GROUP BY user_id, message_id HAVING count(*) > 1"))]
+    if not users:
+        return
+    connection.execute(text(
+        "DELETE FROM likes WHERE user_id IS NOT NULL AND message_id IS NOT NULL "
+        "AND id NOT IN (SELECT min(id) FROM likes GROUP BY user_id, message_id)"))
+    for user_id in users:
+        connection.execute(text(
+            "UPDATE users SET likes_count = (SELECT count(*) FROM likes WHERE user_id = :id) "
+            "WHERE id = :id"), id=user_id)
+
+
+def remove_duplicate_blocks(connection):
+    connection.execute(text(
+        'DELETE FROM blocks WHERE id NOT IN (SELECT min(id) FROM blocks GROUP BY "user", blocked_user)'))
+
+
+def upgrade(connection):
+    remove_duplicate_likes(connection)
+    remove_duplicate_blocks(connection)
+
+    for name, table, columns, where in INDEXES:
+        create_index(connection, name, table, columns, where)
+
+    for name, table, columns in UNIQUES:
+        create_index(connection, name, table, columns, unique=True)
+        if postgres(connection):
+            exists = connection.execute(text(
+                "SELECT 1 FROM pg_constraint WHERE conname = :name "
+                "AND connamespace = current_schema()::regnamespace"), name=name).scalar()
+            if not exists:
+                connection.execute(text(f'ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE USING INDEX {name}'))
+
+
+def downgrade(connection):
+    for name, table, _ in UNIQUES:
+        if postgres(connection):
+            connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}'))
+        else:
+            connection.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+    concurrently = ' CONCURRENTLY' if postgres(connection) else ''
+    for name, _, _, _ in INDEXES:
+        connection.execute(text(f'DROP INDEX{concurrently} IF EXISTS {name}'))
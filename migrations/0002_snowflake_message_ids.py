@@ -0,0 +1,148 @@
+"""Time-ordered message ids; server-side timestamps.
+
+Messages get snowflake ids (see snowflake.py), so timelines page on the
+primary key:
+
+- messages.id and the columns referencing it become BIGINT, and
+  messages.id loses its sequence (the app assigns ids)
+- existing messages are renumbered in their current id order, which is the
+  order they were written in, with each id's time taken from the message's
+  timestamp where that keeps ids increasing; likes and timeline entries
+  follow them
+- profile and timeline indexes move from (…, timestamp, id) to the id,
+  and timeline_entries drops its timestamp copy
+- messages, dms and notifications default their timestamp to the
+  database's UTC time
+
+Timestamps written before this (which were all the worker's start time)
+can't be recovered and are left alone.
+
+Renumbering happens in one transaction and rewrites the three tables.
+"""
+
+from sqlalchemy import BigInteger, DateTime, inspect, text
+
+from snowflake import MAX_SEQUENCE, TIME_SHIFT, make_id
+
+BATCH_SIZE = 10000
+
+# (table, column) holding a message id, besides messages.id
+MESSAGE_ID_REFERENCES = [('likes', 'message_id'), ('timeline_entries', 'message_id')]
+
+TIMESTAMP_COLUMNS = [('messages', 'timestamp'), ('dms', 'timestamp'), ('notifications', 'date')]
+
+
+def postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def renumber(old_ids_and_times):
+    """Yield (old id, new id) for (id, timestamp) rows in id order.
+
+    New ids keep the old order: each takes its timestamp's millisecond
+    unless that would go backwards, and once a millisecond's 4096 sequence
+    numbers are used up the next id moves on to the next millisecond. The
+    worker id is 0, the one kept for one-off processes.
+    """
+    last = 0
+    for old_id, timestamp in old_ids_and_times:
+        if last & MAX_SEQUENCE < MAX_SEQUENCE:
+            following = last + 1
+        else:
+            following = ((last >> TIME_SHIFT) + 1) << TIME_SHIFT
+        last = max(make_id(timestamp), following)
+        yield old_id, last
+
+
+def foreign_keys(connection):
+    """(table, name, definition) of the foreign keys onto messages.id."""
+    return connection.execute(text(
+        "SELECT c.conrelid::regclass::text, c.conname, pg_get_constraintdef(c.oid) "
+        "FROM pg_constraint c "
+        "WHERE c.contype = 'f' AND c.confrelid = 'messages'::regclass")).fetchall()
+
+
+def upgrade(connection):
+    if postgres(connection):
+        keys = foreign_keys(connection)
+        for table, name, _ in keys:
+            connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+        connection.execute(text('ALTER TABLE messages ALTER COLUMN id DROP DEFAULT'))
+        connection.execute(text('DROP SEQUENCE IF EXISTS messages_id_seq'))
+        connection.execute(text('ALTER TABLE messages ALTER COLUMN id TYPE BIGINT'))
+        for table, column in MESSAGE_ID_REFERENCES:
+            connection.execute(text(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT'))
+        for table, column in TIMESTAMP_COLUMNS:
+            connection.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} "
+                                    f"SET DEFAULT TIMEZONE('utc', CURRENT_TIMESTAMP)"))
+        connection.execute(text('CREATE TEMPORARY TABLE message_renumbering '
+                                '(old_id BIGINT PRIMARY KEY, new_id BIGINT NOT NULL) ON COMMIT DROP'))
+    else:
+        # SQLite's INTEGER is already 64-bit, and it doesn't enforce foreign
+        # keys unless asked to; column defaults can't be altered there
+        connection.execute(text('CREATE TEMPORARY TABLE message_renumbering '
+                                '(old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)'))
+
+    rows = connection.execute(text('SELECT id, timestamp FROM messages ORDER BY id')
+                              .columns(id=BigInteger, timestamp=DateTime))
+    mapping = renumber(rows)
+    while True:
+        batch = [{'old_id': old, 'new_id': new} for old, new in _take(mapping, BATCH_SIZE)]
+        if not batch:
+            break
+        connection.execute(text('INSERT INTO message_renumbering (old_id, new_id) '
+                                'VALUES (:old_id, :new_id)'), batch)
+
+    # a new id may be some other message's old one, so go through negative
+    # ids first to keep messages.id unique at every step
+    for table, column in [('messages', 'id')] + MESSAGE_ID_REFERENCES:
+        connection.execute(text(f"UPDATE {table} SET {column} = -{column}"))
+        connection.execute(text(
+            f"UPDATE {table} SET {column} = (SELECT new_id FROM message_renumbering "
+            f"WHERE old_id = -{table}.{column})"))
+    connection.execute(text('DROP TABLE IF EXISTS message_renumbering'))
+
+    if postgres(connection):
+        for table, name, definition in keys:
+            connection.execute(text(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'))
+    elif 'messages_fts' in inspect(connection).get_table_names():
+        connection.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_user_id_id ON messages (user_id, id)'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_messages_user_id_timestamp'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_timeline_entries_user_timestamp'))
+    if 'timestamp' in {c['name'] for c in inspect(connection).get_columns('timeline_entries')}:
+        connection.execute(text('ALTER TABLE timeline_entries DROP COLUMN timestamp'))
+
+
+def downgrade(connection):
+    """Put back the timestamp indexes and a sequence for messages.id.
+
+    Ids stay as they are; they're still valid, increasing integers.
+    """
+    connection.execute(text('ALTER TABLE timeline_entries ADD COLUMN timestamp TIMESTAMP'))
+    connection.execute(text('UPDATE timeline_entries SET timestamp = '
+                            '(SELECT timestamp FROM messages WHERE messages.id = timeline_entries.message_id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_timestamp '
+                            'ON timeline_entries (user_id, timestamp, message_id)'))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp '
+                            'ON messages (user_id, timestamp, id)'))
+    connection.execute(text('DROP INDEX IF EXISTS ix_messages_user_id_id'))
+
+    if postgres(connection):
+        connection.execute(text('ALTER TABLE timeline_entries ALTER COLUMN timestamp SET NOT NULL'))
+        connection.execute(text('CREATE SEQUENCE messages_id_seq OWNED BY messages.id'))
+        connection.execute(text("SELECT setval('messages_id_seq', coalesce((SELECT max(id) FROM messages), 0) + 1, false)"))
+        connection.execute(text("ALTER TABLE messages ALTER COLUMN id SET DEFAULT nextval('messages_id_seq')"))
+        for table, column in TIMESTAMP_COLUMNS:
+            connection.execute(text(f'ALTER TABLE {table} ALTER COLUMN {column} DROP DEFAULT'))
+
+
+def _take(iterator, n):
+    """Up to the next `n` items of `iterator`."""
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == n:
+            break
+    return batch
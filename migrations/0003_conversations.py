@@ -0,0 +1,65 @@
+"""DM conversations with an inbox summary per pair of users.
+
+Creates conversations (one row per pair, lower user id first, with the
+latest DM's preview, time and sender and each side's unread count) and
+dms.conversation_id, then fills both in from the DMs already there.
+"""
+
+from sqlalchemy import (Column, DateTime, ForeignKey, Index, Integer, MetaData, String, Table,
+                        UniqueConstraint, inspect, text)
+
+metadata = MetaData()
+conversations = Table(
+    'conversations', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_low_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+    Column('user_high_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+    Column('last_message_at', DateTime, nullable=False),
+    Column('last_message_preview', String(280), nullable=False),
+    Column('last_sender_id', Integer, nullable=False),
+    Column('low_unread', Integer, nullable=False, server_default='0'),
+    Column('high_unread', Integer, nullable=False, server_default='0'),
+    UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversations_users'),
+    Index('ix_conversations_low_last', 'user_low_id', 'last_message_at', 'id'),
+    Index('ix_conversations_high_last', 'user_high_id', 'last_message_at', 'id'),
+)
+# only so the foreign keys above resolve; never created here
+Table('users', metadata, Column('id', Integer, primary_key=True))
+
+LOW = "CASE WHEN dm_from <= dm_to THEN dm_from ELSE dm_to END"
+HIGH = "CASE WHEN dm_from <= dm_to THEN dm_to ELSE dm_from END"
+
+
+def upgrade(connection):
+    conversations.create(connection, checkfirst=True)
+    if 'conversation_id' not in {c['name'] for c in inspect(connection).get_columns('dms')}:
+        connection.execute(text('ALTER TABLE dms ADD COLUMN conversation_id INTEGER '
+                                'REFERENCES conversations (id) ON DELETE CASCADE'))
+
+    connection.execute(text(f"""
+        INSERT INTO conversations (user_low_id, user_high_id, last_message_at, last_message_preview,
+                                   last_sender_id, low_unread, high_unread)
+        SELECT pairs.low, pairs.high, dms.timestamp, dms.message_text, dms.dm_from,
+               pairs.low_unread, pairs.high_unread
+        FROM (SELECT {LOW} AS low, {HIGH} AS high, max(id) AS latest,
+                     sum(CASE WHEN is_new AND dm_to = {LOW} THEN 1 ELSE 0 END) AS low_unread,
+                     sum(CASE WHEN is_new AND dm_to <> {LOW} THEN 1 ELSE 0 END) AS high_unread
+              FROM dms GROUP BY {LOW}, {HIGH}) AS pairs
+        JOIN dms ON dms.id = pairs.latest
+    """))
+    connection.execute(text(f"""
+        UPDATE dms SET conversation_id = (
+            SELECT id FROM conversations
+            WHERE user_low_id = {LOW} AND user_high_id = {HIGH})
+    """))
+    connection.execute(text('CREATE INDEX IF NOT EXISTS ix_dms_conversation_id ON dms (conversation_id, id)'))
+
+
+def downgrade(connection):
+    connection.execute(text('DROP INDEX IF EXISTS ix_dms_conversation_id'))
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('ALTER TABLE dms DROP COLUMN conversation_id'))
+    else:
+        # SQLite can't drop a column with a foreign key; leave it empty
+        connection.execute(text('UPDATE dms SET conversation_id = NULL'))
+    conversations.drop(connection, checkfirst=True)
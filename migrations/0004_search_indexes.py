@@ -0,0 +1,81 @@
+"""Search indexes for databases made before search.
+
+db.create_all() only builds search.py's indexes alongside a new table, so
+this adds them to existing databases, where missing:
+
+- Postgres: the pg_trgm extension, the trigram index over username,
+  location and bio, the lower(username) prefix index, and the GIN index
+  on to_tsvector('english', messages.text), all built CONCURRENTLY
+- SQLite: the users_fts and messages_fts tables and the triggers keeping
+  them in step, filled from their tables. The users update trigger only
+  fires for the indexed columns, and one made before that is replaced.
+
+The definitions are copied from search.py as it stood, so this revision
+doesn't change meaning when search.py does.
+"""
+
+from sqlalchemy import text
+
+from migrations import create_index
+
+transactional = False
+
+USER_DOCUMENT = "(username || ' ' || coalesce(location, '') || ' ' || coalesce(bio, ''))"
+
+SQLITE_USERS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, location, bio, content='users', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, location, bio) "
+    "VALUES (new.id, new.username, new.location, new.bio); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, location, bio) "
+    "VALUES ('delete', old.id, old.username, old.location, old.bio); END",
+    "DROP TRIGGER IF EXISTS users_fts_au",
+    "CREATE TRIGGER users_fts_au AFTER UPDATE OF username, location, bio ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, location, bio) "
+    "VALUES ('delete', old.id, old.username, old.location, old.bio); "
+    "INSERT INTO users_fts(rowid, username, location, bio) "
+    "VALUES (new.id, new.username, new.location, new.bio); END",
+    "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+]
+
+SQLITE_MESSAGES_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, content='messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+
+
+def postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def upgrade(connection):
+    if postgres(connection):
+        connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        create_index(connection, 'ix_users_search_trgm', 'users', f'{USER_DOCUMENT} gin_trgm_ops', using='gin')
+        create_index(connection, 'ix_users_username_prefix', 'users', 'lower(username) text_pattern_ops')
+        create_index(connection, 'ix_messages_text_fts', 'messages', "to_tsvector('english', text)", using='gin')
+    else:
+        for statement in SQLITE_USERS_DDL + SQLITE_MESSAGES_DDL:
+            connection.execute(text(statement))
+
+
+def downgrade(connection):
+    """Drop the indexes; pg_trgm stays, as something else may use it."""
+    if postgres(connection):
+        for name in ('ix_users_search_trgm', 'ix_users_username_prefix', 'ix_messages_text_fts'):
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+    else:
+        for table in ('users', 'messages'):
+            for trigger in ('ai', 'ad', 'au'):
+                connection.execute(text(f'DROP TRIGGER IF EXISTS {table}_fts_{trigger}'))
+            connection.execute(text(f'DROP TABLE IF EXISTS {table}_fts'))
@@ -0,0 +1,195 @@
+"""Schema migrations for Warbler.
+
+db.create_all() only creates tables that are missing, so changes to
+existing tables (new indexes, constraints, columns) ship as revisions:
+modules in this directory named NNNN_description.py. Each defines
+
+    upgrade(connection)
+    downgrade(connection)
+
+and may set `transactional = False` to run outside a transaction (needed
+for CREATE INDEX CONCURRENTLY on Postgres); otherwise a revision and its
+bookkeeping commit or roll back together. Applied revisions are recorded
+in the schema_migrations table. migrate.py is the command line front end.
+
+A database built from the current models with db.create_all() already has
+everything the revisions add, so it is stamped at the latest revision
+rather than migrated.
+
+create_index() is shared by revisions that add indexes to big tables.
+"""
+
+import importlib.util
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, Text, text
+
+MIGRATIONS_DIR = os.path.dirname(os.path.abspath(__file__))
+REVISION_FILE_RE = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+# kept out of db.metadata so drop_all() doesn't forget what was applied
+# behind its back; stamp() after create_all() resets it instead
+metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('revision', String(16), primary_key=True),
+    Column('description', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class MigrationError(Exception):
+    """Raised for an unknown revision or an applied one that's gone missing."""
+
+
+class Revision:
+    """One revision module."""
+
+    def __init__(self, path):
+        self.path = path
+        self.revision, name = REVISION_FILE_RE.match(os.path.basename(path)).groups()
+        spec = importlib.util.spec_from_file_location(f'migrations.r{self.revision}_{name}', path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+        self.description = (self.module.__doc__ or name).strip().splitlines()[0]
+        self.transactional = getattr(self.module, 'transactional', True)
+
+    def __repr__(self):
+        return f"<Revision {self.revision}: {self.description}>"
+
+
+def create_index(connection, name, table, columns, where=None, unique=False, using=None):
+    """CREATE INDEX IF NOT EXISTS, concurrently on Postgres (so from a
+    revision with `transactional = False`).
+
+    A failed concurrent build leaves an invalid index behind that IF NOT
+    EXISTS would skip, so one of those is dropped and built again.
+    """
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    method = f' USING {using}' if using else ''
+    condition = f' WHERE {where}' if where else ''
+    if connection.dialect.name != 'postgresql':
+        connection.execute(text(f'CREATE {kind} IF NOT EXISTS {name} ON {table}{method} ({columns}){condition}'))
+        return
+    invalid = connection.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND c.relnamespace = current_schema()::regnamespace "
+        "AND NOT i.indisvalid"), name=name).scalar()
+    if invalid:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY {name}'))
+    connection.execute(text(f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table}{method} ({columns}){condition}'))
+
+
+def revisions(directory=MIGRATIONS_DIR):
+    """Every revision in `directory`, oldest first."""
+    return [Revision(os.path.join(directory, filename))
+            for filename in sorted(os.listdir(directory))
+            if REVISION_FILE_RE.match(filename)]
+
+
+def applied(connection):
+    """The set of revisions recorded as applied."""
+    schema_migrations.create(connection, checkfirst=True)
+    return {row.revision for row in connection.execute(schema_migrations.select())}
+
+
+def current(engine):
+    """The newest applied revision, or None for an unmigrated database."""
+    with engine.begin() as connection:
+        done = applied(connection)
+    return max(done) if done else None
+
+
+def _check_target(all_revisions, target):
+    if target is not None and target not in {r.revision for r in all_revisions}:
+        raise MigrationError(f"no revision {target}")
+
+
+def _run(engine, revision, step):
+    """Run revision.upgrade / downgrade and record that it did."""
+
+    def record(connection):
+        if step == 'upgrade':
+            connection.execute(schema_migrations.insert().values(
+                revision=revision.revision, description=revision.description,
+                applied_at=datetime.utcnow()))
+        else:
+            connection.execute(schema_migrations.delete()
+                               .where(schema_migrations.c.revision == revision.revision))
+
+    if revision.transactional:
+        with engine.begin() as connection:
+            getattr(revision.module, step)(connection)
+            record(connection)
+    else:
+        with engine.connect() as connection:
+            # pysqlite has no AUTOCOMMIT level in the pinned SQLAlchemy; a
+            # connection outside begin() commits each statement there anyway
+            if engine.dialect.name == 'postgresql':
+                connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            getattr(revision.module, step)(connection)
+        with engine.begin() as connection:
+            record(connection)
+
+
+def upgrade(engine, target=None, log=print):
+    """Apply every revision up to `target` (default: the latest) that
+    hasn't been applied yet. Returns the revisions applied."""
+
+    all_revisions = revisions()
+    _check_target(all_revisions, target)
+    with engine.begin() as connection:
+        done = applied(connection)
+
+    ran = []
+    for revision in all_revisions:
+        if target is not None and revision.revision > target:
+            break
+        if revision.revision in done:
+            continue
+        log(f"upgrade {revision.revision}: {revision.description}")
+        _run(engine, revision, 'upgrade')
+        ran.append(revision)
+    return ran
+
+
+def downgrade(engine, target, log=print):
+    """Revert applied revisions newer than `target`, newest first; a target
+    of None reverts them all. Returns the revisions reverted."""
+
+    all_revisions = revisions()
+    _check_target(all_revisions, target)
+    with engine.begin() as connection:
+        done = applied(connection)
+    missing = done - {r.revision for r in all_revisions}
+    if missing:
+        raise MigrationError(f"applied revisions not found in {MIGRATIONS_DIR}: {', '.join(sorted(missing))}")
+
+    ran = []
+    for revision in reversed(all_revisions):
+        if target is not None and revision.revision <= target:
+            break
+        if revision.revision not in done:
+            continue
+        log(f"downgrade {revision.revision}: {revision.description}")
+        _run(engine, revision, 'downgrade')
+        ran.append(revision)
+    return ran
+
+
+def stamp(engine, target=None):
+    """Record every revision up to `target` (default: the latest) as applied,
+    and nothing newer, without running any of them."""
+
+    all_revisions = revisions()
+    _check_target(all_revisions, target)
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        schema_migrations.create(connection, checkfirst=True)
+        connection.execute(schema_migrations.delete())
+        rows = [{'revision': r.revision, 'description': r.description, 'applied_at': now}
+                for r in all_revisions if target is None or r.revision <= target]
+        if rows:
+            connection.execute(schema_migrations.insert(), rows)
@@ -2,18 +2,94 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from collections import Counter
+
+from sqlalchemy import and_, event, exists, func, inspect, literal, or_, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.sql.expression import FunctionElement
+
+from passwords import hash_password, check_password, needs_rehash
+from snowflake import next_id
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# message ids are snowflakes (see snowflake.py); SQLite's INTEGER is 64-bit
+# already, and keeps the id as the rowid
+MessageId = db.BigInteger().with_variant(db.Integer(), 'sqlite')
+
+
+class utcnow(FunctionElement):
+    """The database's current UTC time, as a server default for rows
+    written outside the ORM (COPY, raw SQL)."""
+    type = db.DateTime()
+
+
+@compiles(utcnow, 'postgresql')
+def _pg_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+class Conversation(db.Model):
+    """The DMs between two users, summarized for the inbox (see conversations.py).
+
+    Each pair has one row, with the lower user id first.
+    """
+
+    __tablename__ = 'conversations'
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    user_low_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+
+    user_high_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+
+    last_message_at = db.Column(db.DateTime, nullable=False)
+
+    last_message_preview = db.Column(db.String(280), nullable=False)
+
+    last_sender_id = db.Column(db.Integer, nullable=False)
+
+    # DMs each side hasn't read yet
+    low_unread = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    high_unread = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    user_low = db.relationship('User', foreign_keys=[user_low_id])
+    user_high = db.relationship('User', foreign_keys=[user_high_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('user_low_id', 'user_high_id', name='uq_conversations_users'),
+        # a user's inbox is a range read on whichever side they're on
+        db.Index('ix_conversations_low_last', 'user_low_id', 'last_message_at', 'id'),
+        db.Index('ix_conversations_high_last', 'user_high_id', 'last_message_at', 'id'),
+    )
+
+    def __repr__(self):
+        return f"<Conversation #{self.id}: {self.user_low_id}, {self.user_high_id}>"
+
+    def other_user_id(self, user_id):
+        return self.user_high_id if user_id == self.user_low_id else self.user_low_id
+
+    def unread_for(self, user_id):
+        return self.low_unread if user_id == self.user_low_id else self.high_unread
+
+
 class DirectMessage(db.Model):
     """direct message - from one user to another"""
     __tablename__ = 'dms'
 
     id = db.Column(db.Integer, primary_key=True)
 
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id', ondelete='cascade'))
+
     dm_from = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
     dm_to = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -23,7 +99,8 @@ class DirectMessage(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
     is_new = db.Column(
         db.Boolean,
@@ -33,6 +110,16 @@ class DirectMessage(db.Model):
     user_from = db.relationship('User', foreign_keys=[dm_from])
     user_to = db.relationship('User', foreign_keys=[dm_to], backref="dms")
 
+    __table_args__ = (
+        # a thread is a range read on (conversation_id, id)
+        db.Index('ix_dms_conversation_id', 'conversation_id', 'id'),
+        # every DM to a user...
+        db.Index('ix_dms_dm_to', 'dm_to'),
+        # ...but the navbar badge only counts unread ones, so that gets a
+        # small partial index of its own
+        db.Index('ix_dms_dm_to_unread', 'dm_to', postgresql_where=is_new, sqlite_where=is_new),
+    )
+
 class Notification(db.Model):
     """notifications for users"""
 
@@ -48,7 +135,8 @@ class Notification(db.Model):
     date = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
 
     from_id = db.Column(
@@ -65,6 +153,10 @@ class Notification(db.Model):
     from_user = db.relationship('User', foreign_keys=[from_id])
     user = db.relationship('User', foreign_keys=[to_id], backref="notifications")
 
+    __table_args__ = (
+        db.Index('ix_notifications_to_id', 'to_id'),
+    )
+
 class Block(db.Model):
     """Blocked user lists"""
 
@@ -89,6 +181,10 @@ class Block(db.Model):
     blocked = db.relationship('User', foreign_keys=[blocked_user])
     users = db.relationship('User', foreign_keys=[user], backref="blocks")
 
+    __table_args__ = (
+        db.UniqueConstraint('user', 'blocked_user', name='uq_blocks_user_blocked_user'),
+    )
+
     def __repr__(self):
         return f"<Block #{self.id}: {self.user}, {self.blocked_user}>"
 
@@ -109,6 +205,12 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # the primary key leads with user_being_followed_id; "who does this
+        # user follow" needs the other column first
+        db.Index('ix_follows_user_following_id', 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -126,10 +228,16 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        MessageId,
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id', name='uq_likes_user_id_message_id'),
+        # deleting a message looks up its likes by message
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -191,6 +299,33 @@ class User(db.Model):
         default=False
     )
 
+    # Denormalized counts shown on profile cards, kept in step by the flush
+    # listeners below and repaired by `flask recount-counters`.
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0'
+    )
+
     messages = db.relationship('Message', cascade="all, delete-orphan")
 
     followers = db.relationship(
@@ -219,43 +354,72 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in relationships_for(self.id).followers
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in relationships_for(self.id).following
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        return message.id in relationships_for(self.id).liked
     def accept_follow_req(self, other_user, n):
         self.notifications.remove(n)
         self.followers.append(other_user)
         db.session.commit()
-    # def get_messages():
-    #     all_messages = (Message.query.order_by(Message.timestamp.desc()).all())
-    #     messages = [msg for msg in all_messages if g.user in msg.user.followers or msg.user == g.user]
-    #     messages = messages[:100]
-    #     return messages
+    def home_timeline(self):
+        """Query for messages from this user and the users they follow,
+        minus authors this user has blocked (same rule as check_for_blocked)."""
+        followed_ids = (db.session
+                        .query(Follows.user_being_followed_id)
+                        .filter(Follows.user_following_id == self.id))
+        blocked_ids = (db.session
+                       .query(Block.blocked_user)
+                       .filter(Block.user == self.id))
+        return (timeline_query()
+                .filter(or_(Message.user_id == self.id,
+                            Message.user_id.in_(followed_ids)))
+                .filter(~Message.user_id.in_(blocked_ids)))
+
+    def global_timeline(self):
+        """Query for everyone's messages this user is allowed to see.
+
+        Authors this user blocked are left out, and private accounts only
+        show up if this user follows them. Both are anti-/semi-joins so the
+        LIMIT applies after filtering and pages come back full.
+        """
+        blocked = exists().where(and_(Block.user == self.id,
+                                      Block.blocked_user == Message.user_id))
+        followed = exists().where(and_(Follows.user_following_id == self.id,
+                                       Follows.user_being_followed_id == Message.user_id))
+        return (timeline_query()
+                .join(Message.user)
+                .filter(~blocked)
+                .filter(or_(User.is_private == False,
+                            Message.user_id == self.id,
+                            followed)))
     def check_for_blocked(self, other_user):
-        """this will iterate of the blocks list for user, returns true or false if blocked."""
-        is_blocked = Block.query.filter_by(user=self.id, blocked_user=other_user.id).first()
-        if is_blocked in self.blocks:
-            return True
-        return False
+        """Has this user blocked `other_user`? Returns true or false."""
+        return other_user.id in relationships_for(self.id).blocked
     def get_blocked_users(self):
         """Will output a list of blocked users for self user"""
-        block_list = [User.query.get(block.blocked_user) for block in self.blocks]
-        return block_list
+        blocked_ids = relationships_for(self.id).blocked
+        if not blocked_ids:
+            return []
+        return User.query.filter(User.id.in_(blocked_ids)).all()
     def get_direct_messages(self):
         """This will output a list of DMs where self user is DM_TO"""
         my_dms = DirectMessage.query.filter_by(dm_to=self.id).all()
         return my_dms
     def check_for_new_dm(self):
         """This will check for new messages on g.user"""
-        for dm in self.dms:
-            if dm.is_new:
-                return True;
-        return False;
+        pending_notifications, unread_dms = self.unread_counts()
+        return unread_dms > 0
+    def unread_counts(self):
+        """Return (pending_notifications, unread_dms) for this user."""
+        return count_unread(self.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -264,7 +428,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -285,24 +449,27 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at a lower work factor than BCRYPT_LOG_ROUNDS is replaced
+        with a fresh one; the caller's commit saves it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
                 return user
 
         return False
     @classmethod
     def change_password(cls, username, password, new_password):
         """Authenticate username & password, then encrypt new password & store it into db"""
-        if cls.authenticate(username, password):
-            user = cls.query.filter_by(username=username).first()
-            new_hashed_pwd = bcrypt.generate_password_hash(new_password).decode('UTF-8')
-            user.password = new_hashed_pwd
-            db.session.add(user)
+        user = cls.authenticate(username, password)
+        if user:
+            user.password = hash_password(new_password)
             return user
         else:
             return False
@@ -314,8 +481,10 @@ class Message(db.Model):
     __tablename__ = 'messages'
 
     id = db.Column(
-        db.Integer,
+        MessageId,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(db.String(280), nullable=False)
@@ -323,7 +492,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -334,8 +504,396 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (
+        # profile pages: one author's messages, newest (highest id) first
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
+
+
+
+
+# One statement on Postgres: unlike (if asked to) and, unless a like was just
+# removed, like, resting on the unique (user_id, message_id) constraint so a
+# concurrent duplicate does nothing; the liker's likes_count moves with it.
+TOGGLE_LIKE_SQL = text("""
+    WITH target AS (
+        SELECT id, user_id FROM messages WHERE id = :message_id
+    ), removed AS (
+        DELETE FROM likes
+        WHERE :unlike AND user_id = :user_id AND message_id = :message_id
+        RETURNING id
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, id FROM target
+        WHERE :like AND NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT (user_id, message_id) DO NOTHING
+        RETURNING id
+    ), counted AS (
+        UPDATE users
+        SET likes_count = likes_count + (SELECT count(*) FROM added) - (SELECT count(*) FROM removed)
+        WHERE id = :user_id AND EXISTS (SELECT 1 FROM added UNION ALL SELECT 1 FROM removed)
+        RETURNING id
+    )
+    SELECT (SELECT user_id FROM target) AS author_id,
+           :like AND NOT EXISTS (SELECT 1 FROM removed) AS liked,
+           (SELECT count(*) FROM likes WHERE message_id = :message_id)
+             + (SELECT count(*) FROM added) - (SELECT count(*) FROM removed) AS likes
+""")
+
+
+def toggle_like(user_id, message_id, liked=None):
+    """Like or unlike a message for a user; returns (liked, like_count,
+    author_id), or None if there is no such message.
+
+    `liked` True or False sets that state, so repeating the call changes
+    nothing; None flips whatever the state is now. The caller commits.
+    """
+    like = liked is not False
+    unlike = liked is not True
+    session = db.session
+
+    if session.get_bind().dialect.name == 'postgresql':
+        row = session.execute(TOGGLE_LIKE_SQL, {'user_id': user_id, 'message_id': message_id,
+                                                'like': like, 'unlike': unlike}).first()
+        author_id, now_liked, count = row
+    else:
+        # SQLite has no writes inside WITH, so take the same steps one by one
+        likes = Likes.__table__
+        author_id = session.query(Message.user_id).filter(Message.id == message_id).scalar()
+        found = author_id is not None
+        removed = added = 0
+        if found and unlike:
+            removed = session.execute(likes.delete()
+                                      .where(and_(likes.c.user_id == user_id,
+                                                  likes.c.message_id == message_id))).rowcount
+        if found and like and not removed:
+            added = session.execute(likes.insert().prefix_with('OR IGNORE')
+                                    .values(user_id=user_id, message_id=message_id)).rowcount
+        _adjust_counters(session.connection(), {(user_id, 'likes_count'): added - removed})
+        now_liked = like and not removed
+        count = session.query(func.count()).filter(Likes.message_id == message_id).scalar()
+
+    invalidate_relationships()
+    if author_id is None:
+        return None
+    return bool(now_liked), count, author_id
+
+
+def clear_notifications(user_id, up_to=None):
+    """Delete `user_id`'s notifications, only those with ids up to `up_to`
+    if given, in one statement. Returns how many went. The caller commits."""
+    notifications = Notification.__table__
+    criteria = [notifications.c.to_id == user_id]
+    if up_to is not None:
+        criteria.append(notifications.c.id <= up_to)
+    return db.session.execute(notifications.delete().where(and_(*criteria))).rowcount
+
+
+def count_unread(user_id):
+    """Return (pending_notifications, unread_dms) from one aggregate query."""
+    pending = (select([func.count()])
+               .where(Notification.to_id == user_id)
+               .as_scalar())
+    unread = (select([func.count()])
+              .where(and_(DirectMessage.dm_to == user_id, DirectMessage.is_new == True))
+              .as_scalar())
+    return tuple(db.session.query(pending, unread).one())
+
+
+class RelationshipState:
+    """Id sets for who a user follows, is followed by, has blocked and which
+    messages they've liked, loaded together in one UNION ALL query so
+    membership checks in templates are O(1) set lookups."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.following = set()
+        self.followers = set()
+        self.blocked = set()
+        self.liked = set()
+
+        rows = (db.session
+                .query(literal('following'), Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id)
+                .union_all(
+                    db.session
+                    .query(literal('followers'), Follows.user_following_id)
+                    .filter(Follows.user_being_followed_id == user_id),
+                    db.session
+                    .query(literal('blocked'), Block.blocked_user)
+                    .filter(Block.user == user_id),
+                    db.session
+                    .query(literal('liked'), Likes.message_id)
+                    .filter(Likes.user_id == user_id)))
+        for kind, other_id in rows:
+            getattr(self, kind).add(other_id)
+
+
+def relationships_for(user_id):
+    """Return the RelationshipState for `user_id`, loaded at most once per
+    request (cached on g). Outside a request it is loaded fresh each call."""
+
+    if not has_app_context():
+        return RelationshipState(user_id)
+    if '_relationships' not in g:
+        g._relationships = {}
+    if user_id not in g._relationships:
+        g._relationships[user_id] = RelationshipState(user_id)
+    return g._relationships[user_id]
+
+
+def invalidate_relationships():
+    """Forget cached relationship state for this request."""
+
+    if has_app_context():
+        g.pop('_relationships', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_after_write(session, flush_context):
+    """Any flush may add or remove follows, blocks or likes, so drop the cache."""
+    invalidate_relationships()
+
+
+def _adjust_counters(connection, deltas):
+    """Apply {(user_id, column_name): delta} as atomic UPDATE ... SET col = col + delta."""
+
+    users = User.__table__
+    for (user_id, column_name), delta in deltas.items():
+        if user_id is None or delta == 0:
+            continue
+        column = users.c[column_name]
+        connection.execute(users.update()
+                           .where(users.c.id == user_id)
+                           .values({column: column + delta}))
+
+
+def _subtract_counts(connection, column_name, user_column, condition):
+    """Subtract from each user's `column_name` the number of rows matching
+    `condition` that point at them through `user_column`, in one UPDATE for
+    every user at once."""
+
+    users = User.__table__
+    column = users.c[column_name]
+    matching = select([func.count()]).where(and_(user_column == users.c.id, condition)).as_scalar()
+    connection.execute(users.update()
+                       .where(users.c.id.in_(select([user_column]).where(condition)))
+                       .values({column: column - matching}))
+
+
+@event.listens_for(Session, 'before_flush')
+def _count_cascaded_deletes(session, flush_context, instances):
+    """Adjust counters for rows the database removes by ON DELETE CASCADE.
+
+    This has to run before the flush, while those rows can still be found.
+    It's a fixed number of statements however many rows go: deleting a
+    user puts all of their messages in session.deleted too, and those are
+    found through messages.user_id rather than listed one by one.
+    """
+    likes = Likes.__table__
+    follows = Follows.__table__
+    messages = Message.__table__
+
+    user_ids = {obj.id for obj in session.deleted if isinstance(obj, User) and obj.id is not None}
+    message_ids = {obj.id for obj in session.deleted
+                   if isinstance(obj, Message) and obj.id is not None and obj.user_id not in user_ids}
+    if not (user_ids or message_ids):
+        return
+    connection = session.connection()
+
+    deleted_messages = []
+    if message_ids:
+        deleted_messages.append(likes.c.message_id.in_(message_ids))
+    if user_ids:
+        deleted_messages.append(likes.c.message_id.in_(
+            select([messages.c.id]).where(messages.c.user_id.in_(user_ids))))
+    _subtract_counts(connection, 'likes_count', likes.c.user_id, or_(*deleted_messages))
+
+    if user_ids:
+        _subtract_counts(connection, 'follower_count', follows.c.user_being_followed_id,
+                         follows.c.user_following_id.in_(user_ids))
+        _subtract_counts(connection, 'following_count', follows.c.user_following_id,
+                         follows.c.user_being_followed_id.in_(user_ids))
+
+
+def _collection_changes(attr_state):
+    """(added, deleted) for a relationship collection, without loading it."""
+
+    history = attr_state.history
+    return history.added or (), history.deleted or ()
+
+
+@event.listens_for(Session, 'after_flush')
+def _count_flushed_rows(session, flush_context):
+    """Keep User counters in the same transaction as the rows they count."""
+
+    deltas = Counter()
+
+    for sign, objects in ((1, session.new), (-1, session.deleted)):
+        for obj in objects:
+            if isinstance(obj, Message):
+                deltas[obj.user_id, 'message_count'] += sign
+            elif isinstance(obj, Likes):
+                deltas[obj.user_id, 'likes_count'] += sign
+            elif isinstance(obj, Follows):
+                deltas[obj.user_being_followed_id, 'follower_count'] += sign
+                deltas[obj.user_following_id, 'following_count'] += sign
+
+    # follows and likes made through the relationship collections never
+    # become Follows / Likes objects, so read them off the collection history
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, User) or user in session.deleted:
+            continue
+        attrs = inspect(user).attrs
+        added, deleted = _collection_changes(attrs.following)
+        for sign, others in ((1, added), (-1, deleted)):
+            for other in others:
+                deltas[user.id, 'following_count'] += sign
+                deltas[other.id, 'follower_count'] += sign
+        added, deleted = _collection_changes(attrs.followers)
+        for sign, others in ((1, added), (-1, deleted)):
+            for other in others:
+                deltas[user.id, 'follower_count'] += sign
+                deltas[other.id, 'following_count'] += sign
+        added, deleted = _collection_changes(attrs.likes)
+        deltas[user.id, 'likes_count'] += len(added) - len(deleted)
+
+    _adjust_counters(session.connection(), deltas)
+
+
+def recount_counters(batch_size=1000):
+    """Recompute every user's counters from the source tables, committing
+    once per batch of user ids. Returns how many users were recounted."""
+
+    users = User.__table__
+    messages = Message.__table__
+    follows = Follows.__table__
+    likes = Likes.__table__
+    true_counts = {
+        'message_count': select([func.count()]).where(messages.c.user_id == users.c.id),
+        'follower_count': select([func.count()]).where(follows.c.user_being_followed_id == users.c.id),
+        'following_count': select([func.count()]).where(follows.c.user_following_id == users.c.id),
+        'likes_count': select([func.count()]).where(likes.c.user_id == users.c.id),
+    }
+    values = {name: query.as_scalar() for name, query in true_counts.items()}
+
+    max_id = db.session.query(func.max(User.id)).scalar() or 0
+    recounted = 0
+    for low in range(0, max_id, batch_size):
+        result = db.session.execute(users.update()
+                                    .where(and_(users.c.id > low, users.c.id <= low + batch_size))
+                                    .values(values))
+        db.session.commit()
+        recounted += result.rowcount
+    return recounted
 
 
+class TimelineEntry(db.Model):
+    """A message fanned out into one user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        MessageId,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # a page is one range read on the primary key (user_id, message_id),
+    # since message ids are time-ordered
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_author', 'user_id', 'author_id'),
+    )
+
+
+# the only author columns a message card renders
+MESSAGE_CARD_AUTHOR_COLUMNS = ('id', 'username', 'image_url', 'is_verified')
+
+
+def timeline_query():
+    """Base query for every list of message cards.
+
+    Authors are loaded with one batched SELECT ... WHERE id IN (...) per page
+    instead of one lazy load per card, and only the columns the card shows.
+    """
+    return (Message
+            .query
+            .options(selectinload(Message.user).load_only(*MESSAGE_CARD_AUTHOR_COLUMNS)))
+
+
+def encode_cursor(msg):
+    """Turn the last message on a page into an opaque "older than" cursor."""
+    return str(msg.id)
+
+
+def decode_cursor(cursor):
+    """Parse a cursor from encode_cursor into a message id; None if invalid.
+
+    Cursors from before ids were time-ordered ("<timestamp>-<id>") still
+    work: the id in them is all that's needed now. Ids of messages dated
+    before snowflake.EPOCH are negative.
+    """
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(cursor.rpartition('-')[2])
+    except (AttributeError, ValueError):
+        return None
+
+
+def paginate_timeline(query, before=None, limit=100, id_column=None):
+    """Return (messages, next_cursor) for one page of a message query.
+
+    Message ids are time-ordered, so pages are ordered newest first by id
+    and continue from the `before` cursor with `id < cursor` rather than
+    OFFSET. next_cursor is None on the last page.
+
+    `id_column` swaps in another column holding the message id, e.g.
+    TimelineEntry.message_id, so the range read runs on that table's key.
+    """
+    id_column = id_column if id_column is not None else Message.id
+    position = decode_cursor(before) if before else None
+    if position:
+        query = query.filter(id_column < position)
+    messages = (query
+                .order_by(id_column.desc())
+                .limit(limit + 1)
+                .all())
+    if len(messages) > limit:
+        messages = messages[:limit]
+        return messages, encode_cursor(messages[-1])
+    return messages, None
+
+
+def paginate_newer(query, since, limit=100, id_column=None):
+    """Return (messages, more) for messages newer than the `since` message
+    id, oldest first.
+
+    The forward twin of paginate_timeline: a range read from `since` up, so
+    a client catching up asks again from the last id until `more` is False.
+    """
+    id_column = id_column if id_column is not None else Message.id
+    messages = (query
+                .filter(id_column > since)
+                .order_by(id_column)
+                .limit(limit + 1)
+                .all())
+    return messages[:limit], len(messages) > limit
 
 
 def connect_db(app):
@@ -0,0 +1,203 @@
+"""bcrypt hashing in a bounded pool of worker processes.
+
+bcrypt is deliberately slow, and running it inside a gunicorn worker means a
+burst of logins pins every worker. Instead, hashes are computed in a process
+pool, under two limits that hold across every worker on the host:
+
+- at most PASSWORD_HASH_WORKERS hashes run at once: a pool process waits
+  for a hashing slot before it starts bcrypt
+- at most PASSWORD_HASH_QUEUE more may be waiting for one. Past that, or
+  when a hash isn't done within PASSWORD_HASH_TIMEOUT seconds,
+  PasswordHasherBusy is raised so the request can be turned away with a 503
+  instead of piling up.
+
+With gevent workers (see gunicorn.conf.py) a request waiting on its hash
+yields to the others, so one worker can have many hashes in flight; the
+limits are shared so that doesn't multiply by the number of workers.
+
+Slots are one-byte POSIX locks in a file (PASSWORD_HASH_STORAGE, in
+/dev/shm when available), so a process that dies gives its slots back.
+PASSWORD_HASH_WORKERS = 0 hashes inline.
+
+The work factor comes from BCRYPT_LOG_ROUNDS. Hashes made with a lower cost
+are upgraded the next time their owner logs in (see needs_rehash).
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+DEFAULT_TIMEOUT = 10
+
+# hashing slots are locked from here on in the file, after the queue's
+HASHING_OFFSET = 1 << 20
+# how often a pool process looks for a free hashing slot, in seconds
+SLOT_POLL = 0.005
+
+settings = {
+    'rounds': DEFAULT_ROUNDS,
+    'workers': os.cpu_count() or 2,
+    'queue': None,
+    'timeout': DEFAULT_TIMEOUT,
+    'storage': None,
+}
+
+_pool = None
+_pool_pid = None
+_slots = None
+_pool_lock = threading.Lock()
+
+# set in each pool process
+_hashing_slots = None
+
+
+class PasswordHasherBusy(Exception):
+    """Every hashing slot is busy and the queue is full, or a hash took too long."""
+
+
+class HostSlots:
+    """`count` slots shared by every process on the host, each a one-byte
+    POSIX lock at `offset` + n in the file at `path`.
+
+    POSIX locks belong to a process, not a descriptor, so this also keeps
+    track of which slots its process holds. Closing any descriptor of the
+    file drops all of them, so use one HostSlots per file per process.
+    """
+
+    def __init__(self, path, count, offset=0):
+        self.count = count
+        self.offset = offset
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a free slot and return its number, or None if all are taken."""
+        with self._lock:
+            for slot in range(self.count):
+                if slot in self._held:
+                    continue
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, self.offset + slot)
+                except (BlockingIOError, PermissionError):
+                    continue
+                self._held.add(slot)
+                return slot
+        return None
+
+    def release(self, slot):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, self.offset + slot)
+            self._held.discard(slot)
+
+
+def default_storage_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'warbler-passwords')
+
+
+def init_app(app):
+    """Read hashing settings from the app's config."""
+
+    global _pool, _pool_pid
+    settings['rounds'] = app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+    settings['workers'] = app.config.get('PASSWORD_HASH_WORKERS', settings['workers'])
+    settings['queue'] = app.config.get('PASSWORD_HASH_QUEUE', settings['workers'] * 4)
+    settings['timeout'] = app.config.get('PASSWORD_HASH_TIMEOUT', DEFAULT_TIMEOUT)
+    settings['storage'] = app.config.get('PASSWORD_HASH_STORAGE')
+    _pool = _pool_pid = None
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def _start_pool_process(path, count):
+    global _hashing_slots
+    _hashing_slots = HostSlots(path, count, HASHING_OFFSET)
+
+
+def _in_hashing_slot(deadline, fn, *args):
+    """Run fn(*args) in a pool process once a hashing slot is free, unless
+    `deadline` passes first (the request has given up by then)."""
+    slot = _hashing_slots.acquire()
+    while slot is None:
+        if time.time() > deadline:
+            raise TimeoutError("no hashing slot came free in time")
+        time.sleep(SLOT_POLL)
+        slot = _hashing_slots.acquire()
+    try:
+        return fn(*args)
+    finally:
+        _hashing_slots.release(slot)
+
+
+def _get_pool():
+    """This process's pool and queue slots, created on first use so each
+    gunicorn worker (forked after import) gets its own."""
+
+    global _pool, _pool_pid, _slots
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            workers = settings['workers']
+            queue = settings['queue'] if settings['queue'] is not None else workers * 4
+            path = settings['storage'] or default_storage_path()
+            _pool = ProcessPoolExecutor(max_workers=workers, initializer=_start_pool_process,
+                                        initargs=(path, workers))
+            _pool_pid = os.getpid()
+            # a job holds one of these from submit until it's done, running or not
+            _slots = HostSlots(path, workers + queue)
+        return _pool, _slots
+
+
+def _run(fn, *args):
+    if not settings['workers']:
+        return fn(*args)
+
+    pool, slots = _get_pool()
+    slot = slots.acquire()
+    if slot is None:
+        raise PasswordHasherBusy()
+    timeout = settings['timeout']
+    try:
+        future = pool.submit(_in_hashing_slot, time.time() + timeout, fn, *args)
+    except Exception:
+        slots.release(slot)
+        raise
+    future.add_done_callback(lambda f: slots.release(slot))
+    try:
+        return future.result(timeout=timeout)
+    except (futures.TimeoutError, TimeoutError):
+        # not started yet: don't start it
+        future.cancel()
+        raise PasswordHasherBusy()
+
+
+def hash_password(password):
+    """Return a bcrypt hash of `password` at the configured work factor."""
+    return _run(_hash, password, settings['rounds'])
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+    return _run(_check, password, hashed)
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a lower work factor than we use now?"""
+    try:
+        cost = int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return cost < settings['rounds']
@@ -0,0 +1,221 @@
+"""Token-bucket rate limiting for Warbler's expensive endpoints.
+
+Every limited endpoint has a bucket per client IP and/or per logged-in user.
+A bucket holds up to N tokens and refills at N per period, so "10/minute"
+allows a burst of 10 and then one request every six seconds. Only
+state-changing requests (anything but GET/HEAD/OPTIONS) spend tokens.
+
+The check runs as the app's first before_request hook, so a request over
+its limit is answered with a 429 before the user is loaded or any bcrypt
+or database work happens. Per-user buckets use the id in the session cookie.
+
+Buckets live in a small mmap'd file (RATELIMIT_STORAGE, in /dev/shm when
+available) shared by every gunicorn worker on the host. For several hosts,
+point RATELIMIT_BACKEND at a "module:Class" whose instances have the same
+`consume` method as the backends here (e.g. one backed by Redis).
+
+Limits are set per endpoint in RATE_LIMITS; see DEFAULT_LIMITS.
+"""
+
+import fcntl
+import hashlib
+import importlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, session
+
+DEFAULT_LIMITS = {
+    'login': {'ip': '10/minute'},
+    'signup': {'ip': '5/minute'},
+    'messages_add': {'user': '30/minute', 'ip': '60/minute'},
+    'like_post': {'user': '120/minute'},
+    'reply_to_dm': {'user': '30/minute'},
+    'send_message_to_user': {'user': '30/minute'},
+    'mark_dm_read': {'user': '120/minute'},
+}
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+DEFAULT_SLOTS = 65536
+
+
+class RateLimitExceeded(Exception):
+    """The client has run out of tokens; retry_after is in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def parse_limit(limit):
+    """Turn "N/period" into (capacity, tokens per second)."""
+    count, period = limit.split('/')
+    count = int(count)
+    return count, count / PERIODS[period.strip()]
+
+
+def _refill(tokens, updated, now, capacity, rate, cost):
+    """Token bucket step: return (allowed, tokens left, seconds until allowed)."""
+    tokens = min(capacity, tokens + max(now - updated, 0) * rate)
+    if tokens >= cost:
+        return True, tokens - cost, 0
+    return False, tokens, (cost - tokens) / rate
+
+
+class MemoryBackend:
+    """Buckets in a dict; per process, for development and tests."""
+
+    def __init__(self, size=DEFAULT_SLOTS):
+        self.size = size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate, cost=1, now=None):
+        """Spend `cost` tokens from `key`'s bucket; return (allowed, retry_after)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            allowed, tokens, retry_after = _refill(tokens, updated, now, capacity, rate, cost)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+
+class MmapBackend:
+    """Buckets in a fixed-size hash table in a shared mmap'd file.
+
+    Each slot is (key hash, tokens, last update). A key may sit in any of
+    PROBES slots after its home slot; when all are taken, the least recently
+    used one is recycled. Writers take a POSIX lock on the file, which
+    excludes other processes, plus a thread lock for this one.
+    """
+
+    SLOT = struct.Struct('<Qdd')
+    PROBES = 8
+
+    def __init__(self, path, slots=DEFAULT_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.SLOT.size * slots
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def _key_hash(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, 'little') | 1
+
+    def _find_slot(self, key_hash):
+        home = key_hash % self.slots
+        oldest = None
+        for probe in range(self.PROBES):
+            offset = ((home + probe) % self.slots) * self.SLOT.size
+            slot_hash, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, tokens, updated
+            if slot_hash == 0:
+                return offset, None, None
+            if oldest is None or updated < oldest[1]:
+                oldest = (offset, updated)
+        return oldest[0], None, None
+
+    def consume(self, key, capacity, rate, cost=1, now=None):
+        """Spend `cost` tokens from `key`'s bucket; return (allowed, retry_after)."""
+        now = time.time() if now is None else now
+        key_hash = self._key_hash(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, tokens, updated = self._find_slot(key_hash)
+                if tokens is None:
+                    tokens, updated = capacity, now
+                allowed, tokens, retry_after = _refill(tokens, updated, now, capacity, rate, cost)
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        return allowed, retry_after
+
+
+def default_storage_path():
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'warbler-ratelimit')
+
+
+def make_backend(config):
+    """Build the backend named by RATELIMIT_BACKEND: "mmap", "memory" or "module:Class"."""
+    name = config.get('RATELIMIT_BACKEND', 'mmap')
+    slots = config.get('RATELIMIT_SLOTS', DEFAULT_SLOTS)
+    if name == 'mmap':
+        return MmapBackend(config.get('RATELIMIT_STORAGE') or default_storage_path(), slots)
+    if name == 'memory':
+        return MemoryBackend(slots)
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)(config)
+
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def get_backend(app):
+    """This process's backend, opened on first use so each forked worker maps its own."""
+    global _backend, _backend_pid
+    with _backend_lock:
+        if _backend is None or _backend_pid != os.getpid():
+            _backend = make_backend(app.config)
+            _backend_pid = os.getpid()
+        return _backend
+
+
+def reset_backend():
+    """Forget the current backend, e.g. after changing RATELIMIT_* config."""
+    global _backend, _backend_pid
+    with _backend_lock:
+        _backend = _backend_pid = None
+
+
+def check_limits(app, endpoint, user_id):
+    """Spend a token from each of `endpoint`'s buckets, or raise RateLimitExceeded."""
+    limits = app.config.get('RATE_LIMITS', DEFAULT_LIMITS).get(endpoint)
+    if not limits:
+        return
+
+    backend = get_backend(app)
+    clients = {'ip': request.remote_addr, 'user': user_id}
+    retry_after = 0
+    for scope, limit in limits.items():
+        client = clients[scope]
+        if client is None:
+            continue
+        capacity, rate = parse_limit(limit)
+        allowed, wait = backend.consume(f"{endpoint}:{scope}:{client}", capacity, rate)
+        if not allowed:
+            retry_after = max(retry_after, wait)
+    if retry_after:
+        raise RateLimitExceeded(retry_after)
+
+
+def init_app(app, session_key):
+    """Check rate limits before any other before_request hook.
+
+    `session_key` is where the logged-in user's id lives in the session.
+    Call this before registering hooks that load the user.
+    """
+
+    @app.before_request
+    def enforce_rate_limits():
+        if not app.config.get('RATELIMIT_ENABLED', True) or request.method in SAFE_METHODS:
+            return
+        check_limits(app, request.endpoint, session.get(session_key))
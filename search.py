@@ -0,0 +1,210 @@
+"""User and message search for Warbler.
+
+On Postgres, users are matched with a pg_trgm GIN index over username,
+location and bio, so `%q%` matching doesn't scan the table, and ranked by
+trigram similarity to the username. Warbles are matched with a GIN index on
+to_tsvector('english', text) and ranked with ts_rank. Local SQLite
+databases use FTS5 tables kept in sync by triggers instead. All of them are
+created alongside their tables by db.create_all(), and migration 0004 adds
+them to existing databases; the database keeps them current as messages
+are added and deleted.
+
+User results only load the columns a user card renders.
+"""
+
+import re
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import DDL, Numeric, and_, event, func, literal_column, or_
+from sqlalchemy.orm import load_only
+from sqlalchemy.sql import column, table
+
+from models import db, Message, User
+
+USERS_PER_PAGE = 30
+MESSAGES_PER_PAGE = 50
+SUGGESTION_LIMIT = 8
+
+USER_CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url',
+                     'bio', 'is_private', 'is_verified')
+
+# must match the expression in ix_users_search_trgm exactly for Postgres to use it
+SPACE = literal_column("' '")
+EMPTY = literal_column("''")
+USER_DOCUMENT = (User.username + SPACE
+                 + func.coalesce(User.location, EMPTY) + SPACE
+                 + func.coalesce(User.bio, EMPTY))
+
+users_fts = table('users_fts', column('rowid'), column('rank'))
+messages_fts = table('messages_fts', column('rowid'))
+
+# must match the expression in ix_messages_text_fts exactly
+ENGLISH = literal_column("'english'")
+MESSAGE_VECTOR = func.to_tsvector(ENGLISH, Message.text)
+
+POSTGRES_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_users_search_trgm ON users USING gin "
+    "((username || ' ' || coalesce(location, '') || ' ' || coalesce(bio, '')) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_users_username_prefix ON users (lower(username) text_pattern_ops)",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, location, bio, content='users', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, location, bio) "
+    "VALUES (new.id, new.username, new.location, new.bio); END",
+    "CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, location, bio) "
+    "VALUES ('delete', old.id, old.username, old.location, old.bio); END",
+    # only the indexed columns: counter bumps update users all the time
+    "CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, location, bio ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, location, bio) "
+    "VALUES ('delete', old.id, old.username, old.location, old.bio); "
+    "INSERT INTO users_fts(rowid, username, location, bio) "
+    "VALUES (new.id, new.username, new.location, new.bio); END",
+]
+
+for statement in POSTGRES_DDL:
+    event.listen(User.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+for statement in SQLITE_DDL:
+    event.listen(User.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(User.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS users_fts").execute_if(dialect='sqlite'))
+
+MESSAGE_POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_fts ON messages "
+    "USING gin (to_tsvector('english', text))",
+]
+
+MESSAGE_SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, content='messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text); END",
+]
+
+for statement in MESSAGE_POSTGRES_DDL:
+    event.listen(Message.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+for statement in MESSAGE_SQLITE_DDL:
+    event.listen(Message.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Message.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _fts_query(text):
+    """Turn free text into an FTS5 query of quoted prefix terms, or None."""
+    terms = re.findall(r'\w+', text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def user_cards():
+    """Base query for user cards: only the columns the card shows."""
+    return User.query.options(load_only(*USER_CARD_COLUMNS))
+
+
+def paginate(query, page, per_page=USERS_PER_PAGE):
+    """Return (items, has_next) for a 1-based page, without a COUNT query."""
+    page = max(page, 1)
+    items = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    return items[:per_page], len(items) > per_page
+
+
+def search_users(text, page=1, per_page=USERS_PER_PAGE):
+    """Return (users, has_next) matching `text` in username, location or bio, best first."""
+    if _dialect() == 'sqlite':
+        match = _fts_query(text)
+        if match is None:
+            return [], False
+        query = (user_cards()
+                 .join(users_fts, users_fts.c.rowid == User.id)
+                 .filter(literal_column('users_fts').op('MATCH')(match))
+                 .order_by(users_fts.c.rank, User.id))
+    else:
+        query = (user_cards()
+                 .filter(USER_DOCUMENT.ilike(f"%{_like_escape(text)}%", escape='\\'))
+                 .order_by(func.similarity(User.username, text).desc(), User.id))
+    return paginate(query, page, per_page)
+
+
+def list_all_users(page=1, per_page=USERS_PER_PAGE):
+    """Return (users, has_next) for the unfiltered user directory."""
+    return paginate(user_cards().order_by(User.id), page, per_page)
+
+
+def suggest_usernames(prefix, limit=SUGGESTION_LIMIT):
+    """Usernames starting with `prefix` (case-insensitive), for as-you-type search."""
+    pattern = f"{_like_escape(prefix.lower())}%"
+    rows = (db.session
+            .query(User.id, User.username, User.image_url)
+            .filter(func.lower(User.username).like(pattern, escape='\\'))
+            .order_by(func.lower(User.username))
+            .limit(limit))
+    return [{'id': id, 'username': username, 'image_url': image_url}
+            for id, username, image_url in rows]
+
+
+def _decode_search_cursor(cursor, dialect):
+    """Parse a "score_id" cursor into (score, id); None if invalid."""
+    try:
+        score, msg_id = cursor.split('_')
+        score = float(score) if dialect == 'sqlite' else Decimal(score)
+        return score, int(msg_id)
+    except (AttributeError, ValueError, InvalidOperation):
+        return None
+
+
+def search_messages(viewer, text, before=None, limit=MESSAGES_PER_PAGE):
+    """Return (messages, next_cursor) for warbles matching `text`, best match first.
+
+    Only messages `viewer` may see are searched (see User.global_timeline),
+    so blocked authors and private accounts they don't follow are excluded.
+    Pages continue from `before` with a keyset on (score, id).
+    """
+    dialect = _dialect()
+    query = viewer.global_timeline()
+    if dialect == 'sqlite':
+        match = _fts_query(text)
+        if match is None:
+            return [], None
+        score = func.round(-func.bm25(literal_column('messages_fts')), 6)
+        query = (query
+                 .join(messages_fts, messages_fts.c.rowid == Message.id)
+                 .filter(literal_column('messages_fts').op('MATCH')(match)))
+    else:
+        ts_query = func.plainto_tsquery(ENGLISH, text)
+        score = func.round(func.ts_rank(MESSAGE_VECTOR, ts_query).cast(Numeric), 6)
+        query = query.filter(MESSAGE_VECTOR.op('@@')(ts_query))
+
+    position = _decode_search_cursor(before, dialect) if before else None
+    if position:
+        last_score, last_id = position
+        query = query.filter(or_(score < last_score,
+                                 and_(score == last_score, Message.id < last_id)))
+
+    rows = (query
+            .add_columns(score)
+            .order_by(score.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+    messages = [msg for msg, _ in rows[:limit]]
+    if len(rows) > limit:
+        msg, last_score = rows[limit - 1]
+        return messages, f"{last_score}_{msg.id}"
+    return messages, None
@@ -1,8 +1,19 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py                          # the small CSVs in generator/
+    python seed.py --data generator/data    # output of generator/generate.py
+    python seed.py --data more/ --append    # add to what's already there
+
+See loader.py for how the files are streamed in.
+"""
+
+import argparse
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from loader import DEFAULT_CHUNK_SIZE, DEFAULT_WORKERS, load_csvs
+from timelines import rebuild_all_timelines
+from conversations import rebuild_conversations
+from models import User, recount_counters
 
 
 
@@ -15,27 +26,35 @@ except:
     pass
 
 
-db.drop_all()
-db.create_all()
+parser = argparse.ArgumentParser(description="Load Warbler CSVs into the database.")
+parser.add_argument('--data', default='generator', help="directory holding the CSV files")
+parser.add_argument('--append', action='store_true', help="add to the existing data instead of starting over")
+parser.add_argument('--keep-indexes', action='store_true', help="don't drop indexes and constraints during the load")
+parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="tables loaded in parallel (Postgres)")
+parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="rows per COPY / commit")
+args = parser.parse_args()
+
+load_csvs(args.data,
+          append=args.append,
+          drop_indexes=False if args.keep_indexes else None,
+          workers=args.workers,
+          chunk_size=args.chunk_size)
 
 username='admin'
 password='password'
 email='erik@erikrichard.com'
 image_url='https://pbs.twimg.com/profile_images/1181201389701259265/Ggo4P7Ht_400x400.jpg'
 
-
-admin_user = User.signup(username, email, password, image_url)
-admin_user.is_admin=True
-db.session.add(admin_user)
-db.session.commit()
-
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
-
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
-
-db.session.commit()
+# created after the CSVs so their user ids line up with the rows that
+# reference them
+if not User.query.filter_by(username=username).first():
+    admin_user = User.signup(username, email, password, image_url)
+    admin_user.is_admin=True
+    db.session.add(admin_user)
+    db.session.commit()
+
+# bulk loads skip fan-out, the counter listeners and conversations, so
+# build everyone's home timeline, profile counts and inbox from scratch
+rebuild_all_timelines()
+recount_counters()
+rebuild_conversations()
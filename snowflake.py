@@ -0,0 +1,96 @@
+"""Time-ordered 64-bit message ids ("snowflakes").
+
+    | 41 bits: ms since EPOCH | 10 bits: worker id | 12 bits: sequence |
+
+Ids from one process only ever increase, and ids from different processes
+are ordered by the millisecond they were made in, so ordering messages by
+id orders them by age and the primary key doubles as the timeline index.
+41 bits of milliseconds run out in 2089. Messages dated before EPOCH
+(imported or renumbered ones) get negative ids, still in time order.
+
+Every process writing messages at the same time needs its own worker id.
+gunicorn.conf.py sets SNOWFLAKE_WORKER_ID for each worker; anything else
+(flask run, seed.py, tests) reads the same variable and defaults to 0.
+
+If the clock steps backwards, or more than 4096 ids are wanted in one
+millisecond, ids carry on from the last one issued rather than waiting
+for the clock to catch up.
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+
+EPOCH = datetime(2020, 1, 1)
+EPOCH_MS = 1577836800000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+class SnowflakeGenerator:
+    """Issues increasing ids for one worker id. Thread-safe."""
+
+    def __init__(self, worker_id, clock=time.time):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be 0..{MAX_WORKER_ID}, not {worker_id}")
+        self.worker_id = worker_id
+        self._clock = clock
+        self._lock = Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now = int(self._clock() * 1000)
+            if now > self._last_ms:
+                self._last_ms = now
+                self._sequence = 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                # this millisecond is used up: borrow the next one
+                self._last_ms += 1
+                self._sequence = 0
+            return ((self._last_ms - EPOCH_MS) << TIME_SHIFT
+                    | self.worker_id << SEQUENCE_BITS
+                    | self._sequence)
+
+
+def make_id(when, worker_id=0, sequence=0):
+    """The id for `when` (a naive UTC datetime) with the given parts."""
+    millis = (when - EPOCH) // timedelta(milliseconds=1)
+    return millis << TIME_SHIFT | worker_id << SEQUENCE_BITS | sequence
+
+
+def id_time(snowflake):
+    """The UTC datetime an id was made at, to the millisecond."""
+    return EPOCH + timedelta(milliseconds=snowflake >> TIME_SHIFT)
+
+
+def worker_id_from_env():
+    return int(os.environ.get('SNOWFLAKE_WORKER_ID', 0))
+
+
+_generator = None
+_generator_pid = None
+_generator_lock = Lock()
+
+
+def next_id():
+    """A new id from this process's generator.
+
+    The generator is made on first use in each process, so a worker forked
+    from a master that already made ids gets one with its own worker id.
+    """
+    global _generator, _generator_pid
+    if _generator_pid != os.getpid():
+        with _generator_lock:
+            if _generator_pid != os.getpid():
+                _generator = SnowflakeGenerator(worker_id_from_env())
+                _generator_pid = os.getpid()
+    return _generator.next_id()
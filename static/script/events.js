@@ -0,0 +1,36 @@
+// Live updates from /events (see events.py): badge counts for new follow
+// requests and DMs, new DMs in the open conversation, and like counts on
+// the user's messages. EventSource reconnects by itself when the server
+// closes the stream; a 204 (logged out) stops it.
+
+if (window.EventSource && document.getElementById('dm-badge')) {
+    const source = new EventSource('/events')
+    const refreshBadges = e => updateBadges(JSON.parse(e.data))
+
+    source.addEventListener('notification', refreshBadges)
+    source.addEventListener('read', refreshBadges)
+
+    source.addEventListener('dm', function (e) {
+        const dm = JSON.parse(e.data)
+        updateBadges(dm)
+
+        const thread = document.querySelector(`[data-conversation-id="${dm.conversation_id}"] .messages`)
+        if (!thread) return
+        const card = document.createElement('div')
+        card.className = 'dm-card-new'
+        const text = document.createElement('p')
+        text.className = 'dm-text'
+        text.textContent = dm.text
+        card.append(text)
+        // below the "Mark all as read" form, above the older DMs
+        const form = thread.querySelector('form.bulk-read')
+        form ? form.after(card) : thread.prepend(card)
+    })
+
+    source.addEventListener('like', function (e) {
+        const like = JSON.parse(e.data)
+        const icon = document.getElementById(like.message_id)
+        if (!icon || !icon.closest('button')) return
+        icon.closest('button').title = `${like.likes} ${like.likes === 1 ? 'like' : 'likes'}`
+    })
+}
@@ -1,22 +1,20 @@
+// delegated, so cards added later (see timeline.js) work too
+document.addEventListener('click', async function (e) {
+    const btn = e.target.closest('button.messages-form')
+    if (!btn) return
+    e.preventDefault()
+    const messageId = btn.querySelector('i').id
+    // ask for the state we want rather than a flip, so a double click
+    // can't undo itself
+    const wanted = !btn.classList.contains('btn-primary')
+    const resp = await axios.post(`/messages/${messageId}/like`, {liked: wanted})
 
-const btns = document.querySelectorAll('.btn')
-
-btns.forEach(function (e) {
-    e.addEventListener('click', async function(e){
-        e.preventDefault()
-        messageId = (e.target.id).toString()
-        await axios.post(`/users/add_like/${messageId}`)
-        
-        let btn = (e.target.closest("button"))
-        if (btn.classList.contains('btn-primary')) {
-            btn.classList.remove('btn-primary')
-            btn.classList.add('btn-secondary')
-        }
-        else {
-            btn.classList.remove('btn-secondary')
-            btn.classList.add('btn-primary')
-        }
-        
-    })
+    if (typeof resp.data.liked !== 'boolean') {
+        // logged out: the server redirected us to a page instead
+        window.location = '/'
+        return
+    }
+    btn.classList.toggle('btn-primary', resp.data.liked)
+    btn.classList.toggle('btn-secondary', !resp.data.liked)
+    btn.title = `${resp.data.likes} ${resp.data.likes === 1 ? 'like' : 'likes'}`
 })
-
@@ -0,0 +1,25 @@
+
+const searchInput = document.getElementById('search')
+const suggestionList = document.getElementById('search-suggestions')
+let suggestTimer = null
+
+if (searchInput) {
+    searchInput.addEventListener('input', function(e) {
+        clearTimeout(suggestTimer)
+        let prefix = searchInput.value.trim()
+        if (prefix.length < 2) {
+            suggestionList.innerHTML = ""
+            return
+        }
+        suggestTimer = setTimeout(async function() {
+            let resp = await fetch(`/users/suggest?q=${encodeURIComponent(prefix)}`)
+            let data = await resp.json()
+            suggestionList.innerHTML = ""
+            data.users.forEach(function(user) {
+                let option = document.createElement('option')
+                option.value = user.username
+                suggestionList.appendChild(option)
+            })
+        }, 150)
+    })
+}
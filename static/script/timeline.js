@@ -0,0 +1,36 @@
+// Polls /timelines/<home|global> for warbles newer than the top of the page
+// and adds them above it. The server answers 304 when nothing changed, so a
+// quiet poll costs one indexed lookup; hidden tabs don't poll at all.
+
+const timeline = document.querySelector('#messages[data-timeline]')
+
+if (timeline) {
+    const POLL_MS = 30000
+    let etag = null
+    let polling = false
+
+    async function poll() {
+        if (document.hidden || polling) return
+        polling = true
+        try {
+            const url = `/timelines/${timeline.dataset.timeline}?since=${timeline.dataset.latest}`
+            const resp = await fetch(url, {
+                headers: etag ? {'If-None-Match': etag} : {},
+                cache: 'no-store',
+                credentials: 'same-origin',
+            })
+            if (!resp.ok) return  // 304s included
+            etag = resp.headers.get('ETag')
+            const data = await resp.json()
+            // oldest first, so each goes on top of the one before
+            data.messages.forEach(msg => timeline.insertAdjacentHTML('afterbegin', msg.html))
+            timeline.dataset.latest = data.latest
+            if (data.more) setTimeout(poll, 0)
+        } finally {
+            polling = false
+        }
+    }
+
+    setInterval(poll, POLL_MS)
+    document.addEventListener('visibilitychange', poll)
+}
@@ -0,0 +1,46 @@
+// Navbar badges, and the bulk "mark as read" / "clear" forms.
+//
+// A form.bulk-read is posted as JSON (with its data-up-to, if any); the
+// response carries the fresh badge counts, so the page is updated in place
+// instead of reloaded. Elements matching the form's data-covers selector
+// (and, with data-up-to, whose data-item-id is no greater) are the items it
+// read: they're removed if the form has data-remove, otherwise shown as read.
+
+function setBadge(id, count) {
+    const badge = document.getElementById(id)
+    if (!badge) return
+    badge.textContent = count
+    badge.classList.toggle('d-none', !count)
+}
+
+function updateBadges(counts) {
+    setBadge('notification-badge', counts.pending_notifications)
+    setBadge('dm-badge', counts.unread_dms)
+}
+
+document.querySelectorAll('form.bulk-read').forEach(function (form) {
+    form.addEventListener('submit', async function (e) {
+        e.preventDefault()
+        const upTo = form.dataset.upTo
+        const resp = await axios.post(form.action, upTo ? {up_to: upTo} : {})
+
+        if (typeof resp.data.unread_dms !== 'number') {
+            // logged out: the server redirected us to a page instead
+            window.location = '/'
+            return
+        }
+        updateBadges(resp.data)
+
+        // ids can be snowflakes, too big for a JavaScript number
+        document.querySelectorAll(form.dataset.covers).forEach(function (item) {
+            if (upTo && BigInt(item.dataset.itemId) > BigInt(upTo)) return
+            if ('remove' in form.dataset) {
+                item.remove()
+                return
+            }
+            item.classList.replace('dm-card-new', 'dm-card')
+            item.querySelectorAll('.unread-only').forEach(el => el.remove())
+        })
+        form.classList.add('d-none')
+    })
+})
@@ -0,0 +1,212 @@
+"""DM conversation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_conversations.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Conversation, DirectMessage, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from conversations import conversation_between, mark_read, read_inbox, read_thread, rebuild_conversations, send_dm
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATELIMIT_ENABLED'] = False
+
+
+class ConversationTestCase(TestCase):
+    """Test conversations, the inbox and threads."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None) for i in range(4)]
+        db.session.commit()
+        self.ids = [user.id for user in users]
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_send_dm(self):
+        """Is there one conversation per pair, whichever way the DMs go?"""
+        a, b = self.ids[0], self.ids[1]
+        send_dm(b, a, "hi a")
+        send_dm(a, b, "hi b")
+        send_dm(b, a, "again")
+        db.session.commit()
+
+        conversation = Conversation.query.one()
+        self.assertEqual((conversation.user_low_id, conversation.user_high_id), (min(a, b), max(a, b)))
+        self.assertEqual(conversation.last_message_preview, "again")
+        self.assertEqual(conversation.last_sender_id, b)
+        self.assertEqual(conversation.other_user_id(a), b)
+        self.assertEqual(DirectMessage.query.filter_by(conversation_id=conversation.id).count(), 3)
+
+        [row] = read_inbox(a)[0]
+        self.assertEqual((row.other_id, row.unread), (b, 2))
+        [row] = read_inbox(b)[0]
+        self.assertEqual((row.other_id, row.unread), (a, 1))
+
+    def test_inbox_order_and_pages(self):
+        """Is the inbox most recent first, across both sides of each pair?"""
+        me = self.ids[1]
+        for other in [self.ids[0], self.ids[2], self.ids[3]]:
+            send_dm(other, me, f"from {other}")
+            db.session.commit()
+        send_dm(me, self.ids[0], "back to 0")
+        db.session.commit()
+
+        rows, cursor = read_inbox(me, limit=2)
+        self.assertEqual([row.other_id for row in rows], [self.ids[0], self.ids[3]])
+        self.assertIsNotNone(cursor)
+        rows, cursor = read_inbox(me, before=cursor, limit=2)
+        self.assertEqual([row.other_id for row in rows], [self.ids[2]])
+        self.assertIsNone(cursor)
+
+    def test_self_conversation(self):
+        """Does a conversation with yourself show up once?"""
+        me = self.ids[2]
+        send_dm(me, me, "note to self")
+        db.session.commit()
+        rows, _ = read_inbox(me)
+        self.assertEqual([row.other_id for row in rows], [me])
+
+    def test_thread_pages(self):
+        a, b = self.ids[0], self.ids[1]
+        for i in range(5):
+            send_dm(a, b, f"dm {i}")
+        db.session.commit()
+        conversation = conversation_between(b, a)
+
+        dms, cursor = read_thread(conversation, limit=3)
+        self.assertEqual([dm.message_text for dm in dms], ["dm 4", "dm 3", "dm 2"])
+        dms, cursor = read_thread(conversation, before=cursor, limit=3)
+        self.assertEqual([dm.message_text for dm in dms], ["dm 1", "dm 0"])
+        self.assertIsNone(cursor)
+
+    def test_mark_read(self):
+        """Does reading a DM take it off the recipient's unread count?"""
+        a, b = self.ids[0], self.ids[1]
+        dm = send_dm(a, b, "read me")
+        db.session.commit()
+        dm_id = dm.id
+
+        self.login(a)
+        self.client.post(f'/messages/{dm_id}/markread')
+        self.assertTrue(DirectMessage.query.get(dm_id).is_new)
+
+        self.login(b)
+        resp = self.client.post(f'/messages/{dm_id}/markread')
+        self.assertEqual(resp.status_code, 302)
+        self.assertIn('/messages/conversations/', resp.location)
+        resp = self.client.post(f'/messages/{dm_id}/markread')
+        [row] = read_inbox(b)[0]
+        self.assertEqual(row.unread, 0)
+
+    def test_mark_read_up_to(self):
+        """Does a bulk read mark only the DMs asked for and keep each side's
+        count in step?"""
+        a, b, c = self.ids[:3]
+        first = send_dm(a, b, "one")
+        send_dm(b, a, "to a")
+        db.session.commit()
+        up_to = first.id
+        send_dm(a, b, "two")
+        send_dm(c, b, "from c")
+        db.session.commit()
+        conversation = conversation_between(a, b)
+
+        self.assertEqual(mark_read(b, conversation.id, up_to=up_to), 1)
+        db.session.commit()
+        self.assertEqual(conversation.unread_for(b), 1)
+        self.assertEqual(conversation.unread_for(a), 1)
+
+        self.assertEqual(mark_read(b), 2)
+        db.session.commit()
+        self.assertEqual(DirectMessage.query.filter_by(dm_to=b, is_new=True).count(), 0)
+        self.assertEqual([row.unread for row in read_inbox(b)[0]], [0, 0])
+        self.assertEqual(conversation.unread_for(a), 1)
+
+    def test_mark_read_routes(self):
+        """Do the bulk routes answer with fresh badge counts, and refuse
+        conversations the user isn't in?"""
+        a, b, c = self.ids[:3]
+        for text in ("one", "two", "three"):
+            send_dm(a, b, text)
+        send_dm(c, b, "from c")
+        db.session.commit()
+        conversation = conversation_between(a, b)
+        newest = DirectMessage.query.filter_by(conversation_id=conversation.id).order_by(DirectMessage.id.desc()).first()
+
+        self.login(b)
+        resp = self.client.get('/messages/direct-messages')
+        self.assertIn(b'id="dm-badge">4<', resp.data)
+        resp = self.client.post(f'/messages/conversations/{conversation.id}/read', json={'up_to': newest.id - 1})
+        self.assertEqual(resp.json, {'conversation_id': conversation.id, 'marked': 2, 'unread': 1,
+                                     'unread_dms': 2, 'pending_notifications': 0})
+        resp = self.client.post('/messages/direct-messages/read', json={})
+        self.assertEqual(resp.json, {'marked': 2, 'unread_dms': 0, 'pending_notifications': 0})
+        resp = self.client.post('/messages/direct-messages/read')
+        self.assertEqual(resp.status_code, 302)
+
+        self.login(c)
+        resp = self.client.post(f'/messages/conversations/{conversation.id}/read', json={})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_rebuild(self):
+        """Does a rebuild match what sending built, for bulk-loaded DMs too?"""
+        a, b, c = self.ids[:3]
+        send_dm(a, b, "one")
+        send_dm(b, a, "two")
+        db.session.commit()
+        start = datetime.utcnow()
+        db.session.add(DirectMessage(dm_from=c, dm_to=a, message_text="loaded", timestamp=start + timedelta(1)))
+        db.session.commit()
+
+        self.assertEqual(rebuild_conversations(), 2)
+        rows, _ = read_inbox(a)
+        self.assertEqual([(row.other_id, row.last_message_preview, row.unread) for row in rows],
+                         [(c, "loaded", 1), (b, "two", 1)])
+        self.assertEqual(DirectMessage.query.filter(DirectMessage.conversation_id == None).count(), 0)
+
+    def test_routes(self):
+        """Can only the two participants open a conversation?"""
+        a, b, c = self.ids[:3]
+        self.login(a)
+        resp = self.client.post(f'/messages/{b}/reply', data={'message_text': "hello there"})
+        conversation = conversation_between(a, b)
+        self.assertEqual(resp.location.split('/')[-1], str(conversation.id))
+
+        resp = self.client.get('/messages/direct-messages')
+        self.assertIn(b'hello there', resp.data)
+        self.assertIn(b'user1', resp.data)
+
+        self.login(b)
+        resp = self.client.get(f'/messages/conversations/{conversation.id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'hello there', resp.data)
+        self.assertIn(b'Mark As Read', resp.data)
+
+        self.login(c)
+        resp = self.client.get(f'/messages/conversations/{conversation.id}')
+        self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,163 @@
+"""Live update (Server-Sent Events) tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_events.py
+
+
+import os
+import queue
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, Message, Notification, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from conversations import send_dm
+import events
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATELIMIT_ENABLED'] = False
+
+
+def wait_for(items, count, timeout=2):
+    deadline = time.monotonic() + timeout
+    while len(items) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return items
+
+
+class BrokerTestCase(TestCase):
+    """Test the in-process broker and the socket fanout."""
+
+    def test_deliver(self):
+        broker = events.Broker(queue_size=2)
+        mine, other = broker.subscribe(1), broker.subscribe(2)
+        broker.deliver(1, 'read', {})
+        self.assertEqual(mine.get_nowait(), ('read', {}))
+        self.assertTrue(other.empty())
+
+        for _ in range(3):
+            broker.deliver(1, 'read', {})
+        self.assertEqual(mine.qsize(), 2)
+
+        broker.unsubscribe(1, mine)
+        broker.deliver(1, 'read', {})
+        self.assertEqual(len(broker), 1)
+
+    def test_socket_fanout(self):
+        """Does an event reach every process's socket, and is a dead
+        process's socket cleaned up?"""
+        with tempfile.TemporaryDirectory() as directory:
+            config = {'EVENTS_SOCKET_DIR': directory}
+            first, second = [], []
+            a = events.SocketFanout(config, lambda *e: first.append(e), name='a')
+            b = events.SocketFanout(config, lambda *e: second.append(e), name='b')
+            a.start()
+            b.start()
+            dead = os.path.join(directory, 'dead.sock')
+            open(dead, 'w').close()
+
+            a.publish([(7, 'like', {'message_id': '12', 'likes': 3})])
+            self.assertEqual(wait_for(first, 1), [(7, 'like', {'message_id': '12', 'likes': 3})])
+            self.assertEqual(wait_for(second, 1), first)
+            self.assertFalse(os.path.exists(dead))
+
+
+class EventStreamTestCase(TestCase):
+    """Test which commits send events, and the /events stream."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        app.config['EVENTS_FANOUT'] = 'local'
+        app.config['EVENTS_KEEPALIVE'] = 1
+        app.config['EVENTS_MAX_AGE'] = 1
+        events.reset()
+        self.client = app.test_client()
+
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None) for i in range(2)]
+        db.session.commit()
+        self.a, self.b = [user.id for user in users]
+        with app.test_request_context():
+            self.broker, _ = events.get_broker()
+
+    def tearDown(self):
+        db.session.rollback()
+        events.reset()
+        app.config.pop('EVENTS_FANOUT')
+        app.config['EVENTS_KEEPALIVE'] = events.DEFAULT_KEEPALIVE
+        app.config['EVENTS_MAX_AGE'] = events.DEFAULT_MAX_AGE
+
+    def drain(self, stream):
+        items = []
+        while True:
+            try:
+                items.append(stream.get_nowait())
+            except queue.Empty:
+                return items
+
+    def test_sent_on_commit(self):
+        """Are DMs and notifications sent once committed, and only then?"""
+        stream = self.broker.subscribe(self.b)
+        dm = send_dm(self.a, self.b, "hello")
+        db.session.flush()
+        self.assertEqual(self.drain(stream), [])
+        db.session.commit()
+        [(kind, data)] = self.drain(stream)
+        self.assertEqual((kind, data['id'], data['from_id'], data['text']), ('dm', dm.id, self.a, "hello"))
+
+        send_dm(self.a, self.b, "never mind")
+        db.session.rollback()
+        db.session.add(Notification(notification_txt="follow_request", from_id=self.a, to_id=self.b))
+        db.session.commit()
+        self.assertEqual([kind for kind, _ in self.drain(stream)], ['notification'])
+
+        dm = db.session.merge(dm)
+        dm.is_new = False
+        db.session.commit()
+        self.assertEqual(self.drain(stream), [('read', {})])
+
+    def test_like_sent_to_author(self):
+        message = Message(text="likable", user_id=self.a)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+        stream = self.broker.subscribe(self.a)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.b
+        self.client.post(f'/messages/{message_id}/like', json={'liked': True})
+        self.assertEqual(self.drain(stream), [('like', {'message_id': str(message_id), 'likes': 1})])
+
+    def test_stream(self):
+        """Does /events stream a DM sent after it opened, with badge counts?"""
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.b
+        resp = self.client.get('/events')
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+        send_dm(self.a, self.b, "are you there?")
+        db.session.commit()
+        body = resp.get_data(as_text=True)
+        resp.close()
+        self.assertIn('retry: ', body)
+        self.assertIn('event: dm\n', body)
+        self.assertIn('"text": "are you there?"', body)
+        self.assertIn('"unread_dms": 1', body)
+        self.assertEqual(len(self.broker), 0)
+
+    def test_logged_out(self):
+        self.assertEqual(self.client.get('/events').status_code, 204)
@@ -0,0 +1,91 @@
+"""SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from instrumentation import bind_shape, endpoint_stats, reset_endpoint_stats
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATELIMIT_ENABLED'] = False
+
+
+class InstrumentationTestCase(TestCase):
+    """Test Server-Timing, endpoint totals and the slow-query log."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        user = User.signup(username="testuser", email="test@test.com", password="testuser", image_url=None)
+        db.session.add(Message(text="hello", user=user))
+        db.session.commit()
+        self.user_id = user.id
+
+        app.config['SQL_INSTRUMENTATION'] = True
+        app.config['SLOW_QUERY_MS'] = 10_000
+        reset_endpoint_stats()
+
+    def tearDown(self):
+        app.config['SQL_INSTRUMENTATION'] = False
+        db.session.rollback()
+
+    def test_server_timing(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.get('/messages/all')
+        timing = resp.headers.get_all('Server-Timing')
+        self.assertEqual(len(timing), 2)
+        self.assertRegex(timing[0], r'^db;dur=[\d.]+;desc="[1-9]\d* queries"$')
+        self.assertRegex(timing[1], r'^app;dur=[\d.]+$')
+
+        self.client.get('/messages/all')
+        stats = endpoint_stats()['messages_show_all']
+        self.assertEqual(stats['requests'], 2)
+        self.assertGreater(stats['queries'], 0)
+
+    def test_off_by_default(self):
+        app.config['SQL_INSTRUMENTATION'] = False
+        resp = self.client.get('/login')
+        self.assertNotIn('Server-Timing', resp.headers)
+        self.assertEqual(endpoint_stats(), {})
+
+    def test_slow_query_log(self):
+        """Are slow statements logged with bind types but not values?"""
+        app.config['SLOW_QUERY_MS'] = 0
+        app.config['SLOW_QUERY_EXPLAIN'] = True
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        try:
+            with self.assertLogs('warbler.sql.slow', level='WARNING') as logs:
+                self.client.get(f'/users/{self.user_id}')
+        finally:
+            app.config['SLOW_QUERY_EXPLAIN'] = False
+
+        output = '\n'.join(logs.output)
+        self.assertIn('users_show', output)
+        self.assertIn('int', output)
+        self.assertNotIn('testuser@', output)
+
+    def test_bind_shape(self):
+        self.assertEqual(bind_shape({'id_1': 5, 'name': 'x'}), '{id_1: int, name: str}')
+        self.assertEqual(bind_shape((5, None)), '(int, NoneType)')
+        self.assertEqual(bind_shape([(1,), (2,)], executemany=True), '2 x (int)')
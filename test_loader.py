@@ -0,0 +1,97 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import csv
+import io
+import os
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase, skipUnless
+
+import psycopg2
+
+from models import db, Follows, Message, User, decode_cursor, encode_cursor
+from snowflake import id_time
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from loader import load_csvs
+
+GENERATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generator')
+
+
+def postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def csv_rows(filename):
+    with open(os.path.join(GENERATOR_DIR, filename), newline='') as f:
+        return list(csv.DictReader(f))
+
+
+class LoaderTestCase(TestCase):
+    """Test loading the CSVs in generator/."""
+
+    def setUp(self):
+        db.session.remove()
+        with redirect_stdout(io.StringIO()):
+            self.loaded = load_csvs(GENERATOR_DIR)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_counts(self):
+        self.assertEqual(self.loaded, {'users': len(csv_rows('users.csv')),
+                                       'messages': len(csv_rows('messages.csv')),
+                                       'follows': len(csv_rows('follows.csv'))})
+        self.assertEqual(Follows.query.count(), self.loaded['follows'])
+
+    def test_message_ids(self):
+        """Does a messages.csv without ids get snowflake ids from its
+        timestamps, so id order is time order?"""
+        messages = Message.query.order_by(Message.id).all()
+        self.assertEqual(len({msg.id for msg in messages}), len(csv_rows('messages.csv')))
+        self.assertEqual([msg.timestamp for msg in messages], sorted(msg.timestamp for msg in messages))
+        for msg in messages:
+            millis = msg.timestamp.microsecond // 1000 * 1000
+            self.assertEqual(id_time(msg.id), msg.timestamp.replace(microsecond=millis))
+
+        # the stock CSV predates the snowflake epoch
+        self.assertLess(messages[0].id, 0)
+        self.assertEqual(decode_cursor(encode_cursor(messages[0])), messages[0].id)
+        resp = app.test_client().get(f"/messages/{messages[0].id}")
+        self.assertIn(messages[0].text, resp.get_data(as_text=True))
+
+    def test_scalar_defaults(self):
+        """Are model defaults filled in for columns the CSV leaves out?"""
+        user = User.query.first()
+        self.assertFalse(user.is_admin)
+        self.assertEqual(user.message_count, 0)
+
+    @skipUnless(postgres(), "indexes and constraints are only dropped for a Postgres load")
+    def test_load_error_raised(self):
+        """When a COPY fails, is its error raised, not the foreign key
+        violation the partial data then causes when constraints are rebuilt?"""
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'users.csv'), 'w') as f:
+                f.write("id,email,username,password\n1,one@test.com,one,x\n")
+            with open(os.path.join(directory, 'messages.csv'), 'w') as f:
+                f.write("id,text,timestamp,user_id\n"
+                        "1,orphan,2021-05-01 00:00:00,99\n"
+                        "2,broken,not a time,1\n")
+            with redirect_stdout(io.StringIO()) as output, self.assertRaises(psycopg2.DataError):
+                load_csvs(directory, chunk_size=1)
+        self.assertIn("couldn't rebuild them", output.getvalue())
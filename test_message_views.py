@@ -32,6 +32,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Rate limits are exercised in test_ratelimit.py
+
+app.config['RATELIMIT_ENABLED'] = False
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -0,0 +1,70 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['RATELIMIT_ENABLED'] = False
+
+
+class MetricsTestCase(TestCase):
+    """Test the /metrics endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['METRICS_TOKEN'] = None
+
+    def test_request_and_template_metrics(self):
+        self.client.get('/login')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('text/plain', resp.content_type)
+
+        body = resp.get_data(as_text=True)
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="login",le="0.005",method="GET"}', body)
+        self.assertIn('warbler_requests_total{endpoint="login",status="200"}', body)
+        self.assertIn('warbler_template_render_seconds_count{template="users/login.html"}', body)
+        self.assertIn('warbler_db_pool_checked_out', body)
+
+    def test_token(self):
+        app.config['METRICS_TOKEN'] = 'sekrit'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        resp = self.client.get('/metrics', headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_detached_connection_not_checked_out(self):
+        """Does a connection taken out of the pool for good (as the events
+        LISTEN connection is) stop counting as checked out?"""
+        checked_out = lambda: REGISTRY.get_sample_value('warbler_db_pool_checked_out')
+        before = checked_out()
+        connection = db.engine.raw_connection()
+        self.assertEqual(checked_out(), before + 1)
+        connection.detach()
+        self.assertEqual(checked_out(), before)
+        connection.close()
+        self.assertEqual(checked_out(), before)
@@ -0,0 +1,364 @@
+"""Schema migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import (Boolean, Column, DateTime, ForeignKey, Integer, MetaData, String, Table, Text, and_, func,
+                        inspect, select)
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Block, Conversation, DirectMessage, Follows, Likes, Message, Notification, TimelineEntry, User, timeline_query
+from snowflake import id_time
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import migrations
+from conversations import rebuild_conversations
+from search import search_messages, search_users
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def index_names(table):
+    return {index['name'] for index in inspect(db.engine).get_indexes(table)}
+
+
+def baseline_metadata():
+    """The tables as they were before any revision: no counters, timelines,
+    conversations or search indexes."""
+    metadata = MetaData()
+    Table('users', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('email', Text, nullable=False, unique=True),
+          Column('username', Text, nullable=False, unique=True),
+          Column('image_url', Text),
+          Column('header_image_url', Text),
+          Column('bio', Text),
+          Column('location', Text),
+          Column('password', Text, nullable=False),
+          Column('is_private', Boolean, nullable=False),
+          Column('is_verified', Boolean, nullable=False),
+          Column('is_admin', Boolean, nullable=False))
+    Table('messages', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('text', String(280), nullable=False),
+          Column('timestamp', DateTime, nullable=False),
+          Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False))
+    Table('follows', metadata,
+          Column('user_being_followed_id', Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+          Column('user_following_id', Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True))
+    Table('likes', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade')),
+          Column('message_id', Integer, ForeignKey('messages.id', ondelete='cascade')))
+    Table('blocks', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('user', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+          Column('blocked_user', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False))
+    Table('dms', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('dm_from', Integer, ForeignKey('users.id'), nullable=False),
+          Column('dm_to', Integer, ForeignKey('users.id'), nullable=False),
+          Column('message_text', String(280), nullable=False),
+          Column('timestamp', DateTime, nullable=False),
+          Column('is_new', Boolean))
+    Table('notifications', metadata,
+          Column('id', Integer, primary_key=True),
+          Column('notification_txt', String(20), nullable=False),
+          Column('date', DateTime, nullable=False),
+          Column('from_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False),
+          Column('to_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False))
+    return metadata
+
+
+class MigrationTestCase(TestCase):
+    """Test the migration runner and the revisions."""
+
+    def setUp(self):
+        db.drop_all()
+        migrations.metadata.drop_all(db.engine)
+        db.create_all()
+        self.log = []
+
+        u1 = User.signup("one", "one@test.com", "password", None)
+        u2 = User.signup("two", "two@test.com", "password", None)
+        db.session.add(Message(text="hello", user=u1))
+        db.session.commit()
+        self.u1_id, self.u2_id = u1.id, u2.id
+        self.msg_id = u1.messages[0].id
+        # an idle transaction would block DROP / CREATE INDEX CONCURRENTLY,
+        # which waits out every transaction open when it starts
+        db.session.commit()
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_upgrade_is_recorded_once(self):
+        """Does upgrade apply every revision, then nothing the second time?"""
+        ran = migrations.upgrade(db.engine, '0001', log=self.log.append)
+        self.assertEqual([r.revision for r in ran], ['0000', '0001'])
+        self.assertEqual(migrations.current(db.engine), '0001')
+        self.assertEqual(migrations.upgrade(db.engine, '0001', log=self.log.append), [])
+        self.assertEqual(len(self.log), 2)
+
+    def test_stamp(self):
+        migrations.stamp(db.engine)
+        self.assertEqual(migrations.current(db.engine), migrations.revisions()[-1].revision)
+        self.assertEqual(migrations.upgrade(db.engine, log=self.log.append), [])
+
+    def test_unknown_revision(self):
+        with self.assertRaises(migrations.MigrationError):
+            migrations.upgrade(db.engine, '9999', log=self.log.append)
+
+    def test_downgrade_and_upgrade(self):
+        """Does 0001 build its indexes on a database that lacks them?"""
+        migrations.stamp(db.engine, '0001')
+        migrations.downgrade(db.engine, '0000', log=self.log.append)
+        self.assertEqual(migrations.current(db.engine), '0000')
+        self.assertNotIn('ix_follows_user_following_id', index_names('follows'))
+        self.assertNotIn('ix_dms_dm_to_unread', index_names('dms'))
+
+        migrations.upgrade(db.engine, '0001', log=self.log.append)
+        self.assertIn('ix_follows_user_following_id', index_names('follows'))
+        self.assertIn('ix_dms_dm_to_unread', index_names('dms'))
+
+    @skipUnless(postgres(), "SQLite can't drop a table's unique constraint")
+    def test_duplicates_removed(self):
+        """Are duplicate likes and blocks removed, and likes_count fixed?"""
+        migrations.stamp(db.engine, '0001')
+        migrations.downgrade(db.engine, '0000', log=self.log.append)
+        for _ in range(3):
+            db.session.add(Likes(user_id=self.u2_id, message_id=self.msg_id))
+            db.session.add(Block(user=self.u1_id, blocked_user=self.u2_id))
+        db.session.commit()
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 3)
+        db.session.commit()
+
+        migrations.upgrade(db.engine, '0001', log=self.log.append)
+        db.session.expire_all()
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Block.query.count(), 1)
+        self.assertEqual(User.query.get(self.u2_id).likes_count, 1)
+
+        db.session.add(Likes(user_id=self.u2_id, message_id=self.msg_id))
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+    def test_upgrade_from_baseline(self):
+        """Does a database from before any revision come up to date, with
+        counters, home timelines, conversations and search filled in?"""
+        db.session.remove()
+        db.drop_all()
+        baseline = baseline_metadata()
+        baseline.create_all(db.engine)
+        then = datetime(2021, 5, 1)
+        with db.engine.begin() as connection:
+            connection.execute(baseline.tables['users'].insert(), [
+                {'id': i, 'email': f'{name}@test.com', 'username': name, 'password': 'x',
+                 'is_private': False, 'is_verified': False, 'is_admin': False}
+                for i, name in [(1, 'one'), (2, 'two')]])
+            connection.execute(baseline.tables['messages'].insert(), [
+                {'id': 1, 'text': 'hello', 'timestamp': then, 'user_id': 1},
+                {'id': 2, 'text': 'hi', 'timestamp': then, 'user_id': 2}])
+            connection.execute(baseline.tables['follows'].insert(),
+                               {'user_being_followed_id': 1, 'user_following_id': 2})
+            connection.execute(baseline.tables['likes'].insert(), {'user_id': 2, 'message_id': 1})
+            connection.execute(baseline.tables['dms'].insert(), {
+                'dm_from': 1, 'dm_to': 2, 'message_text': 'psst', 'timestamp': then, 'is_new': True})
+
+        ran = migrations.upgrade(db.engine, log=self.log.append)
+        self.assertEqual([r.revision for r in ran], [r.revision for r in migrations.revisions()])
+        one, two = User.query.get(1), User.query.get(2)
+        self.assertEqual((one.message_count, one.follower_count, one.likes_count), (1, 1, 0))
+        self.assertEqual((two.message_count, two.following_count, two.likes_count), (1, 1, 1))
+        home = TimelineEntry.query.filter_by(user_id=2).order_by(TimelineEntry.message_id).all()
+        self.assertEqual([entry.author_id for entry in home], [1, 2])
+        self.assertEqual([entry.message_id for entry in home],
+                         [msg.id for msg in Message.query.order_by(Message.id)])
+        self.assertEqual(Likes.query.one().message_id, home[0].message_id)
+        self.assertEqual(Conversation.query.one().high_unread, 1)
+        self.assertEqual([user.id for user in search_users("two")[0]], [2])
+
+    def test_message_ids_renumbered(self):
+        """Does 0002 give old messages increasing snowflake ids, in their
+        old order, and carry likes and timeline entries along?"""
+        messages = [Message(id=1000 + i, text=f"old {i}", user_id=self.u1_id,
+                            timestamp=datetime(2021, 5, 1)) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add(Likes(user_id=self.u2_id, message_id=1001))
+        db.session.add(TimelineEntry(user_id=self.u2_id, message_id=1002, author_id=self.u1_id))
+        db.session.commit()
+        migrations.stamp(db.engine, '0001')
+
+        migrations.upgrade(db.engine, log=self.log.append)
+        db.session.expire_all()
+        renumbered = Message.query.filter(Message.text.like('old %')).order_by(Message.id).all()
+        self.assertEqual([m.text for m in renumbered], ['old 0', 'old 1', 'old 2'])
+        self.assertEqual(id_time(renumbered[0].id), datetime(2021, 5, 1))
+        self.assertEqual(Likes.query.one().message_id, renumbered[1].id)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2_id).one().message_id,
+                         renumbered[2].id)
+        self.assertIn('ix_messages_user_id_id', index_names('messages'))
+
+    def test_conversations_backfilled(self):
+        """Does 0003 give existing DMs one conversation per pair, with the
+        latest DM's preview and each side's unread count?"""
+        migrations.stamp(db.engine)
+        migrations.downgrade(db.engine, '0002', log=self.log.append)
+        self.assertNotIn('conversations', inspect(db.engine).get_table_names())
+        for sender, recipient, text in [(self.u1_id, self.u2_id, "hi"), (self.u2_id, self.u1_id, "hey"),
+                                        (self.u1_id, self.u2_id, "how are you?")]:
+            db.session.execute(DirectMessage.__table__.insert().values(
+                dm_from=sender, dm_to=recipient, message_text=text, is_new=True))
+        db.session.commit()
+
+        migrations.upgrade(db.engine, log=self.log.append)
+        conversation = Conversation.query.one()
+        unread = {conversation.user_low_id: conversation.low_unread,
+                  conversation.user_high_id: conversation.high_unread}
+        self.assertEqual(unread, {self.u1_id: 1, self.u2_id: 2})
+        self.assertEqual(conversation.last_message_preview, "how are you?")
+        self.assertEqual(conversation.last_sender_id, self.u1_id)
+        self.assertEqual(DirectMessage.query.filter_by(conversation_id=conversation.id).count(), 3)
+        self.assertIn('ix_dms_conversation_id', index_names('dms'))
+
+    def test_search_indexes(self):
+        """Does 0004 give a database without them the search indexes,
+        indexing the users and messages already there?"""
+        migrations.stamp(db.engine)
+        migrations.downgrade(db.engine, '0003', log=self.log.append)
+        if postgres():
+            self.assertNotIn('ix_users_search_trgm', index_names('users'))
+        else:
+            self.assertNotIn('users_fts', inspect(db.engine).get_table_names())
+            self.assertNotIn('messages_fts', inspect(db.engine).get_table_names())
+
+        migrations.upgrade(db.engine, log=self.log.append)
+        self.assertEqual([user.id for user in search_users("one")[0]], [self.u1_id])
+        messages, _ = search_messages(User.query.get(self.u2_id), "hello")
+        self.assertEqual([msg.id for msg in messages], [self.msg_id])
+        if postgres():
+            self.assertIn('ix_users_search_trgm', index_names('users'))
+            self.assertIn('ix_messages_text_fts', index_names('messages'))
+        else:
+            trigger = db.session.execute("SELECT sql FROM sqlite_master WHERE name = 'users_fts_au'").scalar()
+            self.assertIn('UPDATE OF username, location, bio', trigger)
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the hot queries and check each one searches an index.
+
+    The tables are tiny, so on Postgres sequential scans are switched off
+    for the transaction: the question is whether an index *can* serve the
+    query, not whether the planner prefers it for ten rows.
+    """
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None) for i in range(10)]
+        db.session.commit()
+        for i, user in enumerate(users):
+            db.session.add(Message(text=f"warble {i}", user_id=user.id))
+            db.session.add(Follows(user_being_followed_id=users[i - 1].id, user_following_id=user.id))
+            db.session.add(Block(user=user.id, blocked_user=users[i - 2].id))
+            db.session.add(DirectMessage(dm_from=user.id, dm_to=users[i - 1].id, message_text="hi"))
+            db.session.add(Notification(notification_txt="follow", from_id=user.id, to_id=users[i - 1].id))
+        db.session.commit()
+        for i, user in enumerate(users):
+            db.session.add(Likes(user_id=user.id, message_id=users[i - 3].messages[0].id))
+        db.session.commit()
+        rebuild_conversations()
+        self.user_id = users[0].id
+        self.other_id = users[1].id
+
+        if postgres():
+            db.session.execute('ANALYZE')
+            db.session.execute('SET LOCAL enable_seqscan = off')
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def plan(self, query):
+        statement = getattr(query, 'statement', query)
+        sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+        prefix = 'EXPLAIN ' if postgres() else 'EXPLAIN QUERY PLAN '
+        rows = db.session.execute(prefix + sql).fetchall()
+        return '\n'.join(str(row[-1]) for row in rows)
+
+    def assertSearchesIndex(self, query, table):
+        plan = self.plan(query)
+        if postgres():
+            self.assertNotIn(f'Seq Scan on {table}', plan)
+            self.assertRegex(plan, rf'Index (Only )?Scan( Backward)? using \w+ on {table}|Bitmap Index Scan')
+        else:
+            self.assertRegex(plan, rf'SEARCH (TABLE )?{table}\b.*INDEX')
+        return plan
+
+    def test_profile_messages(self):
+        """One author's messages, newest first, with no sort step."""
+        plan = self.assertSearchesIndex(timeline_query()
+                                        .filter(Message.user_id == self.user_id)
+                                        .order_by(Message.id.desc())
+                                        .limit(100), 'messages')
+        self.assertNotRegex(plan, r'Sort|TEMP B-TREE')
+
+    def test_like_lookup(self):
+        self.assertSearchesIndex(Likes.query.filter_by(user_id=self.user_id, message_id=1), 'likes')
+
+    def test_user_likes(self):
+        self.assertSearchesIndex(Likes.query.filter_by(user_id=self.user_id), 'likes')
+
+    def test_block_lookup(self):
+        self.assertSearchesIndex(Block.query.filter_by(user=self.user_id, blocked_user=self.other_id), 'blocks')
+
+    def test_unread_dms(self):
+        self.assertSearchesIndex(select([func.count()])
+                                 .where(and_(DirectMessage.dm_to == self.user_id, DirectMessage.is_new == True)),
+                                 'dms')
+
+    def test_inbox(self):
+        self.assertSearchesIndex(DirectMessage.query.filter_by(dm_to=self.user_id), 'dms')
+
+    def test_conversation_inbox(self):
+        for column in (Conversation.user_low_id, Conversation.user_high_id):
+            plan = self.assertSearchesIndex(Conversation.query
+                                            .filter(column == self.user_id)
+                                            .order_by(Conversation.last_message_at.desc(), Conversation.id.desc())
+                                            .limit(30), 'conversations')
+            self.assertNotRegex(plan, r'Sort|TEMP B-TREE')
+
+    def test_thread(self):
+        self.assertSearchesIndex(DirectMessage.query
+                                 .filter(DirectMessage.conversation_id == 1)
+                                 .order_by(DirectMessage.id.desc())
+                                 .limit(50), 'dms')
+
+    def test_notifications(self):
+        self.assertSearchesIndex(Notification.query.filter_by(to_id=self.user_id), 'notifications')
+
+    def test_following(self):
+        """Who a user follows: the column the primary key doesn't lead with."""
+        self.assertSearchesIndex(db.session.query(Follows.user_being_followed_id)
+                                 .filter(Follows.user_following_id == self.user_id), 'follows')
@@ -0,0 +1,124 @@
+"""Password hashing pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+import importlib.util
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, skipUnless
+
+import passwords
+from passwords import HASHING_OFFSET, HostSlots, PasswordHasherBusy
+
+# a gunicorn gevent worker: patched first, then many greenlets hashing at once
+GEVENT_WORKER = """
+from gevent import monkey
+monkey.patch_all()
+
+import sys
+import gevent
+import passwords
+
+passwords.settings.update(rounds=10, workers=2, queue=2, storage=sys.argv[1])
+outcomes = []
+ticks = []
+
+def login():
+    try:
+        passwords.check_password(passwords.hash_password('password'), 'password')
+        outcomes.append('ok')
+    except passwords.PasswordHasherBusy:
+        outcomes.append('busy')
+
+def tick():
+    while len(outcomes) < 12:
+        ticks.append(1)
+        gevent.sleep(0.005)
+
+gevent.joinall([gevent.spawn(login) for _ in range(12)] + [gevent.spawn(tick)], timeout=30)
+print(outcomes.count('ok'), outcomes.count('busy'), len(ticks))
+"""
+
+
+def hold_slots(path, count, offset, held, done):
+    """Another process (another gunicorn worker) taking `count` slots."""
+    slots = HostSlots(path, count, offset)
+    for _ in range(count):
+        slots.acquire()
+    held.set()
+    done.wait(10)
+
+
+class PasswordPoolTestCase(TestCase):
+    """Test the slots shared by every worker on a host."""
+
+    def setUp(self):
+        self.saved = dict(passwords.settings)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'slots')
+        passwords.settings.update(rounds=4, workers=1, queue=1, timeout=10, storage=self.path)
+        passwords._pool = None
+
+    def tearDown(self):
+        passwords.settings.update(self.saved)
+        passwords._pool = None
+        self.tmp.cleanup()
+
+    def elsewhere(self, count, offset=0):
+        """Hold `count` slots from another process until the returned event is set."""
+        held, done = multiprocessing.Event(), multiprocessing.Event()
+        process = multiprocessing.Process(target=hold_slots, args=(self.path, count, offset, held, done))
+        process.start()
+        self.assertTrue(held.wait(10))
+        self.addCleanup(process.join)
+        self.addCleanup(done.set)
+        return done, process
+
+    def test_slots_are_shared(self):
+        """Do slots taken in one process count in another, and come back
+        when that process exits?"""
+        done, process = self.elsewhere(2)
+        slots = HostSlots(self.path, 2)
+        self.assertIsNone(slots.acquire())
+        done.set()
+        process.join()
+        self.assertEqual({slots.acquire(), slots.acquire()}, {0, 1})
+        self.assertIsNone(slots.acquire())
+
+    def test_busy_when_host_queue_full(self):
+        """Is a hash turned away when other workers fill the queue?"""
+        self.elsewhere(2)
+        with self.assertRaises(PasswordHasherBusy):
+            passwords.hash_password('password')
+
+    def test_timeout_is_busy(self):
+        """Does a hash that can't get a hashing slot in time count as busy?"""
+        passwords.settings['timeout'] = 0.2
+        self.elsewhere(1, HASHING_OFFSET)
+        with self.assertRaises(PasswordHasherBusy):
+            passwords.hash_password('password')
+
+    def test_hash_and_check(self):
+        hashed = passwords.hash_password('password')
+        self.assertTrue(passwords.check_password(hashed, 'password'))
+        self.assertFalse(passwords.check_password(hashed, 'wrong'))
+
+    @skipUnless(importlib.util.find_spec('gevent'), "gevent isn't installed")
+    def test_gevent_worker(self):
+        """Under gevent, do hashes past the limits get a busy answer while
+        the rest complete, without blocking other greenlets?"""
+        result = subprocess.run([sys.executable, '-c', GEVENT_WORKER, self.path],
+                                capture_output=True, text=True, timeout=60,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0, result.stderr)
+        ok, busy, ticks = map(int, result.stdout.split())
+        self.assertEqual(ok + busy, 12)
+        self.assertGreaterEqual(ok, 1)
+        self.assertGreaterEqual(busy, 1)
+        self.assertGreater(ticks, 1)
@@ -0,0 +1,117 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import ratelimit
+from ratelimit import MemoryBackend, MmapBackend, parse_limit
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TokenBucketTestCase(TestCase):
+    """Test the bucket backends on their own."""
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit('10/minute'), (10, 10 / 60))
+        self.assertEqual(parse_limit('2/second'), (2, 2))
+
+    def test_memory_bucket(self):
+        backend = MemoryBackend()
+        for _ in range(3):
+            self.assertEqual(backend.consume('k', 3, 1, now=100), (True, 0))
+        allowed, retry_after = backend.consume('k', 3, 1, now=100)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 1)
+        # one token back after a second; other keys have their own bucket
+        self.assertTrue(backend.consume('k', 3, 1, now=101)[0])
+        self.assertTrue(backend.consume('other', 3, 1, now=101)[0])
+
+    def test_mmap_bucket_is_shared(self):
+        """Do two mappings of the same file (two workers) share buckets?"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'buckets')
+            first = MmapBackend(path, slots=64)
+            second = MmapBackend(path, slots=64)
+            self.assertTrue(first.consume('login:ip:1.2.3.4', 2, 0.5, now=10)[0])
+            self.assertTrue(second.consume('login:ip:1.2.3.4', 2, 0.5, now=10)[0])
+            allowed, retry_after = first.consume('login:ip:1.2.3.4', 2, 0.5, now=10)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(retry_after, 2)
+            self.assertTrue(second.consume('login:ip:5.6.7.8', 2, 0.5, now=10)[0])
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test limits on real endpoints."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.client = app.test_client()
+        self.user = User.signup(username="testuser", email="test@test.com", password="testuser", image_url=None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        app.config['RATELIMIT_ENABLED'] = True
+        app.config['RATELIMIT_BACKEND'] = 'memory'
+        app.config['RATE_LIMITS'] = {'login': {'ip': '2/minute'},
+                                     'messages_add': {'user': '1/minute'}}
+        ratelimit.reset_backend()
+
+    def tearDown(self):
+        app.config['RATELIMIT_ENABLED'] = False
+        app.config.pop('RATE_LIMITS')
+        ratelimit.reset_backend()
+        db.session.rollback()
+
+    def test_login_limited_before_bcrypt(self):
+        """Is the third login a 429 that never reaches User.authenticate?"""
+        form = {'username': 'testuser', 'password': 'wrong'}
+        self.assertEqual(self.client.post('/login', data=form).status_code, 200)
+        self.assertEqual(self.client.post('/login', data=form).status_code, 200)
+
+        with patch.object(User, 'authenticate') as authenticate:
+            resp = self.client.post('/login', data=form)
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp.headers)
+        authenticate.assert_not_called()
+
+        # viewing the form isn't limited
+        self.assertEqual(self.client.get('/login').status_code, 200)
+
+    def test_per_user_limit(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        resp = self.client.post('/messages/new', data={'text': 'first'})
+        self.assertEqual(resp.status_code, 302)
+        resp = self.client.post('/messages/new', data={'text': 'second'})
+        self.assertEqual(resp.status_code, 429)
+
+        # a different user has their own bucket
+        other = User.signup(username="other", email="other@test.com", password="other", image_url=None)
+        db.session.commit()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = other.id
+        resp = self.client.post('/messages/new', data={'text': 'hello'})
+        self.assertEqual(resp.status_code, 302)
@@ -0,0 +1,99 @@
+"""Snowflake id and message timestamp tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import TestCase
+
+from models import db, Message, User
+from snowflake import MAX_SEQUENCE, SEQUENCE_BITS, SnowflakeGenerator, id_time, make_id
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SnowflakeTestCase(TestCase):
+    """Test the id generator."""
+
+    def test_parts(self):
+        clock = FakeClock(datetime(2024, 3, 1, tzinfo=timezone.utc).timestamp())
+        generator = SnowflakeGenerator(7, clock=clock)
+        first, second = generator.next_id(), generator.next_id()
+        self.assertEqual(id_time(first), datetime(2024, 3, 1))
+        self.assertEqual(first >> SEQUENCE_BITS & 1023, 7)
+        self.assertEqual(second, first + 1)
+        self.assertEqual(make_id(datetime(2024, 3, 1), worker_id=7), first)
+
+    def test_increasing(self):
+        generator = SnowflakeGenerator(1)
+        ids = [generator.next_id() for _ in range(20000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(ids[-1], 1 << 63)
+
+    def test_sequence_exhausted(self):
+        """A full millisecond borrows the next one instead of repeating."""
+        clock = FakeClock(1700000000.0)
+        generator = SnowflakeGenerator(0, clock=clock)
+        ids = [generator.next_id() for _ in range(MAX_SEQUENCE + 2)]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(id_time(ids[-1]) - id_time(ids[0]), timedelta(milliseconds=1))
+
+    def test_clock_backwards(self):
+        clock = FakeClock(1700000000.0)
+        generator = SnowflakeGenerator(0, clock=clock)
+        before = generator.next_id()
+        clock.now -= 5
+        self.assertGreater(generator.next_id(), before)
+
+    def test_worker_id_range(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(1024)
+
+
+class MessageIdTestCase(TestCase):
+    """Test ids and timestamps of new messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_new_messages(self):
+        """Are new messages time-ordered by id, with their own timestamps?"""
+        first = Message(text="first", user_id=self.user.id)
+        db.session.add(first)
+        db.session.commit()
+        time.sleep(0.01)
+        second = Message(text="second", user_id=self.user.id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreater(second.timestamp, first.timestamp)
+        self.assertLess(abs((id_time(first.id) - first.timestamp).total_seconds()), 1)
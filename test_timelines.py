@@ -0,0 +1,149 @@
+"""Materialized timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timelines.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Block, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from timelines import home_watermark, read_home_since, read_home_timeline, rebuild_timeline
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Rate limits are exercised in test_ratelimit.py
+
+app.config['RATELIMIT_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write home timelines."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+        db.session.add(Follows(user_being_followed_id=self.author_id,
+                               user_following_id=self.reader_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['TIMELINE_CELEBRITY_CUTOFF'] = 10000
+
+    def post_as(self, user_id, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            return c.post("/messages/new", data={"text": text})
+
+    def test_post_fans_out_to_followers(self):
+        self.post_as(self.author_id, "hello followers")
+
+        msg = Message.query.filter_by(text="hello followers").one()
+        owners = {e.user_id for e in TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(owners, {self.author_id, self.reader_id})
+
+        messages, cursor = read_home_timeline(User.query.get(self.reader_id))
+        self.assertEqual([m.text for m in messages], ["hello followers"])
+        self.assertIsNone(cursor)
+
+    def test_celebrity_merged_at_read_time(self):
+        app.config['TIMELINE_CELEBRITY_CUTOFF'] = 0
+        self.post_as(self.author_id, "too famous to fan out")
+
+        msg = Message.query.filter_by(text="too famous to fan out").one()
+        self.assertIsNone(TimelineEntry.query.get((self.reader_id, msg.id)))
+
+        messages, cursor = read_home_timeline(User.query.get(self.reader_id))
+        self.assertEqual([m.text for m in messages], ["too famous to fan out"])
+
+    def test_block_prunes_and_rebuild_matches(self):
+        self.post_as(self.author_id, "soon hidden")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+            c.post(f"/users/block/{self.author_id}")
+
+        reader = User.query.get(self.reader_id)
+        self.assertEqual(read_home_timeline(reader)[0], [])
+
+        rebuild_timeline(reader)
+        db.session.commit()
+        self.assertEqual(read_home_timeline(reader)[0], [])
+
+    def poll(self, name, since, etag=None, user_id=None):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id or self.reader_id
+            headers = {'If-None-Match': etag} if etag else {}
+            return c.get(f"/timelines/{name}?since={since}", headers=headers)
+
+    def test_home_since(self):
+        """Are newer messages read oldest first, celebrities' merged in?"""
+        self.post_as(self.author_id, "first")
+        first = Message.query.filter_by(text="first").one().id
+        self.post_as(self.author_id, "second")
+        app.config['TIMELINE_CELEBRITY_CUTOFF'] = 0
+        self.post_as(self.author_id, "famous now")
+        self.post_as(self.author_id, "and again")
+
+        reader = User.query.get(self.reader_id)
+        newest = Message.query.filter_by(text="and again").one().id
+        self.assertEqual(home_watermark(self.reader_id), newest)
+        messages, more = read_home_since(reader, first, limit=2)
+        self.assertEqual([m.text for m in messages], ["second", "famous now"])
+        self.assertTrue(more)
+        messages, more = read_home_since(reader, messages[-1].id, limit=2)
+        self.assertEqual([m.text for m in messages], ["and again"])
+        self.assertFalse(more)
+
+    def test_poll_new_messages(self):
+        """Does polling return only what's new, then 304 until that changes?"""
+        self.post_as(self.author_id, "seen already")
+        seen = str(Message.query.filter_by(text="seen already").one().id)
+
+        resp = self.poll("home", seen)
+        self.assertEqual(resp.json, {"messages": [], "more": False, "latest": seen})
+        self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+        etag = resp.headers["ETag"]
+        self.assertEqual(self.poll("home", seen, etag).status_code, 304)
+        self.assertEqual(self.poll("home", seen, etag, user_id=self.author_id).status_code, 200)
+
+        self.post_as(self.author_id, "fresh warble")
+        resp = self.poll("home", seen, etag)
+        self.assertEqual(resp.status_code, 200)
+        [msg] = resp.json["messages"]
+        self.assertEqual((msg["text"], msg["username"]), ("fresh warble", "author"))
+        self.assertIn("fresh warble", msg["html"])
+        self.assertEqual(resp.json["latest"], msg["id"])
+
+        resp = self.poll("global", seen)
+        self.assertEqual([m["text"] for m in resp.json["messages"]], ["fresh warble"])
+        self.assertEqual(self.poll("global", "nonsense").status_code, 400)
+        self.assertEqual(self.poll("elsewhere", seen).status_code, 404)
@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes, Notification, DirectMessage, recount_counters
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +23,12 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from unread import unread_counts
+from current_user import get_current_user
+import current_user
+import events
+import passwords
+import unread
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -139,3 +147,169 @@ class UserModelTestCase(TestCase):
         self.assertEqual(u.authenticate('test123', 'password'), User.query.filter_by(username='test123').first())
         self.assertEqual(u.authenticate('test124', 'password'), False)
         self.assertEqual(u.authenticate('test123', 'pasword'), False)
+
+    def test_counters(self):
+        """Are the denormalized counters kept in step with follows, messages & likes?"""
+        u1 = User.signup(username='counter1', email='c1@test.com', password='password', image_url=None)
+        u2 = User.signup(username='counter2', email='c2@test.com', password='password', image_url=None)
+        db.session.commit()
+
+        u1.following.append(u2)
+        msg = Message(text='counted', user_id=u2.id)
+        db.session.add(msg)
+        db.session.commit()
+        u1.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual((u1.following_count, u1.likes_count), (1, 1))
+        self.assertEqual((u2.follower_count, u2.message_count), (1, 1))
+
+        u1.following.remove(u2)
+        db.session.delete(msg)
+        db.session.commit()
+
+        self.assertEqual((u1.following_count, u1.likes_count), (0, 0))
+        self.assertEqual((u2.follower_count, u2.message_count), (0, 0))
+
+    def test_counters_on_user_delete(self):
+        """Are likes and follows of a deleted user's rows uncounted in a
+        fixed number of statements, however many messages they had?"""
+        author = User.signup(username='leaving', email='l@test.com', password='password', image_url=None)
+        fan = User.signup(username='fan', email='f@test.com', password='password', image_url=None)
+        db.session.commit()
+        fan.following.append(author)
+        author.following.append(fan)
+        messages = [Message(text=f'bye {i}', user_id=author.id) for i in range(5)]
+        db.session.add_all(messages)
+        db.session.commit()
+        fan.likes.extend(messages)
+        db.session.add(Message(text='still here', user_id=fan.id))
+        db.session.commit()
+        self.assertEqual((fan.likes_count, fan.follower_count, fan.following_count), (5, 1, 1))
+
+        counter_updates = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('UPDATE users'):
+                counter_updates.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            db.session.delete(author)
+            db.session.commit()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        # likes, follower and following counts, then the author's message_count
+        self.assertEqual(len(counter_updates), 4)
+        self.assertEqual((fan.likes_count, fan.follower_count, fan.following_count), (0, 0, 0))
+        self.assertEqual(fan.message_count, 1)
+
+    def test_recount_counters(self):
+        """Does recount_counters repair drifted counters?"""
+        u = User.signup(username='drifted', email='d@test.com', password='password', image_url=None)
+        db.session.commit()
+        db.session.add(Message(text='one', user_id=u.id))
+        u.message_count = 42
+        u.follower_count = 7
+        db.session.commit()
+
+        recount_counters(batch_size=2)
+        self.assertEqual((u.message_count, u.follower_count), (1, 0))
+
+    def test_unread_counts(self):
+        """Are badge counts right, and refreshed when a DM or notification is committed?"""
+        u1 = User.signup(username='reader1', email='r1@test.com', password='password', image_url=None)
+        u2 = User.signup(username='sender1', email='s1@test.com', password='password', image_url=None)
+        db.session.commit()
+        self.assertEqual(unread_counts(u1.id), (0, 0))
+
+        db.session.add(Notification(notification_txt="follow_request", from_id=u2.id, to_id=u1.id))
+        dm = DirectMessage(dm_from=u2.id, dm_to=u1.id, message_text="hi")
+        db.session.add(dm)
+        db.session.commit()
+        self.assertEqual(unread_counts(u1.id), (1, 1))
+
+        dm.is_new = False
+        db.session.commit()
+        self.assertEqual(unread_counts(u1.id), (1, 0))
+
+        Notification.query.delete()
+        DirectMessage.query.delete()
+        db.session.commit()
+
+    def test_unread_cache_size(self):
+        """Does the badge cache keep only the most recently used users?"""
+        users = [User.signup(username=f'badge{i}', email=f'badge{i}@test.com', password='password',
+                             image_url=None) for i in range(3)]
+        db.session.commit()
+        app.config['UNREAD_CACHE_SIZE'] = 2
+        try:
+            for user in users:
+                unread_counts(user.id)
+            self.assertEqual(list(unread._cache), [users[1].id, users[2].id])
+            unread_counts(users[1].id)
+            unread_counts(users[0].id)
+            self.assertEqual(list(unread._cache), [users[1].id, users[0].id])
+        finally:
+            app.config['UNREAD_CACHE_SIZE'] = 1024
+
+    def test_current_user_snapshot(self):
+        """Is the cached snapshot read-only and reloaded after the user is edited?"""
+        u = User.signup(username='snapshot', email='snap@test.com', password='password', image_url=None)
+        db.session.commit()
+
+        snapshot = get_current_user(u.id)
+        self.assertEqual(snapshot.username, 'snapshot')
+        self.assertIs(get_current_user(u.id), snapshot)
+        with self.assertRaises(AttributeError):
+            snapshot.username = 'nope'
+
+        u.username = 'renamed'
+        db.session.commit()
+        self.assertEqual(get_current_user(u.id).username, 'renamed')
+
+    def test_current_user_changed_elsewhere(self):
+        """Is a snapshot dropped when another worker's change is announced,
+        and does the cache stay within its size?"""
+        app.config['EVENTS_FANOUT'] = 'local'
+        events.reset()
+        try:
+            users = [User.signup(username=f'cached{i}', email=f'cached{i}@test.com', password='password',
+                                 image_url=None) for i in range(3)]
+            db.session.commit()
+            user_id = users[0].id
+            self.assertFalse(get_current_user(user_id).is_admin)
+
+            # as another worker would: the row changes, then the event arrives
+            db.session.execute(User.__table__.update().where(User.id == user_id).values(is_admin=True))
+            db.session.commit()
+            self.assertFalse(get_current_user(user_id).is_admin)
+            events.send([(user_id, current_user.USER_CHANGED, {})])
+            self.assertTrue(get_current_user(user_id).is_admin)
+
+            app.config['CURRENT_USER_CACHE_SIZE'] = 2
+            for user in users:
+                get_current_user(user.id)
+            self.assertEqual(len(current_user._snapshots), 2)
+        finally:
+            app.config['CURRENT_USER_CACHE_SIZE'] = 1024
+            app.config.pop('EVENTS_FANOUT')
+            events.reset()
+
+    def test_authenticate_rehashes_weak_password(self):
+        """Is a hash made at a lower work factor upgraded on login?"""
+        rounds = passwords.settings['rounds']
+        passwords.settings['rounds'] = 4
+        try:
+            u = User.signup(username='oldhash', email='old@test.com', password='password', image_url=None)
+            db.session.commit()
+            self.assertTrue(u.password.startswith('$2b$04$'))
+            passwords.settings['rounds'] = 5
+
+            self.assertEqual(User.authenticate('oldhash', 'password'), u)
+            self.assertTrue(u.password.startswith('$2b$05$'))
+            self.assertFalse(passwords.needs_rehash(u.password))
+            self.assertTrue(passwords.check_password(u.password, 'password'))
+        finally:
+            passwords.settings['rounds'] = rounds
@@ -6,9 +6,12 @@
 
 
 import os
+from contextlib import contextmanager
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes, Follows
+from sqlalchemy import event
+
+from models import db, connect_db, Message, User, Likes, Follows, Block, Notification, paginate_timeline
 from bs4 import BeautifulSoup
 
 # BEFORE we import our app, let's set an environmental variable
@@ -22,6 +25,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from timelines import rebuild_all_timelines
+from search import search_messages
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -33,6 +38,26 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Rate limits are exercised in test_ratelimit.py
+
+app.config['RATELIMIT_ENABLED'] = False
+
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement run inside the block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -89,6 +114,31 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn("@efg", str(resp.data))
             self.assertNotIn("@hij", str(resp.data))
 
+    def test_users_search_bio_and_location(self):
+        self.u1.location = "Testville"
+        self.u2.bio = "nothing to see"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=testville")
+
+            self.assertIn("@abc", str(resp.data))
+            self.assertNotIn("@efg", str(resp.data))
+
+    def test_users_index_paginated(self):
+        with self.client as c:
+            resp = c.get("/users?page=2")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Sorry, no users found", str(resp.data))
+
+    def test_users_suggest(self):
+        with self.client as c:
+            resp = c.get("/users/suggest?q=TES")
+
+            usernames = [u['username'] for u in resp.json['users']]
+            self.assertEqual(sorted(usernames), ["testing", "testuser"])
+
     def test_user_show(self):
         with self.client as c:
             resp = c.get(f"/users/{self.testuser_id}")
@@ -175,6 +225,56 @@ class MessageViewTestCase(TestCase):
             # the like has been deleted
             self.assertEqual(len(likes), 0)
 
+    def test_like_json(self):
+        """Does the like endpoint report the new state and count, and is
+        setting an explicit state safe to repeat?"""
+        self.setup_likes()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = c.post("/messages/9876/like", json={"liked": True})
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json, {"message_id": "9876", "liked": True, "likes": 2})
+
+            resp = c.post("/messages/9876/like")
+            self.assertEqual(resp.json, {"message_id": "9876", "liked": False, "likes": 1})
+            resp = c.post("/messages/9876/like", data={"liked": "false"})
+            self.assertEqual(resp.json, {"message_id": "9876", "liked": False, "likes": 1})
+
+            self.assertEqual(c.post("/messages/12345/like").status_code, 404)
+
+        self.assertEqual(Likes.query.filter_by(message_id=9876).count(), 1)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_clear_notifications(self):
+        """Does clearing remove notifications up to the id sent, and only
+        the user's own, and report the new badge counts?"""
+        notifications = [Notification(notification_txt="follow_request", from_id=from_id, to_id=self.testuser_id)
+                         for from_id in (self.u1_id, self.u2_id, self.u3.id)]
+        db.session.add_all(notifications)
+        db.session.add(Notification(notification_txt="follow_request", from_id=self.u1_id, to_id=self.u2_id))
+        db.session.commit()
+        up_to, last = notifications[1].id, notifications[2].id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}/notifications")
+            self.assertIn(f'data-up-to="{last}"', str(resp.data))
+
+            resp = c.post("/users/notifications/clear", json={"up_to": up_to})
+            self.assertEqual(resp.json, {"cleared": 2, "pending_notifications": 1, "unread_dms": 0})
+
+            resp = c.post("/users/notifications/clear")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(Notification.query.filter_by(to_id=self.testuser_id).count(), 0)
+        self.assertEqual(Notification.query.filter_by(to_id=self.u2_id).count(), 1)
+
     def test_unauthenticated_like(self):
         self.setup_likes()
 
@@ -273,6 +373,199 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
 
+    def test_home_timeline(self):
+        self.setup_followers()
+        m1 = Message(text="from abc", user_id=self.u1_id)
+        m2 = Message(text="from efg", user_id=self.u2_id)
+        m3 = Message(text="from hij", user_id=self.u3.id)
+        m4 = Message(text="from me", user_id=self.testuser_id)
+        b = Block(user=self.testuser_id, blocked_user=self.u2_id)
+        db.session.add_all([m1, m2, m3, m4, b])
+        db.session.commit()
+        # rows added directly skip fan-out, same as seed.py
+        rebuild_all_timelines()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("from abc", str(resp.data))
+            self.assertIn("from me", str(resp.data))
+            # blocked author and unfollowed author are left out
+            self.assertNotIn("from efg", str(resp.data))
+            self.assertNotIn("from hij", str(resp.data))
+
+    def test_home_timeline_pagination(self):
+        msgs = [Message(text=f"warble {i}", user_id=self.testuser_id) for i in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        user = User.query.get(self.testuser_id)
+        page1, cursor = paginate_timeline(user.home_timeline(), limit=3)
+        self.assertEqual(len(page1), 3)
+        self.assertIsNotNone(cursor)
+
+        page2, cursor = paginate_timeline(user.home_timeline(), before=cursor, limit=3)
+        self.assertEqual(len(page2), 2)
+        self.assertIsNone(cursor)
+        self.assertEqual(len({m.id for m in page1 + page2}), 5)
+
+    def test_all_messages_full_page_without_blocked(self):
+        # 100 visible messages, with the newest ones from a blocked user
+        db.session.add_all([Message(text=f"visible {i}", user_id=self.u1_id) for i in range(100)])
+        db.session.add_all([Message(text=f"hidden {i}", user_id=self.u2_id) for i in range(5)])
+        db.session.add(Block(user=self.testuser_id, blocked_user=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/messages/all")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("hidden", str(resp.data))
+            self.assertEqual(str(resp.data).count("visible "), 100)
+
+    def test_all_messages_private_account(self):
+        self.u3.is_private = True
+        db.session.add(Message(text="private warble", user_id=self.u3.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/messages/all")
+            self.assertNotIn("private warble", str(resp.data))
+
+    def test_all_messages_query_count_ignores_blocks(self):
+        u3_id, u4_id = self.u3.id, self.u4.id
+        db.session.add_all([Message(text=f"warble {i}", user_id=self.u1_id) for i in range(20)])
+        db.session.add(Block(user=self.testuser_id, blocked_user=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            with count_queries() as one_block:
+                c.get("/messages/all")
+
+            db.session.add_all([Block(user=self.testuser_id, blocked_user=u3_id),
+                                Block(user=self.testuser_id, blocked_user=u4_id)])
+            db.session.commit()
+
+            with count_queries() as three_blocks:
+                c.get("/messages/all")
+
+            self.assertEqual(len(one_block), len(three_blocks))
+
+    def test_users_index_query_count_ignores_follows(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            # warm the navbar's unread-count cache so both pages hit it
+            c.get("/users")
+
+            with count_queries() as no_follows:
+                c.get("/users")
+
+            self.setup_followers()
+
+            with count_queries() as some_follows:
+                resp = c.get("/users")
+
+            self.assertEqual(len(no_follows), len(some_follows))
+            self.assertEqual(str(resp.data).count("Unfollow"), 2)
+
+    def test_relationship_cache_sees_writes(self):
+        with app.test_request_context():
+            user = User.query.get(self.testuser_id)
+            other = User.query.get(self.u1_id)
+            self.assertFalse(user.is_following(other))
+
+            user.following.append(other)
+            db.session.flush()
+            self.assertTrue(user.is_following(other))
+
+    def test_timeline_pages_load_authors_in_one_query(self):
+        """Each message card's author must not cost its own SELECT."""
+        authors = [self.u1_id, self.u2_id, self.u3.id, self.u4.id]
+        for author_id in authors:
+            db.session.add(Follows(user_being_followed_id=author_id,
+                                   user_following_id=self.testuser_id))
+        db.session.commit()
+
+        def post_and_like(author_ids):
+            for author_id in author_ids:
+                msg = Message(text="card", user_id=author_id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=self.testuser_id, message_id=msg.id))
+            db.session.commit()
+            rebuild_all_timelines()
+
+        pages = ["/", "/messages/all", f"/users/{self.testuser_id}/likes"]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            post_and_like(authors[:1])
+            # warm the navbar's unread-count cache so every page hits it
+            c.get("/")
+            counts_one_author = []
+            for page in pages:
+                with count_queries() as statements:
+                    c.get(page)
+                counts_one_author.append(len(statements))
+
+            post_and_like(authors[1:])
+            counts_four_authors = []
+            for page in pages:
+                with count_queries() as statements:
+                    c.get(page)
+                counts_four_authors.append(len(statements))
+
+        self.assertEqual(counts_one_author, counts_four_authors)
+
+    def test_messages_search(self):
+        u3_id = self.u3.id
+        self.u3.is_private = True
+        db.session.add_all([Message(text="lunch at the beach", user_id=self.u1_id),
+                            Message(text="beach day", user_id=self.u2_id),
+                            Message(text="private beach", user_id=u3_id),
+                            Message(text="working late", user_id=self.u1_id)])
+        db.session.add(Block(user=self.testuser_id, blocked_user=self.u2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/messages/search?q=beach")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("lunch at the beach", str(resp.data))
+            # blocked author, private account and non-matching text are left out
+            self.assertNotIn("beach day", str(resp.data))
+            self.assertNotIn("private beach", str(resp.data))
+            self.assertNotIn("working late", str(resp.data))
+
+    def test_messages_search_pagination(self):
+        db.session.add_all([Message(text=f"cursor warble {i}", user_id=self.u1_id) for i in range(5)])
+        db.session.commit()
+
+        user = User.query.get(self.testuser_id)
+        page1, cursor = search_messages(user, "warble", limit=3)
+        self.assertEqual(len(page1), 3)
+        page2, cursor = search_messages(user, "warble", before=cursor, limit=3)
+        self.assertEqual(len(page2), 2)
+        self.assertIsNone(cursor)
+        self.assertEqual(len({m.id for m in page1 + page2}), 5)
+
 
 #######################################################################################
 #NOTE- my own code below. I couldn't figure out how to test for logged in users.
@@ -0,0 +1,227 @@
+"""Fan-out-on-write home timelines for Warbler.
+
+When a user posts, the new message id is pushed into the timeline_entries
+of everyone following them, so reading the home page is a single range read
+on (user_id, message_id); message ids are time-ordered. Authors with more followers than
+TIMELINE_CELEBRITY_CUTOFF are not fanned out; their messages are merged in
+when the timeline is read instead.
+
+Follow, unfollow, block and delete routes keep the entries in step. If they
+ever drift, `flask rebuild-timelines` rebuilds them from the source tables.
+"""
+
+from sqlalchemy import and_, exists, func, literal, or_, select
+
+from models import db, Block, Follows, Message, TimelineEntry, User, encode_cursor, paginate_newer, paginate_timeline, timeline_query
+
+DEFAULT_CELEBRITY_CUTOFF = 10000
+
+ENTRY_COLUMNS = ['user_id', 'message_id', 'author_id']
+
+
+def celebrity_cutoff():
+    """Follower count above which an author's posts are merged at read time."""
+    return db.get_app().config.get('TIMELINE_CELEBRITY_CUTOFF', DEFAULT_CELEBRITY_CUTOFF)
+
+
+def is_celebrity(user_id):
+    """Does this user have too many followers to fan out to?"""
+    follower_count = db.session.query(User.follower_count).filter(User.id == user_id).scalar()
+    return (follower_count or 0) > celebrity_cutoff()
+
+
+def followed_celebrities(user_id):
+    """Ids of celebrity authors `user_id` follows and has not blocked."""
+    followed_ids = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+    blocked_ids = (db.session
+                   .query(Block.blocked_user)
+                   .filter(Block.user == user_id))
+    celebrities = (db.session
+                   .query(User.id)
+                   .filter(User.id.in_(followed_ids))
+                   .filter(~User.id.in_(blocked_ids))
+                   .filter(User.follower_count > celebrity_cutoff()))
+    return [user_id for (user_id,) in celebrities]
+
+
+def _insert_entries(query):
+    """INSERT ... SELECT the (user_id, message_id, author_id) rows of `query`."""
+    stmt = TimelineEntry.__table__.insert().from_select(ENTRY_COLUMNS, query.statement)
+    db.session.execute(stmt)
+
+
+def fan_out_message(msg):
+    """Push a new message into its author's timeline and, unless the author
+    is a celebrity, into the timeline of every follower who hasn't blocked them."""
+    db.session.flush()
+    db.session.add(TimelineEntry(user_id=msg.user_id, message_id=msg.id,
+                                 author_id=msg.user_id))
+    if is_celebrity(msg.user_id):
+        return
+
+    not_blocked = ~exists().where(and_(Block.user == Follows.user_following_id,
+                                       Block.blocked_user == msg.user_id))
+    followers = (db.session
+                 .query(Follows.user_following_id,
+                        literal(msg.id),
+                        literal(msg.user_id))
+                 .filter(Follows.user_being_followed_id == msg.user_id)
+                 .filter(not_blocked))
+    _insert_entries(followers)
+
+
+def backfill_follow(follower_id, followed_id):
+    """Copy the followed user's messages into the follower's timeline."""
+    blocked = Block.query.filter_by(user=follower_id, blocked_user=followed_id).first()
+    if blocked or is_celebrity(followed_id):
+        return
+
+    already_there = exists().where(and_(TimelineEntry.user_id == follower_id,
+                                        TimelineEntry.message_id == Message.id))
+    messages = (db.session
+                .query(literal(follower_id), Message.id, Message.user_id)
+                .filter(Message.user_id == followed_id)
+                .filter(~already_there))
+    _insert_entries(messages)
+
+
+def prune_author(user_id, author_id):
+    """Drop everything by `author_id` from `user_id`'s timeline (unfollow / block)."""
+    (TimelineEntry
+     .query
+     .filter_by(user_id=user_id, author_id=author_id)
+     .delete(synchronize_session=False))
+
+
+def remove_message(message_id):
+    """Drop a deleted message from every timeline it was fanned out to."""
+    (TimelineEntry
+     .query
+     .filter_by(message_id=message_id)
+     .delete(synchronize_session=False))
+
+
+def remove_user(user_id):
+    """Drop a deleted user's own timeline and their messages in everyone else's."""
+    (TimelineEntry
+     .query
+     .filter(or_(TimelineEntry.user_id == user_id, TimelineEntry.author_id == user_id))
+     .delete(synchronize_session=False))
+
+
+def rebuild_timeline(user):
+    """Rebuild one user's materialized timeline from follows, blocks and messages."""
+    TimelineEntry.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+
+    celebrities = followed_celebrities(user.id)
+    messages = (user
+                .home_timeline()
+                .with_entities(literal(user.id), Message.id, Message.user_id))
+    if celebrities:
+        messages = messages.filter(or_(Message.user_id == user.id,
+                                       ~Message.user_id.in_(celebrities)))
+    _insert_entries(messages)
+
+
+def rebuild_all_timelines(batch_size=500):
+    """Rebuild every user's timeline, committing once per batch of users.
+
+    Returns how many timelines were rebuilt.
+    """
+    rebuilt = 0
+    last_id = 0
+    while True:
+        users = (User
+                 .query
+                 .filter(User.id > last_id)
+                 .order_by(User.id)
+                 .limit(batch_size)
+                 .all())
+        if not users:
+            return rebuilt
+        for user in users:
+            rebuild_timeline(user)
+        db.session.commit()
+        rebuilt += len(users)
+        last_id = users[-1].id
+
+
+def read_home_timeline(user, before=None, limit=100):
+    """Return (messages, next_cursor) for a page of `user`'s home timeline.
+
+    Reads the materialized entries and merges in followed celebrities'
+    messages, paged with the same cursor as paginate_timeline.
+    """
+    materialized = (timeline_query()
+                    .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                    .filter(TimelineEntry.user_id == user.id))
+    messages, next_cursor = paginate_timeline(materialized, before, limit,
+                                              id_column=TimelineEntry.message_id)
+
+    celebrities = followed_celebrities(user.id)
+    if not celebrities:
+        return messages, next_cursor
+
+    celebrity_messages, celebrity_cursor = paginate_timeline(
+        timeline_query().filter(Message.user_id.in_(celebrities)), before, limit)
+
+    # an author's older posts may already be materialized from before they
+    # crossed the cutoff, so de-duplicate by id before merging
+    merged = {msg.id: msg for msg in messages + celebrity_messages}
+    merged = sorted(merged.values(), key=lambda msg: msg.id, reverse=True)
+    page = merged[:limit]
+    has_more = len(merged) > limit or next_cursor or celebrity_cursor
+    return page, (encode_cursor(page[-1]) if has_more and page else None)
+
+
+def home_watermark(user_id):
+    """The newest message id in `user_id`'s home timeline (0 if empty).
+
+    One statement, all index probes: the top of the user's materialized
+    entries and the latest post of each followed celebrity they haven't
+    blocked. Nothing newer than this means nothing new to show.
+    """
+    materialized = (select([func.max(TimelineEntry.message_id)])
+                    .where(TimelineEntry.user_id == user_id)
+                    .as_scalar())
+    latest_post = (select([Message.id])
+                   .where(Message.user_id == Follows.user_being_followed_id)
+                   .order_by(Message.id.desc())
+                   .limit(1)
+                   .as_scalar())
+    not_blocked = ~exists().where(and_(Block.user == user_id,
+                                       Block.blocked_user == Follows.user_being_followed_id))
+    celebrities = (select([func.max(latest_post)])
+                   .select_from(Follows.__table__.join(User.__table__,
+                                                       User.id == Follows.user_being_followed_id))
+                   .where(and_(Follows.user_following_id == user_id,
+                               User.follower_count > celebrity_cutoff(),
+                               not_blocked))
+                   .as_scalar())
+    return max(value or 0 for value in db.session.query(materialized, celebrities).one())
+
+
+def latest_message_id():
+    """The newest message id anywhere: the global timeline's watermark."""
+    return db.session.query(func.max(Message.id)).scalar() or 0
+
+
+def read_home_since(user, since, limit=100):
+    """Return (messages, more) for `user`'s home timeline messages newer
+    than the `since` message id, oldest first (see paginate_newer)."""
+    materialized = (timeline_query()
+                    .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                    .filter(TimelineEntry.user_id == user.id))
+    messages, more = paginate_newer(materialized, since, limit, id_column=TimelineEntry.message_id)
+
+    celebrities = followed_celebrities(user.id)
+    if not celebrities:
+        return messages, more
+
+    celebrity_messages, celebrity_more = paginate_newer(
+        timeline_query().filter(Message.user_id.in_(celebrities)), since, limit)
+    merged = {msg.id: msg for msg in messages + celebrity_messages}
+    merged = sorted(merged.values(), key=lambda msg: msg.id)
+    return merged[:limit], len(merged) > limit or more or celebrity_more
@@ -0,0 +1,86 @@
+"""Short-lived per-user cache of the navbar's unread badge counts.
+
+base.html shows pending notifications and unread DMs on every page, so the
+(pending_notifications, unread_dms) pair from User.unread_counts() is kept
+in a process-local cache for UNREAD_CACHE_TTL seconds. Any committed change
+to a Notification or DirectMessage drops the cached entry of the user it was
+sent to, so the badge updates on the next page. Other gunicorn workers may
+show the old count until their own entry expires. At most
+UNREAD_CACHE_SIZE users are kept, least recently used out first.
+"""
+
+import time
+from collections import OrderedDict
+from itertools import chain
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from metrics import record_cache
+from models import db, DirectMessage, Notification, count_unread
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 15
+
+_cache = OrderedDict()
+_lock = Lock()
+
+
+def cache_ttl():
+    """Seconds a cached count may be served (UNREAD_CACHE_TTL)."""
+    return db.get_app().config.get('UNREAD_CACHE_TTL', DEFAULT_TTL)
+
+
+def unread_counts(user_id):
+    """Return (pending_notifications, unread_dms) for `user_id`, cached."""
+    now = time.monotonic()
+    with _lock:
+        cached = _cache.get(user_id)
+        if cached and cached[0] > now:
+            _cache.move_to_end(user_id)
+            record_cache('unread', True)
+            return cached[1]
+
+    record_cache('unread', False)
+    counts = count_unread(user_id)
+    with _lock:
+        _cache[user_id] = (now + cache_ttl(), counts)
+        _cache.move_to_end(user_id)
+        while len(_cache) > db.get_app().config.get('UNREAD_CACHE_SIZE', DEFAULT_SIZE):
+            _cache.popitem(last=False)
+    return counts
+
+
+def invalidate_unread(*user_ids):
+    """Forget cached counts for these users."""
+    with _lock:
+        for user_id in user_ids:
+            _cache.pop(user_id, None)
+
+
+def invalidate_on_commit(*user_ids):
+    """Forget these users' cached counts once the session commits; for bulk
+    statements, which the flush listener below never sees."""
+    db.session.info.setdefault('unread_touched', set()).update(user_ids)
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_unread_changes(session, flush_context):
+    """Remember whose badges a flush touched; invalidated once it commits."""
+    touched = session.info.setdefault('unread_touched', set())
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Notification):
+            touched.add(obj.to_id)
+        elif isinstance(obj, DirectMessage):
+            touched.add(obj.dm_to)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    invalidate_unread(*session.info.pop('unread_touched', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rolled_back(session):
+    session.info.pop('unread_touched', None)